@@ -18,19 +18,51 @@ limitations under the License.
 """
 
 import numpy as np
-from scipy.io import loadmat, matlab
-import matplotlib.pyplot as plt
 import os
+from instrumentation import get_logger, stage
+
+TIMESTAMP_RATE = 1e4  # assume timestamps have 4 decimal places
+AFFERENT_TYPES = ('sa', 'ra', 'pc')  # afferent_class codes 0, 1, 2 (-1 for a neuron that is none of these)
+logger = get_logger('loader')
+LOADER_VERSION = 2  # bump whenever TouchSimMat2Python's output changes; invalidates trials cached by trialcache.py
+PARTIAL_SUFFIX = '.partial'  # outputs being written (MATLAB saves <name>.mat.partial, then renames it to <name>.mat)
+POPULATION_FILE = 'population.mat'  # afferent population shared by a spikes directory (matlab/TouchSimPopulation.m)
+#  Variables of the flat export written by matlab/TouchSimToFlat.m [see flat_sensors()]
+FLAT_VARIABLES = ('flat_version', 'spike_times', 'spike_offsets', 'sensor_offsets', 'afferent_class', 'locations',
+                  'depths', 'rates', 'duration')
 
 ## helper functions
-def load_mat(filename):
+def is_trial_file(filename):
+    """
+    True for the .mat files the loaders read. Outputs still being written end in PARTIAL_SUFFIX, so they are skipped,
+    and so is the POPULATION_FILE saved next to the spikes files.
+    """
+    return filename.endswith('.mat') and filename != POPULATION_FILE
+
+def load_mat(filename, variable_names=None):
     """
     This function should be called instead of direct scipy.io.loadmat
     as it cures the problem of not properly recovering python dictionaries
     from mat files. It calls the function check keys to cure all entries
     which are still mat-objects
     from https://stackoverflow.com/questions/48970785/complex-matlab-struct-mat-file-read-by-python
+    :param variable_names: only read (and convert) these variables of the file (optional)
+    """
+    from scipy.io import loadmat  # imported here so analysis of cached trials never pays for scipy.io
+
+    with stage('mat_read', bytes_read=os.path.getsize(filename)):
+        data = loadmat(filename, variable_names=variable_names, struct_as_record=False, squeeze_me=True)
+    with stage('struct_conversion'):
+        return mat_to_dict(data)
+
+def mat_to_dict(data):
+    """
+    Converts the mat-objects among the variables read by scipy.io.loadmat(..., struct_as_record=False,
+    squeeze_me=True) to nested dictionaries and arrays, in place [see load_mat()]
+    :param data: dictionary of variables as returned by loadmat
+    :return: data
     """
+    from scipy.io import matlab
 
     def _check_vars(d):
         """
@@ -78,51 +110,211 @@ def load_mat(filename):
         else:
             return ndarray
 
-    data = loadmat(filename, struct_as_record=False, squeeze_me=True)
     return _check_vars(data)
 
-def TouchSimMat2Python(data_dir,file):
+def load_r_strs(filename):
+    """
+    Reads only the r_strs variable of a TouchSim file and leaves its structs unconverted (scipy mat_struct objects).
+    Fields are read with mat_field(), so only the handful the analysis needs are ever touched; the stimulus trace
+    and afferent parameter blocks are never turned into dictionaries.
+    """
+    return load_touchsim_variables(filename)['r_strs']
+
+def load_touchsim_variables(filename, full=False):
+    """
+    Reads a TouchSim file in one pass, whichever format it is in: the r_strs cell written by MuJoCoSpikesToStruct,
+    or the flat export variables (FLAT_VARIABLES) written by MuJoCoToSpikes(..., 'flat'). Other variables are
+    never read. Pass full=True to convert r_strs to nested dictionaries [see mat_to_dict()]; the flat variables are
+    plain arrays and are always returned as read.
+    :return: dictionary of the variables found
+    """
+    from scipy.io import loadmat
+
+    variable_names = ['r_strs'] + list(FLAT_VARIABLES)
+    with stage('mat_read', bytes_read=os.path.getsize(filename)):
+        variables = loadmat(filename, variable_names=variable_names, struct_as_record=False, squeeze_me=True)
+    if full and 'r_strs' in variables:
+        with stage('struct_conversion'):
+            variables['r_strs'] = mat_to_dict({'r_strs': variables['r_strs']})['r_strs']
+    return variables
+
+def mat_field(struct, name):
+    """
+    Reads a field of a TouchSim struct, whether converted to a dictionary by load_mat() or raw from load_r_strs()
+    """
+    return struct[name] if isinstance(struct, dict) else getattr(struct, name)
+
+def spike_times_from_responses(responses, rates):
+    """
+    Build the sparse spike-time structure for one sensor straight from the TouchSim responses.
+    Spike times are truncated to TIMESTAMP_RATE resolution (as the dense raster always did), so
+    repeated timestamps within a neuron collapse to a single spike.
+    :return: spike_times - 1D float array of every neuron's spike times (sec), neuron by neuron
+             spike_offsets - int array of length n_neurons + 1; neuron i owns spike_times[spike_offsets[i]:spike_offsets[i+1]]
+    """
+    counts = np.zeros(rates.shape[0], dtype=np.int64)
+    neuron_ticks = []
+    activeneuronidx = np.nonzero(rates)
+    for activeneuron in activeneuronidx[0]:
+        spikestamps = np.atleast_1d(mat_field(responses[activeneuron], 'spikes')) * TIMESTAMP_RATE  # account for 1 spike
+        spikestamps = np.unique(spikestamps.astype(int))
+        counts[activeneuron] = spikestamps.shape[0]
+        neuron_ticks.append(spikestamps)
+
+    spike_offsets = np.zeros(rates.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=spike_offsets[1:])
+    if len(neuron_ticks) == 0:
+        return np.zeros(0), spike_offsets
+    return np.concatenate(neuron_ticks) / TIMESTAMP_RATE, spike_offsets
+
+
+def afferent_class_codes(metadata):
+    """
+    Convert the iSA1/iRA/iPC flags of every afferent into one int8 code per neuron (index into AFFERENT_TYPES)
+    """
+    codes = np.full(len(metadata), -1, dtype=np.int8)
+    for code in reversed(range(len(AFFERENT_TYPES))):  # SA wins over RA wins over PC, as in the original elif chain
+        flag = ('iSA1', 'iRA', 'iPC')[code]
+        codes[np.array([mat_field(afferent, flag) == 1 for afferent in metadata], dtype=bool)] = code
+    return codes
+
+
+def afferent_locations(metadata):
+    """
+    Stack the location of every afferent into an n neurons x 2 array
+    """
+    return np.array([mat_field(afferent, 'location') for afferent in metadata], dtype=float).reshape(len(metadata), 2)
+
+
+def afferent_depths(metadata):
+    """
+    Collect the depth of every afferent into a 1D array
+    """
+    return np.array([mat_field(afferent, 'depth') for afferent in metadata], dtype=float).reshape(len(metadata))
+
+
+def spike_raster(spike_times, spike_offsets, n_timestamps):
+    """
+    Build the dense n neurons x d time array where the entries are 1 if a spike occurred at a specific
+    timestamp (column index). Only use this when a raster is actually needed; it is mostly zeros.
+    """
+    with stage('spike_densification', spikes=spike_times.shape[0]):
+        n_neurons = spike_offsets.shape[0] - 1
+        spikes = np.zeros((n_neurons, int(n_timestamps)))
+        rows = np.repeat(np.arange(n_neurons), np.diff(spike_offsets))
+        cols = np.rint(spike_times * TIMESTAMP_RATE).astype(int)
+        spikes[rows, cols] = 1
+        return spikes
+
+
+def raster_to_spike_times(spikes):
+    """
+    Inverse of spike_raster(); converts a dense 0/1 raster to spike_times and spike_offsets
+    """
+    with stage('spike_densification') as measurement:
+        rows, cols = np.nonzero(spikes)
+        spike_offsets = np.zeros(spikes.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=spikes.shape[0]), out=spike_offsets[1:])
+        measurement['spikes'] = rows.shape[0]
+        return cols / TIMESTAMP_RATE, spike_offsets
+
+
+def flat_sensors(variables, sensor_type):
+    """
+    Build the TouchSimMat2Python() sensor dictionaries of a flat export [see matlab/TouchSimToFlat.m]:
+        spike_times    - every spike time (sec), afferent by afferent and sensor by sensor
+        spike_offsets  - afferent i (counted across sensors) owns spike_times[spike_offsets[i]:spike_offsets[i+1]]
+        sensor_offsets - sensor s owns afferents sensor_offsets[s]:sensor_offsets[s+1]
+        afferent_class - int8 code per afferent (index into AFFERENT_TYPES, -1 for none)
+        locations      - n afferents x 2, depths and rates - per afferent, duration - per sensor
+    Spike times are truncated to TIMESTAMP_RATE resolution and deduplicated per neuron, exactly as
+    spike_times_from_responses() does for r_strs files.
+    """
+    spike_offsets = np.atleast_1d(variables['spike_offsets']).astype(np.int64)
+    sensor_offsets = np.atleast_1d(variables['sensor_offsets']).astype(np.int64)
+    rates = np.atleast_1d(variables['rates']).astype(float)
+    durations = np.atleast_1d(variables['duration']).astype(float)
+    afferent_class = np.atleast_1d(variables['afferent_class']).astype(np.int8)
+    locations = np.asarray(variables['locations'], dtype=float).reshape(-1, 2)
+    depths = np.atleast_1d(variables['depths']).astype(float)
+
+    with stage('spike_densification') as measurement:
+        #  Same ticks as spike_times_from_responses(): truncate, drop silent neurons, unique per neuron
+        ticks = (np.atleast_1d(variables['spike_times']).astype(float) * TIMESTAMP_RATE).astype(int)
+        neurons = np.repeat(np.arange(spike_offsets.shape[0] - 1), np.diff(spike_offsets))
+        keep = rates[neurons] != 0
+        ticks, neurons = ticks[keep], neurons[keep]
+        order = np.lexsort((ticks, neurons))
+        ticks, neurons = ticks[order], neurons[order]
+        first = np.ones(ticks.shape[0], dtype=bool)
+        first[1:] = (ticks[1:] != ticks[:-1]) | (neurons[1:] != neurons[:-1])
+        ticks, neurons = ticks[first], neurons[first]
+        measurement['spikes'] = ticks.shape[0]
+
+    sensor_data = []
+    for sensor in range(sensor_offsets.shape[0] - 1):
+        start, stop = sensor_offsets[sensor], sensor_offsets[sensor + 1]
+        in_sensor = (neurons >= start) & (neurons < stop)
+        counts = np.bincount(neurons[in_sensor] - start, minlength=stop - start)
+        neuron_data = {}
+        neuron_data['spike_times'] = ticks[in_sensor] / TIMESTAMP_RATE
+        neuron_data['spike_offsets'] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        neuron_data['n_timestamps'] = int(np.ceil(durations[sensor]*TIMESTAMP_RATE)+10)
+        neuron_data['afferent_class'] = afferent_class[start:stop]
+        neuron_data['locations'] = locations[start:stop]
+        neuron_data['depths'] = depths[start:stop]
+        neuron_data['rates'] = rates[start:stop]
+        neuron_data['sensor_type'] = sensor_type
+        neuron_data['sensor_no'] = sensor
+        sensor_data.append(neuron_data)
+    return sensor_data
+
+def TouchSimMat2Python(data_dir,file,dense=False,full=True):
     """
     Create a dictionary from a touchsim file that contains the file's spikes and metadata
+    Spikes are stored sparsely: 'spike_times' holds every neuron's spike times (sec) back to back and neuron i's
+    spikes are spike_times[spike_offsets[i]:spike_offsets[i+1]]. Pass dense=True to also build the
+    n neurons x d time 0/1 raster under 'spikes' (see spike_raster()).
+    Pass full=False to skip converting the whole file to dictionaries [see load_r_strs()]: only the spikes, rates,
+    duration, afferent class flags, locations and depths are read, and 'metadata' and 'stimulus' are left out.
+    Files in the flat export format [see flat_sensors()] are read directly; they carry no 'metadata' or 'stimulus'.
     """
-    print('loading ', file)
-    datas = load_mat(str(data_dir + file))
-    data_str = datas['r_strs']
-    sensor_type = 'trq'
+    logger.info('loading %s', file)
+    variables = load_touchsim_variables(str(data_dir + file), full=full)
+    sensor_type = 'ftsn' if 'ftsn' in file else 'trq'
+    if 'spike_times' in variables:
+        sensor_data = flat_sensors(variables, sensor_type)
+        if dense:
+            for neuron_data in sensor_data:
+                neuron_data['spikes'] = spike_raster(neuron_data['spike_times'], neuron_data['spike_offsets'],
+                                                     neuron_data['n_timestamps'])
+        return sensor_data
+
+    data_str = variables['r_strs']
     if 'ftsn' in file:
         data_str = [data_str]  # hack to get single value into list
-        sensor_type = 'ftsn'
     # print(data_str)
     # print(len(data_str))
     sensor_data = []
     for sensor in range(len(data_str)):
         data = data_str[sensor]
-        affpop = data['affpop']
-        responses = data['responses']
-        stimulus = data['stimulus']  # doing anything with this?
-        rates = data['rate']
-        duration = data['duration']
-
-        # generate a spikes array of n neurons x d time where the entries are 1 if a spike occurred at a specific timestamp (column index)
-        dt = 1e4  # assume timestamps have 4 decimal places
-        # numtimestamps = np.around(duration, decimals=4) * dt
-        # numtimestamps = np.ceil(duration*1e5)/1e5*dt
-        numtimestamps = np.ceil(duration*dt)+10
-        spikes = np.zeros((rates.shape[0], int(numtimestamps)))  # TODO: this may be too big
-        activeneuronidx = np.nonzero(rates)
-        for activeneuron in activeneuronidx[0]:
-            spikestamps = responses[activeneuron]['spikes']
-            spikestamps = spikestamps * dt
-            if np.isscalar(spikestamps):
-                spikestamps = np.array([spikestamps])  # hack to account for 1 spike
-            spikestamps = spikestamps.astype(int)
-            for spikestamp in spikestamps:
-                spikes[activeneuron, spikestamp] = 1
-        # print(spikes)
-
-        # generate a dictionary that maps neuron index to metadata (physical position of neuron, finger, neuron type, neuron parameters, etc)
-        neuron_metadata = affpop[
-            'afferents']  # metadata should conveniently be in afferent population from MATLAB already
+        with stage('struct_conversion') as measurement:
+            affpop = mat_field(data, 'affpop')
+            responses = mat_field(data, 'responses')
+            rates = mat_field(data, 'rate')
+            duration = mat_field(data, 'duration')
+
+            # store spike times as one flat array plus per-neuron offsets (CSR-style) instead of a dense raster
+            numtimestamps = int(np.ceil(duration*TIMESTAMP_RATE)+10)
+            spike_times, spike_offsets = spike_times_from_responses(responses, rates)
+            measurement['spikes'] = spike_times.shape[0]
+
+            # generate a dictionary that maps neuron index to metadata (physical position of neuron, finger, neuron type, neuron parameters, etc)
+            neuron_metadata = mat_field(affpop,
+                'afferents')  # metadata should conveniently be in afferent population from MATLAB already
+            afferent_class = afferent_class_codes(neuron_metadata)
+            locations = afferent_locations(neuron_metadata)
+            depths = afferent_depths(neuron_metadata)
         # print(neuron_metadata)
 
         # for i in range(len(neuron_metadata)):
@@ -133,11 +325,20 @@ def TouchSimMat2Python(data_dir,file):
         #     print(neuron_metadata[i]['location'])
         #     print(neuron_metadata[i]['depth'])
         #     print(neuron_metadata[i]['idx'])
-        print('np array and metadata dictionary constructed for ', file, ', now creating dictionary with both')
+        logger.debug('np array and metadata dictionary constructed for %s (sensor %d), now creating dictionary with both',
+                     file, sensor)
         neuron_data = {}
-        neuron_data['spikes'] = spikes
-        neuron_data['metadata'] = neuron_metadata
-        neuron_data['stimulus'] = stimulus
+        neuron_data['spike_times'] = spike_times
+        neuron_data['spike_offsets'] = spike_offsets
+        neuron_data['n_timestamps'] = numtimestamps
+        if dense:
+            neuron_data['spikes'] = spike_raster(spike_times, spike_offsets, numtimestamps)
+        neuron_data['afferent_class'] = afferent_class
+        neuron_data['locations'] = locations
+        neuron_data['depths'] = depths
+        if full:
+            neuron_data['metadata'] = neuron_metadata
+            neuron_data['stimulus'] = data['stimulus']  # doing anything with this?
         neuron_data['rates'] = rates
         neuron_data['sensor_type'] = sensor_type
         neuron_data['sensor_no'] = sensor
@@ -145,7 +346,7 @@ def TouchSimMat2Python(data_dir,file):
         sensor_data.append(neuron_data)
     return sensor_data
 
-def TouchSimMatDir2Python(data_dir):
+def TouchSimMatDir2Python(data_dir,dense=False):
     """
     Create a dictionary from a directory full of touchsim files that uses a file's name as key and returns a
     subdictionary with the file's spikes and metadata as the value
@@ -153,9 +354,9 @@ def TouchSimMatDir2Python(data_dir):
     data_dir_contents = os.listdir(data_dir)
     file_data={}
     for file in data_dir_contents:
-        if 'mat' in file: # assume any .mat files are touchsim files for now
-            file_data[file] = TouchSimMat2Python(data_dir,file)
+        if is_trial_file(file): # assume any .mat files are touchsim files for now
+            file_data[file] = TouchSimMat2Python(data_dir,file,dense=dense)
         else:
-            print('skipping ',file)
+            logger.info('skipping %s', file)
     # print(file_data)
     return file_data
@@ -0,0 +1,170 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import spiketrainanalysis as sta
+import trialstats as ts
+import trialcache
+from instrumentation import StageRecorder
+from TouchSimMat2Python_Loader import load_mat, TouchSimMat2Python
+from synthetic_trials import write_dataset, noise_directory
+
+#  Scale ladder: afferents per sensor, response duration (sec), trials per object
+SCALES = {'small': {'n_neurons': 100, 'duration': 0.5, 'trials': 2},
+          'medium': {'n_neurons': 300, 'duration': 1.0, 'trials': 3},
+          'large': {'n_neurons': 1000, 'duration': 2.0, 'trials': 4}}
+REGRESSION_THRESHOLD = 1.25  # flag benchmarks this many times slower (or larger) than the baseline
+
+
+def measure(function, repeats=3):
+    """
+    Runs function repeats times for timing and once more under tracemalloc for peak memory. The trial cache is
+    emptied before every run so loading is always measured cold. Output printed by the toolkit is discarded.
+    :return: best wall time (sec), peak traced memory (bytes)
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            trialcache.get_trial_cache().clear()
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+        trialcache.get_trial_cache().clear()
+        tracemalloc.start()
+        try:
+            function()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmarks(root, n_bins=30):
+    """
+    The benchmarked calls for a dataset written by write_dataset(), as (name, function) pairs
+    """
+    data_dir = os.path.join(root, noise_directory(0)) + '/'
+    minus_dir = os.path.join(root, noise_directory(-6)) + '/'
+    ftsn_1, _ = ts.trial_select(root, noise=0, sensor='ftsn', obj=1)
+    ftsn_2, _ = ts.trial_select(root, noise=0, sensor='ftsn', obj=2)
+    file = ftsn_1[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        sensor = TouchSimMat2Python(data_dir, file, dense=True)[0]
+
+    return [
+        ('load_mat', lambda: load_mat(data_dir + file)),
+        ('TouchSimMat2Python', lambda: TouchSimMat2Python(data_dir, file)),
+        ('TouchSimMat2Python (full=False)', lambda: TouchSimMat2Python(data_dir, file, full=False)),
+        ('calculate_afferet_isi_stats (raster)',
+         lambda: sta.calculate_afferet_isi_stats(sensor['spikes'], sensor['metadata'], 0)),
+        ('calculate_afferet_isi_stats (sparse)',
+         lambda: sta.calculate_afferet_isi_stats(sensor['spike_times'], sensor['metadata'], 0,
+                                                 spike_offsets=sensor['spike_offsets'])),
+        ('trial_isi_probability_distribution',
+         lambda: sta.trial_isi_probability_distribution(n_bins, data_dir, list(ftsn_1), plot=False)),
+        ('trial_distance_probabilty_distribution',
+         lambda: sta.trial_distance_probabilty_distribution(data_dir, list(ftsn_1), n_bins, plot=False)),
+        ('compare_neuron', lambda: ts.compare_neuron(data_dir, ftsn_1, 5, 50, n_bins=n_bins, plot=False)),
+        ('compare_all_neurons', lambda: ts.compare_all_neurons(data_dir, ftsn_1, n_bins=n_bins)),
+        ('compare_afferent', lambda: ts.compare_afferent(data_dir, ftsn_1, 'sa', 'ra', n_bins=n_bins, plot=False)),
+        ('compare_response', lambda: ts.compare_response(data_dir, ftsn_1, ftsn_2, n_bins=n_bins, plot=False)),
+        ('compare_trial', lambda: ts.compare_trial(data_dir, ftsn_1[:1], ftsn_1[1:], n_bins=n_bins, plot=False)),
+        ('compare_noise', lambda: ts.compare_noise(data_dir, minus_dir, ftsn_1, ftsn_1, n_bins=n_bins, plot=False)),
+        ('compare_location',
+         lambda: ts.compare_location(data_dir, ftsn_1, ref1=(0, 0), ref2=(5, 5), n_bins=n_bins, plot=False)),
+    ]
+
+
+def run(scales, repeats=3, work_dir=None, stages=False):
+    """
+    Writes the dataset of every scale and measures every benchmark on it
+    stages=True also prints the per-stage breakdown of one more run of every benchmark [see instrumentation.py]
+    :return: {scale: {benchmark: {'seconds': ..., 'peak_bytes': ...}}}
+    """
+    results = {}
+    for scale in scales:
+        root = os.path.join(work_dir, scale)
+        if not os.path.isdir(root):
+            write_dataset(root, objects=(1, 2), trials=range(1, SCALES[scale]['trials'] + 1),
+                          n_neurons=SCALES[scale]['n_neurons'], duration=SCALES[scale]['duration'])
+        results[scale] = {}
+        for name, function in benchmarks(root):
+            seconds, peak = measure(function, repeats=repeats)
+            results[scale][name] = {'seconds': seconds, 'peak_bytes': peak}
+            print(f'{scale:>7} {name:<40} {seconds * 1e3:10.1f} ms {peak / 2 ** 20:9.1f} MiB')
+            if stages:
+                trialcache.get_trial_cache().clear()
+                with StageRecorder() as recorder:
+                    function()
+                print(recorder.report() + '\n')
+    return results
+
+
+def regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Lists the benchmarks whose time or peak memory grew past threshold x their value in baseline
+    """
+    found = []
+    for scale, scale_results in results.items():
+        for name, result in scale_results.items():
+            reference = baseline.get(scale, {}).get(name)
+            if reference is None:
+                continue
+            for metric in ('seconds', 'peak_bytes'):
+                if reference[metric] > 0 and result[metric] > threshold * reference[metric]:
+                    found.append((scale, name, metric, reference[metric], result[metric]))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and peak memory of the spike train analysis toolkit')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--work-dir', help='where to write (and reuse) the synthetic datasets (default: temporary)')
+    parser.add_argument('--output', help='save the results as json')
+    parser.add_argument('--stages', action='store_true', help='print the per-stage breakdown of every benchmark')
+    parser.add_argument('--baseline', help='results json of an earlier run to check for regressions')
+    args = parser.parse_args()
+
+    trialcache.configure_trial_cache(cache_dir=None)  # measure parsing, not the on-disk trial cache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run(args.scales, repeats=args.repeats, work_dir=args.work_dir or tmp_dir, stages=args.stages)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(results, json.load(baseline_file))
+        for scale, name, metric, before, after in found:
+            print(f'REGRESSION: {scale} {name} {metric} {before:.4g} -> {after:.4g}')
+        sys.exit(1 if found else 0)
@@ -0,0 +1,164 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import argparse
+import numpy as np
+from scipy.io import savemat
+
+AFFERENT_CLASSES = ('SA1', 'RA', 'PC')
+DEFAULT_MIX = (0.35, 0.45, 0.2)  # fraction of SA1, RA and PC afferents
+DEFAULT_FIRING_RATES = (20.0, 40.0, 80.0)  # mean firing rate (Hz) of active SA1, RA and PC afferents
+DEFAULT_DEPTHS = ((0.4, 0.8), (0.8, 1.5), (1.5, 3.0))  # range of afferent depths (mm) per class
+
+
+def cell(items):
+    """
+    Builds a 1 x n MATLAB cell array (numpy object array) that savemat writes the way MATLAB's {} would
+    """
+    cell_array = np.empty((1, len(items)), dtype=object)
+    for i, item in enumerate(items):
+        cell_array[0, i] = item
+    return cell_array
+
+
+def afferent_population(rng, n_neurons=300, mix=DEFAULT_MIX, finger_radius=8.0):
+    """
+    Generates the afferents of a TouchSim population as MuJoCoSpikesToStruct leaves them (one struct per afferent),
+    sorted by class like affpop_hand()
+    """
+    classes = np.sort(rng.choice(len(AFFERENT_CLASSES), size=n_neurons, p=mix))
+    afferents = []
+    for idx, afferent_class in enumerate(classes):
+        depth_range = DEFAULT_DEPTHS[afferent_class]
+        afferents.append({'class': AFFERENT_CLASSES[afferent_class],
+                          'location': rng.uniform(-finger_radius, finger_radius, size=(1, 2)),
+                          'depth': float(rng.uniform(*depth_range)),
+                          'idx': idx + 1,
+                          'iSA1': int(afferent_class == 0),
+                          'iRA': int(afferent_class == 1),
+                          'iPC': int(afferent_class == 2),
+                          'noisy': 0,
+                          'parameters': rng.normal(size=(1, 12))})
+    return afferents
+
+
+def r_str(rng, afferents, duration=1.0, firing_rates=DEFAULT_FIRING_RATES, silent_fraction=0.2, rate_scale=1.0,
+          sampling_rate=5000):
+    """
+    Generates one sensor's response structure (an element of r_strs): Poisson spike trains for every afferent,
+    a silent_fraction of which never fire, plus a stimulus trace sampled at sampling_rate
+    """
+    responses = []
+    rates = np.zeros((len(afferents), 1))
+    for i, afferent in enumerate(afferents):
+        mean_rate = firing_rates[AFFERENT_CLASSES.index(afferent['class'])] * rate_scale
+        if rng.random() < silent_fraction:
+            spikes = np.zeros((1, 0))
+        else:
+            spike_count = rng.poisson(mean_rate * rng.lognormal(0, 0.5) * duration)
+            spikes = np.sort(rng.uniform(0, duration, size=spike_count)).reshape(1, -1)
+        rates[i] = spikes.size / duration
+        responses.append({'afferent': afferent, 'spikes': spikes, 'duration': duration})
+
+    trace = np.abs(np.cumsum(rng.normal(0, 0.01, size=int(duration * sampling_rate)))).reshape(-1, 1)
+    stimulus = {'trace': trace, 'sf': float(sampling_rate), 'location': np.zeros((1, 2)), 'pin_radius': 5.64}
+    return {'affpop': {'afferents': cell(afferents), 'surface': 'hand'}, 'responses': cell(responses),
+            'stimulus': stimulus, 'rate': rates, 'duration': duration}
+
+
+def flat_variables(r_strs):
+    """
+    Flattens the sensors of one file into the variables matlab/TouchSimToFlat.m saves (the flat export format read
+    by TouchSimMat2Python_Loader.flat_sensors())
+    """
+    afferents = [afferent for sensor in r_strs for afferent in sensor['affpop']['afferents'][0]]
+    spikes = [response['spikes'].ravel() for sensor in r_strs for response in sensor['responses'][0]]
+    return {'flat_version': 1.0,
+            'spike_times': np.concatenate([np.zeros(0)] + spikes).reshape(-1, 1),
+            'spike_offsets': np.cumsum([0] + [spike_times.shape[0] for spike_times in spikes]).astype(np.int64),
+            'sensor_offsets': np.cumsum([0] + [len(sensor['affpop']['afferents'][0]) for sensor in r_strs]
+                                        ).astype(np.int64),
+            'afferent_class': np.array([0 if afferent['iSA1'] else 1 if afferent['iRA'] else 2 if afferent['iPC']
+                                        else -1 for afferent in afferents], dtype=np.int8),
+            'locations': np.array([afferent['location'].ravel() for afferent in afferents]).reshape(-1, 2),
+            'depths': np.array([afferent['depth'] for afferent in afferents]),
+            'rates': np.concatenate([sensor['rate'].ravel() for sensor in r_strs]),
+            'duration': np.array([sensor['duration'] for sensor in r_strs], dtype=float)}
+
+
+def noise_directory(noise):
+    """
+    Name of the directory holding the trials of a noise level (dB), as trial_select() expects it
+    """
+    return f'data_minus{-noise}' if noise < 0 else f'data_noise_{noise}'
+
+
+def write_dataset(root, noise_levels=(0, -6), sensors=('ftsn', 'trq'), objects=(1, 2), dims=(2,), trials=(1, 2, 3),
+                  n_neurons=300, duration=1.0, mix=DEFAULT_MIX, firing_rates=DEFAULT_FIRING_RATES,
+                  silent_fraction=0.2, trq_sensors=3, seed=0, flat=False):
+    """
+    Writes a synthetic dataset in the layout of the MATLAB pipeline: one noise_directory() per noise level, holding
+    spikes_<sensor>_object_<o>_dim_<d>_trial_<t>.mat files with an r_strs cell (1 sensor for ftsn, trq_sensors for
+    trq). Every file of a sensor type shares one afferent population; noise levels scale the firing rates
+    (+/-6 dB = x2^(+/-1/2)) so they differ measurably. Pass flat=True to write the flat export format instead
+    [see flat_variables()].
+    :return: list of the written file paths
+    """
+    rng = np.random.default_rng(seed)
+    populations = {sensor: [afferent_population(rng, n_neurons, mix)
+                            for _ in range(trq_sensors if sensor == 'trq' else 1)] for sensor in sensors}
+    paths = []
+    for noise in noise_levels:
+        directory = os.path.join(root, noise_directory(noise))
+        os.makedirs(directory, exist_ok=True)
+        for sensor in sensors:
+            for obj in objects:
+                for dim in dims:
+                    for trial in trials:
+                        r_strs = [r_str(rng, afferents, duration=duration, firing_rates=firing_rates,
+                                        silent_fraction=silent_fraction, rate_scale=2 ** (noise / 12))
+                                  for afferents in populations[sensor]]
+                        path = os.path.join(directory, f'spikes_{sensor}_object_{obj}_dim_{dim}_trial_{trial}.mat')
+                        savemat(path, flat_variables(r_strs) if flat else {'r_strs': cell(r_strs)})
+                        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic TouchSim dataset (r_strs .mat files)')
+    parser.add_argument('root', help='directory to create the noise level directories in')
+    parser.add_argument('--noise', type=int, nargs='+', default=[0, -6], help='noise levels (dB)')
+    parser.add_argument('--sensors', nargs='+', default=['ftsn', 'trq'])
+    parser.add_argument('--objects', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--dims', type=int, nargs='+', default=[2])
+    parser.add_argument('--trials', type=int, default=3, help='trials per object and dim')
+    parser.add_argument('--neurons', type=int, default=300, help='afferents per sensor')
+    parser.add_argument('--duration', type=float, default=1.0, help='response duration (sec)')
+    parser.add_argument('--mix', type=float, nargs=3, default=DEFAULT_MIX, help='SA1 RA PC fractions')
+    parser.add_argument('--rates', type=float, nargs=3, default=DEFAULT_FIRING_RATES, help='SA1 RA PC rates (Hz)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--flat', action='store_true', help='write the flat export format instead of r_strs')
+    args = parser.parse_args()
+
+    written = write_dataset(args.root, noise_levels=args.noise, sensors=args.sensors, objects=args.objects,
+                            dims=args.dims, trials=range(1, args.trials + 1), n_neurons=args.neurons,
+                            duration=args.duration, mix=args.mix, firing_rates=args.rates, seed=args.seed,
+                            flat=args.flat)
+    print(f'wrote {len(written)} files to {args.root}')
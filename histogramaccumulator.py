@@ -0,0 +1,195 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from instrumentation import stage
+
+
+def histogram_bin_indices(data, bin_edges):
+    """
+    Function returns the bin of every value in data as np.histogram(data, bins=bin_edges) would count it
+    (the last bin includes its right edge). Values outside the edges get -1.
+    """
+    n_bins = bin_edges.shape[0] - 1
+    indices = np.searchsorted(bin_edges, data, side='right') - 1
+    indices[data == bin_edges[-1]] = n_bins - 1
+    indices[(indices < 0) | (indices >= n_bins)] = -1
+    return indices
+
+
+class HistogramAccumulator:
+    """
+    Streaming histogram on fixed bin edges. Arrays are added one at a time (e.g. one trial's ISIs) and only the bin
+    counts are kept, together with
+        underflow / overflow - number of values below the first / above the last edge
+        count, mean, m2      - exact count, mean and sum of squared deviations of every value added
+        minimum, maximum     - range of every value added
+    so memory does not grow with the number of trials. Accumulators on the same edges can be merged (e.g. one per
+    worker) and saved to / restored from a dictionary of arrays [see to_arrays()] or an .npz file.
+    """
+
+    def __init__(self, bin_edges):
+        self.bin_edges = np.asarray(bin_edges, dtype=float)
+        self.counts = np.zeros(self.bin_edges.shape[0] - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def add(self, data, weights=None):
+        """
+        Counts every value of data (any shape), each weights times (integer multiplicities, e.g. from ValueCounter)
+        when given; returns self
+        """
+        data = np.asarray(data, dtype=float).ravel()
+        weights = np.ones(data.shape[0], dtype=np.int64) if weights is None else np.asarray(weights).ravel()
+        if data.shape[0] == 0:
+            return self
+        with stage('histogram', spikes=data.shape[0]):
+            bins = histogram_bin_indices(data, self.bin_edges)
+            inside = bins >= 0
+            self.counts += np.bincount(bins[inside], weights=weights[inside],
+                                       minlength=self.counts.shape[0]).astype(np.int64)
+            self.underflow += int(weights[data < self.bin_edges[0]].sum())
+            self.overflow += int(weights[data > self.bin_edges[-1]].sum())
+            count = int(weights.sum())
+            mean = float(np.dot(weights, data)) / count
+            self._merge_moments(count, mean, float(np.dot(weights, (data - mean) ** 2)), data.min(), data.max())
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts and moments of another accumulator on the same bin edges; returns self
+        """
+        if not np.array_equal(self.bin_edges, other.bin_edges):
+            raise ValueError('Cannot merge histograms with different bin edges.')
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        if other.count > 0:
+            self._merge_moments(other.count, other.mean, other.m2, other.minimum, other.maximum)
+        return self
+
+    def _merge_moments(self, count, mean, m2, minimum, maximum):
+        #  Chan et al. pairwise update, exact up to float round-off in any merge order
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.minimum = min(self.minimum, float(minimum))
+        self.maximum = max(self.maximum, float(maximum))
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count > 0 else np.nan
+
+    def to_arrays(self):
+        """
+        Dictionary of numpy arrays holding the full state, e.g. for np.savez(path, **accumulator.to_arrays())
+        """
+        return {'bin_edges': self.bin_edges, 'counts': self.counts,
+                'underflow': np.array(self.underflow), 'overflow': np.array(self.overflow),
+                'count': np.array(self.count), 'mean': np.array(self.mean), 'm2': np.array(self.m2),
+                'minimum': np.array(self.minimum), 'maximum': np.array(self.maximum)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Inverse of to_arrays(); also accepts the NpzFile returned by np.load()
+        """
+        accumulator = cls(arrays['bin_edges'])
+        accumulator.counts = np.array(arrays['counts'], dtype=np.int64)
+        accumulator.underflow = int(arrays['underflow'])
+        accumulator.overflow = int(arrays['overflow'])
+        accumulator.count = int(arrays['count'])
+        accumulator.mean = float(arrays['mean'])
+        accumulator.m2 = float(arrays['m2'])
+        accumulator.minimum = float(arrays['minimum'])
+        accumulator.maximum = float(arrays['maximum'])
+        return accumulator
+
+    def save(self, path):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls.from_arrays(arrays)
+
+
+class ValueCounter:
+    """
+    Exact record of the values added so far: every distinct value (sorted) and how many times it was added.
+    Spike times are quantised to TIMESTAMP_RATE and an afferent population has fixed locations, so the distinct
+    ISIs or distances of a dataset stay few however many trials are added. The range and the counts on any bin
+    edges then come from one pass over the trials [see histogram()]. Counters can be merged (e.g. one per worker).
+        count, minimum, maximum - number and range of every value added
+    """
+
+    def __init__(self):
+        self.values = np.zeros(0)
+        self.multiplicities = np.zeros(0, dtype=np.int64)
+
+    def add(self, data):
+        """
+        Adds every value of data (any shape); returns self
+        """
+        values, multiplicities = np.unique(np.asarray(data, dtype=float).ravel(), return_counts=True)
+        return self._merge(values, multiplicities)
+
+    def merge(self, other):
+        """
+        Adds the values of another counter; returns self
+        """
+        return self._merge(other.values, other.multiplicities)
+
+    def _merge(self, values, multiplicities):
+        if values.shape[0] == 0:
+            return self
+        if self.values.shape[0] == 0:
+            self.values, self.multiplicities = values, multiplicities.astype(np.int64)
+            return self
+        weights = np.concatenate((self.multiplicities, multiplicities))
+        self.values, inverse = np.unique(np.concatenate((self.values, values)), return_inverse=True)
+        self.multiplicities = np.bincount(inverse.ravel(), weights=weights,
+                                          minlength=self.values.shape[0]).astype(np.int64)
+        return self
+
+    @property
+    def count(self):
+        return int(self.multiplicities.sum())
+
+    @property
+    def minimum(self):
+        return float(self.values[0]) if self.values.shape[0] > 0 else np.inf
+
+    @property
+    def maximum(self):
+        return float(self.values[-1]) if self.values.shape[0] > 0 else -np.inf
+
+    def histogram(self, bin_edges):
+        """
+        HistogramAccumulator on bin_edges of every value added, identical to adding the values one trial at a time
+        (up to float round-off in the moments)
+        """
+        return HistogramAccumulator(bin_edges).add(self.values, weights=self.multiplicities)
@@ -0,0 +1,157 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import logging
+import threading
+import tracemalloc
+import contextlib
+
+STAGES = ('mat_read', 'struct_conversion', 'spike_densification', 'isi_extraction', 'histogram', 'kl', 'spike_distance')
+LOGGER_NAME = 'blast_tools'  # parent of every logger in this repo, e.g. logging.getLogger('blast_tools').setLevel(...)
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+def get_logger(module_name):
+    """
+    Logger of a module of this repo, a child of the LOGGER_NAME logger
+    """
+    return logging.getLogger(f'{LOGGER_NAME}.{module_name}')
+
+
+def configure_logging(level=logging.INFO, handler=None):
+    """
+    Shows the toolkit's log messages (e.g. which file is being loaded) at level and above. Messages are
+    'blast_tools.<module> LEVEL: message' on stderr unless another handler is given. Use level=logging.ERROR to
+    silence the warnings too.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(name)s %(levelname)s: %(message)s'))
+    logger.handlers = [handler]
+    return logger
+
+
+def add_hook(callback):
+    """
+    Registers callback(measurement) to receive every stage measurement [see stage()]
+    """
+    with _hooks_lock:
+        _hooks.append(callback)
+
+
+def remove_hook(callback):
+    with _hooks_lock:
+        if callback in _hooks:
+            _hooks.remove(callback)
+
+
+@contextlib.contextmanager
+def stage(name, bytes_read=0, spikes=0):
+    """
+    Measures one pipeline stage (one of STAGES) and passes the measurement to every registered hook as a dictionary:
+        stage      - stage name
+        seconds    - wall time
+        bytes_read - bytes read from disk
+        spikes     - spikes (or values) processed
+        peak_bytes - peak allocation above the stage's starting point, if tracemalloc is tracing (else None)
+    The with block can fill in bytes_read/spikes on the yielded dictionary once it knows them.
+    Without hooks nothing is measured. Stages are not nested inside each other, so each peak covers one stage.
+    Measurements are only reported in the process that runs the stage (not from worker processes).
+    """
+    measurement = {'stage': name, 'bytes_read': bytes_read, 'spikes': spikes}
+    if not _hooks:
+        yield measurement
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield measurement
+    measurement['seconds'] = time.perf_counter() - start
+    measurement['peak_bytes'] = tracemalloc.get_traced_memory()[1] - start_bytes if tracing else None
+
+    with _hooks_lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(measurement)
+
+
+class StageRecorder:
+    """
+    Context manager that collects every stage measurement made inside it, e.g.
+        with StageRecorder(trace_memory=True) as recorder:
+            trialstats.compare_response(...)
+        print(recorder.report())
+    trace_memory=True runs tracemalloc for peak allocations, which slows the run down noticeably.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.measurements = []
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        add_hook(self.measurements.append)
+        return self
+
+    def __exit__(self, *exc_info):
+        remove_hook(self.measurements.append)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def summary(self):
+        """
+        Totals per stage: {stage: {'calls', 'seconds', 'bytes_read', 'spikes', 'peak_bytes' (largest single peak)}}
+        """
+        totals = {}
+        for measurement in self.measurements:
+            total = totals.setdefault(measurement['stage'], {'calls': 0, 'seconds': 0.0, 'bytes_read': 0,
+                                                             'spikes': 0, 'peak_bytes': None})
+            total['calls'] += 1
+            total['seconds'] += measurement['seconds']
+            total['bytes_read'] += measurement['bytes_read']
+            total['spikes'] += measurement['spikes']
+            if measurement['peak_bytes'] is not None:
+                total['peak_bytes'] = max(total['peak_bytes'] or 0, measurement['peak_bytes'])
+        return totals
+
+    def report(self):
+        """
+        Table of summary(), one line per stage in pipeline order
+        """
+        totals = self.summary()
+        lines = [f'{"stage":<20} {"calls":>6} {"seconds":>9} {"MiB read":>9} {"spikes":>11} {"peak MiB":>9}']
+        for name in sorted(totals, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+            total = totals[name]
+            peak = f'{total["peak_bytes"] / 2 ** 20:9.1f}' if total['peak_bytes'] is not None else f'{"-":>9}'
+            lines.append(f'{name:<20} {total["calls"]:>6} {total["seconds"]:>9.3f} '
+                         f'{total["bytes_read"] / 2 ** 20:>9.1f} {total["spikes"]:>11} {peak}')
+        return '\n'.join(lines)
@@ -0,0 +1,72 @@
+% Christophe J. Brown
+% August 2020
+% 
+% Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+% 
+% Licensed under the MIT License (the "License");
+% you may not use this file except in compliance with the License.
+% You may obtain a copy of the License at
+% 
+% https://opensource.org/licenses/MIT
+% 
+% Unless required by applicable law or agreed to in writing, software
+% distributed under the License is distributed on an "AS IS" BASIS,
+% WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+% See the License for the specific language governing permissions and
+% limitations under the License.
+
+function MuJoCoFileToSpikes(file_path, save_path, export_format)
+% Converts one HAPTIX depth file to TouchSim spikes and saves it to save_path as spikes_ftsn_<name>.mat
+% export_format - 'object' (default) or 'flat' (see MuJoCoToSpikes)
+% The afferent population is the one of save_path (<save_path>/population.mat, see TouchSimPopulation), so every
+% engine of a parallel conversion, and every later run into save_path, uses the same afferents. It is loaded on the
+% first call of a MATLAB session and kept until save_path or its population file changes. The file is written to
+% <name>.partial and then moved into place, so an interrupted conversion never leaves a truncated .mat file behind.
+if nargin < 3
+    export_format = 'object';
+end
+
+persistent population population_key
+population_file = fullfile(save_path, 'population.mat');
+listing = dir(population_file);
+key = '';
+if ~isempty(listing)
+    key = sprintf('%s %.10f', population_file, listing.datenum);
+end
+if isempty(key) || ~strcmp(key, population_key)
+    population = TouchSimPopulation(save_path);
+    listing = dir(population_file);
+    population_key = sprintf('%s %.10f', population_file, listing.datenum);
+end
+
+data = load(file_path);
+depths = data.depths;
+
+%grab the depths
+sensor_trace = depths(:,2); % This is the sensor data from mujoco (in mm)
+
+%calculate average sampling frequency
+average_sample_time = mean(depths(:,3)); %Indexing the times
+
+%generate stimulus signal
+sampling_freq = round(1 / average_sample_time);
+sensor_stim = Stimulus(sensor_trace,population.stim_location,sampling_freq,population.pin_rad);
+
+%generate afferent behavior based on the stimulus signal
+for j = 1:length(population.fingers)
+    r_sensor(j) = population.a(j).response(sensor_stim);
+end
+
+%save out variable for the trial
+[~, save_name, ~] = fileparts(file_path);
+save_filename = fullfile(save_path, strcat('spikes_ftsn_',save_name,'.mat'));
+partial_filename = strcat(save_filename,'.partial');
+if strcmp(export_format, 'flat')
+    flat = TouchSimToFlat(r_sensor);
+    save(partial_filename,'-struct','flat','-mat');
+else
+    save(partial_filename,'r_sensor','-mat');
+end
+movefile(partial_filename,save_filename,'f');
+
+end
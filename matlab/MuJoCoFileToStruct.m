@@ -0,0 +1,59 @@
+% Christophe J. Brown
+% August 2020
+% 
+% Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+% 
+% Licensed under the MIT License (the "License");
+% you may not use this file except in compliance with the License.
+% You may obtain a copy of the License at
+% 
+% https://opensource.org/licenses/MIT
+% 
+% Unless required by applicable law or agreed to in writing, software
+% distributed under the License is distributed on an "AS IS" BASIS,
+% WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+% See the License for the specific language governing permissions and
+% limitations under the License.
+
+function MuJoCoFileToStruct(file_path, new_dir)
+% Converts the TouchSim response objects (r_sensor) of one spikes file to plain structs (r_strs) that scipy can
+% read, saved under the same name in new_dir. The file is written to <name>.partial and then moved into place, so
+% an interrupted conversion never leaves a truncated .mat file behind.
+data = load(file_path);
+
+% start new instance of data as struct, losing methods associated
+% with object but converting custom obj to standard matlab obj
+r_strs={};
+
+r_strs{1}=struct(data.r_sensor);
+
+for k=1:length(r_strs)
+    r_str=r_strs{k};
+    % first level
+    r_str.affpop=struct(r_str.affpop);
+    responses=r_str.responses;
+    r_str.responses={};
+    for j=1:length(responses)
+        responses_struct=struct(responses(j));
+        responses_struct.afferent=struct(responses_struct.afferent);
+        r_str.responses{j}=responses_struct;
+    end
+    r_str.stimulus=struct(r_str.stimulus);
+
+    % second level
+    affpop_afferents=r_str.affpop.afferents;
+    r_str.affpop.afferents={};
+    for j=1:length(affpop_afferents)
+        afferent_struct=struct(affpop_afferents(j));
+        r_str.affpop.afferents{j}=afferent_struct;
+    end
+    r_strs{k}=r_str;
+end
+
+[~, name, ext] = fileparts(file_path);
+newfilename=fullfile(new_dir,strcat(name,ext));
+partial_filename=strcat(newfilename,'.partial');
+save(partial_filename,'r_strs','-mat')
+movefile(partial_filename,newfilename,'f')
+
+end
@@ -15,7 +15,13 @@
 % See the License for the specific language governing permissions and
 % limitations under the License.
 
-function MuJoCoSense(spikes_save_path, target_sampling_frequency, step_count, trial_count)
+function saved_files = MuJoCoSense(spikes_save_path, target_sampling_frequency, step_count, trial_count, first_trial)
+% first_trial - number of the first trial in the saved filenames (default 1), so trials can also be sensed one call
+%               at a time (e.g. by the pipelined mode of mujoco_sense.py)
+% saved_files - cell array with the full name of every trial file saved, in trial order
+    if nargin < 5
+        first_trial = 1;
+    end
 
 %     mj_close() % if "Already connected" error is being thrown.
     mj = HaptixInterface('key');
@@ -57,7 +63,8 @@ function MuJoCoSense(spikes_save_path, target_sampling_frequency, step_count, tr
     % END OF INITIALIZATION -------------------------------------------------
 
     % MAIN LOOP - This happens for each desired trial
-    for trial = 1:trial_count
+    saved_files = {};
+    for trial = first_trial:first_trial + trial_count - 1
         A_wrist_UDEV = A_wrist_UDEV_init;
         
         jointAngles = [A_wrist_PRO A_wrist_UDEV A_wrist_PRO A_thumb_ABD... 
@@ -116,7 +123,11 @@ function MuJoCoSense(spikes_save_path, target_sampling_frequency, step_count, tr
         sampling_freq = round(1 / average_sample_time)
         % Record indentation depth into array for saving
 
-        save(strcat(spikes_save_path,'\object_key_sf_',num2str(sampling_freq), '_trial_',num2str(trial),'.mat'), 'depths')
+        % Write to a .partial file and move it into place, so readers never see a half-written trial
+        save_filename = strcat(spikes_save_path,'\object_key_sf_',num2str(sampling_freq), '_trial_',num2str(trial),'.mat');
+        save(strcat(save_filename,'.partial'), 'depths', '-mat')
+        movefile(strcat(save_filename,'.partial'), save_filename, 'f')
+        saved_files{end + 1} = save_filename;
     end
 
 
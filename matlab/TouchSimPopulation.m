@@ -0,0 +1,61 @@
+% Christophe J. Brown
+% August 2020
+% 
+% Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+% 
+% Licensed under the MIT License (the "License");
+% you may not use this file except in compliance with the License.
+% You may obtain a copy of the License at
+% 
+% https://opensource.org/licenses/MIT
+% 
+% Unless required by applicable law or agreed to in writing, software
+% distributed under the License is distributed on an "AS IS" BASIS,
+% WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+% See the License for the specific language governing permissions and
+% limitations under the License.
+
+function population = TouchSimPopulation(save_path)
+% Builds the TouchSim afferent population and stimulus settings shared by every converted file
+% save_path - optional; the population is kept in <save_path>/population.mat. The first call builds and saves it,
+%             every later call (from any MATLAB engine, or a later run) loads it, so neuron i is the same afferent
+%             in every spikes file of save_path (affpop_hand places the afferents at random).
+if nargin > 0
+    population_file = fullfile(save_path, 'population.mat');
+    if exist(population_file, 'file')
+        saved = load(population_file);
+        population = saved.population;
+        return
+    end
+end
+
+population.fingers = {'D2d'}; % Tip of index finger
+
+%set up the stimulus location properties 
+population.pin_rad = 5.64;      % pin with 5.64 mm radius gives contact area ~100 mm^2)
+
+%Note: within TouchSim, the segment ID for the distal finger pads are Thumb (1),
+%Index (3), Middle (14), Ring (18), and Little (21)
+stim_location = [65 -60; 
+                  0 0;
+                  -4 53;
+                  20 85;
+                  63 105]; % pin coordinate (D1; D2; D3; D4; D5 distal finger pads)
+
+population.stim_location = stim_location(2,:); %downselect to only the fingers we want to analyze
+
+%generate afferent population 
+fprintf('Generating afferent population...\r\n');
+for i = 1:length(population.fingers)
+    a(i) = affpop_hand(population.fingers{i});    
+end
+population.a = a;
+fprintf('Done\r\n');
+
+if nargin > 0
+    partial_filename = strcat(population_file,'.partial');
+    save(partial_filename,'population','-mat');
+    movefile(partial_filename,population_file,'f');
+end
+
+end
@@ -0,0 +1,80 @@
+% Christophe J. Brown
+% August 2020
+% 
+% Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+% 
+% Licensed under the MIT License (the "License");
+% you may not use this file except in compliance with the License.
+% You may obtain a copy of the License at
+% 
+% https://opensource.org/licenses/MIT
+% 
+% Unless required by applicable law or agreed to in writing, software
+% distributed under the License is distributed on an "AS IS" BASIS,
+% WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+% See the License for the specific language governing permissions and
+% limitations under the License.
+
+function flat = TouchSimToFlat(r_sensor)
+% Flattens TouchSim responses (one per sensor) into plain arrays that Python reads directly
+% (TouchSimMat2Python_Loader.flat_sensors), with no struct conversion. Save with save(filename,'-struct','flat').
+%   spike_times    - every spike time (sec), afferent by afferent and sensor by sensor
+%   spike_offsets  - afferent i (0-based, counted across sensors) owns spike_times(spike_offsets(i+1)+1:spike_offsets(i+2))
+%   sensor_offsets - sensor s owns afferents sensor_offsets(s)+1:sensor_offsets(s+1)
+%   afferent_class - 0 SA1, 1 RA, 2 PC, -1 none (int8)
+%   locations      - n afferents x 2 locations
+%   depths, rates  - one per afferent
+%   duration       - one per sensor
+%   flat_version   - version of this format
+
+afferent_count = 0;
+for s = 1:length(r_sensor)
+    afferent_count = afferent_count + length(r_sensor(s).affpop.afferents);
+end
+
+spike_times = cell(afferent_count, 1);
+spike_counts = zeros(1, afferent_count);
+afferent_class = -ones(1, afferent_count);
+locations = zeros(afferent_count, 2);
+depths = zeros(afferent_count, 1);
+rates = zeros(afferent_count, 1);
+sensor_sizes = zeros(1, length(r_sensor));
+duration = zeros(1, length(r_sensor));
+
+i = 0;
+for s = 1:length(r_sensor)
+    r = r_sensor(s);
+    afferents = r.affpop.afferents;
+    sensor_sizes(s) = length(afferents);
+    duration(s) = r.duration;
+    rates(i+1:i+length(afferents)) = r.rate(:);
+    for k = 1:length(afferents)
+        i = i + 1;
+        spikes = r.responses(k).spikes;
+        spike_times{i} = spikes(:);
+        spike_counts(i) = numel(spikes);
+
+        afferent = afferents(k);
+        if afferent.iSA1 % same precedence as the Python loader
+            afferent_class(i) = 0;
+        elseif afferent.iRA
+            afferent_class(i) = 1;
+        elseif afferent.iPC
+            afferent_class(i) = 2;
+        end
+        locations(i,:) = afferent.location;
+        depths(i) = afferent.depth;
+    end
+end
+
+flat.flat_version = 1;
+flat.spike_times = vertcat(zeros(0,1), spike_times{:});
+flat.spike_offsets = int64([0 cumsum(spike_counts)]);
+flat.sensor_offsets = int64([0 cumsum(sensor_sizes)]);
+flat.afferent_class = int8(afferent_class);
+flat.locations = locations;
+flat.depths = depths;
+flat.rates = rates;
+flat.duration = duration;
+
+end
@@ -18,33 +18,236 @@ limitations under the License.
 """
 
 import os
+import json
+import time
 import errno
-import matlab.engine
+import queue
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from TouchSimMat2Python_Loader import PARTIAL_SUFFIX, POPULATION_FILE, is_trial_file
+from instrumentation import get_logger
+
+logger = get_logger('mujoco_sense')
+
+PATHS_CONFIGURED = 'blast_tools_paths_configured'  # MATLAB root appdata set once a session's paths are set up
+MANIFEST_NAME = 'conversion_manifest.json'  # kept in every conversion output directory
+MANIFEST_VERSION = 1
+PIPELINE_END = None  # queued after the last item of a pipeline stage
+
+
+def matlab_engine():
+    """
+    Imports the MATLAB engine API on first use, so this module can be imported (e.g. with a stand-in engine)
+    without MATLAB installed
+    """
+    import matlab.engine
+    return matlab.engine
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_identity(path, checksum=False):
+    """
+    Size and mtime of an input file, plus its SHA-1 when checksum is set
+    """
+    stat = os.stat(path)
+    identity = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if checksum:
+        identity['sha1'] = file_sha1(path)
+    return identity
+
+
+def load_manifest(output_dir):
+    """
+    Reads the conversion manifest of an output directory: for every converted input (absolute path), its identity
+    [see file_identity()], the conversion options and the output filenames it produced
+    """
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as file:
+            manifest = json.load(file)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'inputs': {}}
+
+
+def save_manifest(output_dir, manifest):
+    """
+    Writes the manifest to a temporary file and renames it into place, so it is never left half written
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=PARTIAL_SUFFIX)
+    with os.fdopen(fd, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp_path, os.path.join(output_dir, MANIFEST_NAME))
+
+
+def up_to_date(manifest, input_path, output_dir, options, checksum=False):
+    """
+    True if input_path was converted with the same options, is unchanged since (same size and mtime, or same
+    SHA-1 when checksum is set and the mtime differs) and all of its outputs still exist. When the SHA-1 confirms
+    a file whose mtime changed, the recorded mtime is refreshed (in manifest, which the caller saves), so the file
+    is not hashed again on later runs.
+    """
+    record = manifest['inputs'].get(os.path.abspath(input_path))
+    if record is None or record['options'] != options:
+        return False
+    if not all(os.path.exists(os.path.join(output_dir, output)) for output in record['outputs']):
+        return False
+    identity = file_identity(input_path)
+    if identity['size'] != record['size']:
+        return False
+    if identity['mtime_ns'] == record['mtime_ns']:
+        return True
+    if checksum and record.get('sha1') == file_sha1(input_path):
+        record['mtime_ns'] = identity['mtime_ns']
+        return True
+    return False
+
+
+def record_conversion(manifest, input_path, output_dir, outputs, options, checksum=False):
+    """
+    Records a finished conversion and saves the manifest right away, so an interrupted run resumes after it
+    """
+    manifest['inputs'][os.path.abspath(input_path)] = dict(file_identity(input_path, checksum=checksum),
+                                                           options=options, outputs=outputs)
+    save_manifest(output_dir, manifest)
+
+
+def pending_conversions(data_path, output_dir, options, outputs, force=False, checksum=False):
+    """
+    Lists the .mat inputs of data_path and the ones that still need converting into output_dir [see up_to_date()],
+    and removes the outputs of those left half written by an interrupted run. Partial outputs of other inputs are
+    left alone, as another conversion into output_dir may still be writing them.
+    :param outputs: function returning the output filenames of an input [see spikes_outputs(), struct_outputs()]
+    :param force: convert every input, even the up to date ones
+    :return: manifest of output_dir, all inputs, inputs to convert
+    """
+    manifest = load_manifest(output_dir)
+    recorded_mtimes = {path: record['mtime_ns'] for path, record in manifest['inputs'].items()}
+    inputs = [os.path.join(data_path, file) for file in sorted(os.listdir(data_path)) if is_trial_file(file)]
+    pending = [file for file in inputs if force or not up_to_date(manifest, file, output_dir, options, checksum)]
+    if any(manifest['inputs'][path]['mtime_ns'] != mtime_ns for path, mtime_ns in recorded_mtimes.items()):
+        save_manifest(output_dir, manifest)  # mtimes refreshed by up_to_date()
+
+    for file in pending:
+        for output in outputs(file):
+            partial_path = os.path.join(output_dir, output + PARTIAL_SUFFIX)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+    return manifest, inputs, pending
+
+
+def spikes_options(sensor, save_path, flat=False):
+    """
+    Makes sure save_path has its afferent population (POPULATION_FILE, built by matlab/TouchSimPopulation.m on the
+    first conversion into save_path and loaded by every later one, on any engine) and returns the options of a
+    spikes conversion into save_path. They include the population's SHA-1, so files of the manifest converted with
+    another population are converted again.
+    """
+    sensor.eng.TouchSimPopulation(save_path, nargout=0)
+    return {'stage': 'spikes', 'format': 'flat' if flat else 'object',
+            'population': file_sha1(os.path.join(save_path, POPULATION_FILE))}
+
+
+def spikes_outputs(input_path):
+    """
+    Output filenames of matlab/MuJoCoFileToSpikes.m for an input
+    """
+    return ['spikes_ftsn_' + os.path.splitext(os.path.basename(input_path))[0] + '.mat']
+
+
+def struct_outputs(input_path):
+    """
+    Output filenames of matlab/MuJoCoFileToStruct.m for an input
+    """
+    return [os.path.basename(input_path)]
+
 
 class MujoCoSense:
 
-    def __init__(self, showpaths=False, showroot=False):
-        print('MATLAB engine starting.')
-        self.eng = matlab.engine.start_matlab()
-        print('Engine started.')
-        print('Importing paths. This may take a few minutes.')
+    def __init__(self, showpaths=False, showroot=False, engine=None, connect=False, background=False):
+        """
+
+        Parameters
+        ----------
+        showpaths - print every MATLAB path entry while setting up paths
+        showroot - print the MATLAB root while setting up paths
+        engine - an already started MATLAB engine (or any object with the same methods) to use instead of starting one
+        connect - attach to a shared MATLAB session (run matlab.engine.shareEngine in MATLAB) instead of starting a
+                  new one; True for the first shared session found, or the session name
+        background - start (or connect to) MATLAB without blocking. The engine is awaited, and its paths set up, the
+                     first time self.eng is used; ready() tells whether it has started
+
+        """
+        self.showpaths = showpaths
+        self.showroot = showroot
+        self._eng = engine
+        self._engine_future = None
+        if engine is None:
+            if connect:
+                print('Connecting to shared MATLAB session.')
+                names = (connect,) if isinstance(connect, str) else ()
+                started = matlab_engine().connect_matlab(*names, background=background)
+            else:
+                print('MATLAB engine starting.')
+                started = matlab_engine().start_matlab(background=background)
+            if background:
+                self._engine_future = started
+                return
+            self._eng = started
+            print('Engine started.')
+        self.setup_paths()
+
+    @property
+    def eng(self):
+        if self._eng is None:
+            self._eng = self._engine_future.result()
+            self._engine_future = None
+            print('Engine started.')
+            self.setup_paths()
+        return self._eng
+
+    def ready(self):
+        """
+        Returns True once the MATLAB engine has started, without waiting for it
+        """
+        return self._eng is not None or self._engine_future.done()
 
-        matlabroot = self.eng.matlabroot()
-        matlabpath = self.eng.matlabpath().split(';')
+    def setup_paths(self):
+        """
+        Adds the MATLAB path in a single addpath call and calls setup_path, unless this MATLAB session (e.g. a shared
+        session used before) has already been set up
+        """
+        if self.eng.isappdata(0., PATHS_CONFIGURED):
+            print('MATLAB paths already configured.')
+            return
 
-        if showroot:
-            print(f'MATLAB root: {matlabroot}')
+        print('Importing paths.')
+        if self.showroot:
+            print(f'MATLAB root: {self.eng.matlabroot()}')
 
-        for path in matlabpath:
-            if showpaths:
+        matlabpath = self.eng.matlabpath()
+        if self.showpaths:
+            for path in matlabpath.split(os.pathsep):
                 print(f'Adding path: {path}')
-            self.eng.addpath(path)
+        self.eng.addpath(matlabpath, nargout=0)
 
         print('Calling setup_path.')
         self.eng.setup_path(nargout=0)
+        self.eng.setappdata(0., PATHS_CONFIGURED, True, nargout=0)
         print('All paths imported.')
 
-    def haptix_sense(self, spikes_save_path, target_sampling_frequency=1e3, step_count=1e3, trial_count=10):
+    def haptix_sense(self, spikes_save_path, target_sampling_frequency=1e3, step_count=1e3, trial_count=10,
+                     first_trial=1):
         """
 
         Parameters
@@ -53,6 +256,7 @@ class MujoCoSense:
         target_sampling_frequency - desired sampling frequency. Actual will vary depending on cpu speeds. use <= 1e3
         step_count - how many steps (wrist movement increments) to complete the trial in
         trial_count - how many trials (i.e. files) to generate
+        first_trial - number of the first trial, used in the saved filenames
 
         Returns None
         -------
@@ -61,17 +265,27 @@ class MujoCoSense:
         if not os.path.exists(spikes_save_path):
             os.makedirs(spikes_save_path)
         print(f'Calling MuJoCoSense for haptic sensing. Performing {trial_count} trial(s).')
-        self.eng.MuJoCoSense(spikes_save_path, target_sampling_frequency, step_count, trial_count, nargout=0)
+        self.eng.MuJoCoSense(spikes_save_path, target_sampling_frequency, step_count, trial_count, first_trial,
+                             nargout=0)
         print('Finished haptic sensing.')
         print(f'Saved to {spikes_save_path}')
 
-    def MuJoCoToSpikes(self, data_path, save_path):
+    def MuJoCoToSpikes(self, data_path, save_path, flat=False, force=False, checksum=False):
         """
 
         Parameters
         ----------
         data_path - directory to load data from
         save_path - directory to save data to for neural spike train analysis
+        flat - save the flat export format (matlab/TouchSimToFlat.m), which the Python loaders read directly, so
+               MuJoCoSpikesToStruct does not need to be run on save_path
+        force - convert every file, even those the manifest of save_path lists as up to date
+        checksum - also record SHA-1s, so inputs whose mtime changed but content did not are not converted again
+
+        Files are converted one at a time (matlab/MuJoCoFileToSpikes.m), all with the afferent population of
+        save_path [see spikes_options()], and recorded in the manifest of save_path as they finish
+        [see pending_conversions()], so a re-run only converts new or changed files and an interrupted run resumes
+        where it stopped.
 
         Returns None
         -------
@@ -90,18 +304,28 @@ class MujoCoSense:
         if not os.path.exists(save_path):
             os.makedirs(save_path)
 
-        print('Converting indentation depths to neural spikes.')
-        self.eng.MuJoCoToSpikes(data_path, save_path, nargout=0)
+        options = spikes_options(self, save_path, flat=flat)
+        manifest, inputs, pending = pending_conversions(data_path, save_path, options, spikes_outputs, force=force,
+                                                        checksum=checksum)
+        print(f'Converting indentation depths to neural spikes ({len(pending)} of {len(inputs)} file(s) to convert).')
+        for file in pending:
+            self.eng.MuJoCoFileToSpikes(file, save_path, options['format'], nargout=0)
+            record_conversion(manifest, file, save_path, spikes_outputs(file), options, checksum=checksum)
         print('Finished converting forces.')
         print(f'Saved to {save_path}')
 
-    def MuJoCoSpikesToStruct(self, data_dir, processed_dir):
+    def MuJoCoSpikesToStruct(self, data_dir, processed_dir, force=False, checksum=False):
         """
 
         Parameters
         ----------
         data_dir - directory to load data from
         processed_dir - directory to save preprocessed data for Python analysis
+        force - convert every file, even those the manifest of processed_dir lists as up to date
+        checksum - also record SHA-1s [see MuJoCoToSpikes()]
+
+        Files are converted one at a time (matlab/MuJoCoFileToStruct.m) and skipped when up to date
+        [see MuJoCoToSpikes()].
 
         Returns
         -------
@@ -120,11 +344,241 @@ class MujoCoSense:
         if not os.path.exists(processed_dir):
             os.makedirs(processed_dir)
 
-        print('Beginning pre-processing for spike train analysis.')
-        self.eng.MuJoCoSpikesToStruct(data_dir, processed_dir, nargout=0)
+        options = {'stage': 'struct'}
+        manifest, inputs, pending = pending_conversions(data_dir, processed_dir, options, struct_outputs, force=force,
+                                                        checksum=checksum)
+        print(f'Beginning pre-processing for spike train analysis ({len(pending)} of {len(inputs)} file(s) to convert).')
+        for file in pending:
+            self.eng.MuJoCoFileToStruct(file, processed_dir, nargout=0)
+            record_conversion(manifest, file, processed_dir, struct_outputs(file), options, checksum=checksum)
         print('Finished pre-processing.')
         print(f'Saved to {processed_dir}')
 
+    def HaptixPipeline(self, depths_path, spikes_path, struct_path=None, target_sampling_frequency=1e3,
+                       step_count=1e3, trial_count=10, flat=False, spikes_sensor=None, struct_sensor=None,
+                       analyze=None, queue_size=4):
+        """
+        Pipelined haptix_sense -> MuJoCoToSpikes -> MuJoCoSpikesToStruct -> analysis. Trials are sensed one at a
+        time on this engine, and every file moves on to the next stage as soon as it is written: trial k is
+        converted to spikes while trial k+1 is being sensed, and analysed as soon as its struct file lands. Each
+        conversion stage runs in its own thread on its own MATLAB engine, fed through a bounded queue (a stage that
+        falls queue_size files behind holds up the previous one), so the whole run takes about as long as its
+        slowest stage. Conversions are recorded in the output manifests [see MuJoCoToSpikes()].
+
+        Parameters
+        ----------
+        depths_path - save location for sensor data [see haptix_sense()]
+        spikes_path - save location for the neural spikes
+        struct_path - save location of the preprocessed data (not used with flat)
+        target_sampling_frequency, step_count, trial_count - see haptix_sense()
+        flat - save spikes in the flat export format, which needs no struct stage [see MuJoCoToSpikes()]
+        spikes_sensor, struct_sensor - MujoCoSense whose engines run the conversions; started in the background
+                                       when not given
+        analyze - called as analyze(directory, file) on every analysable file as it lands, in its own thread;
+                  defaults to spiketrainanalysis.load_isi_stats
+
+        Returns dictionary with the files produced by each stage (depths, spikes, struct), the analysis result
+        of every file and the failed files (file -> error message)
+        -------
+
+        """
+        if analyze is None:
+            from spiketrainanalysis import load_isi_stats as analyze
+        for path in (depths_path, spikes_path) + (() if flat else (struct_path,)):
+            if not os.path.exists(path):
+                os.makedirs(path)
+        if spikes_sensor is None:
+            spikes_sensor = MujoCoSense(showpaths=self.showpaths, showroot=self.showroot, background=True)
+        if struct_sensor is None and not flat:
+            struct_sensor = MujoCoSense(showpaths=self.showpaths, showroot=self.showroot, background=True)
+
+        results = {'depths': [], 'spikes': [], 'struct': [], 'analysis': {}, 'failed': {}}
+        options = {}  # spikes conversion options, set on the first file [see spikes_options()]
+        spikes_manifest = load_manifest(spikes_path)
+        struct_manifest = None if flat else load_manifest(struct_path)
+
+        def to_spikes(file):
+            if not options:
+                options.update(spikes_options(spikes_sensor, spikes_path, flat=flat))
+            spikes_sensor.eng.MuJoCoFileToSpikes(file, spikes_path, options['format'], nargout=0)
+            record_conversion(spikes_manifest, file, spikes_path, spikes_outputs(file), options)
+            results['spikes'].append(os.path.join(spikes_path, spikes_outputs(file)[0]))
+            return results['spikes'][-1]
+
+        def to_struct(file):
+            struct_sensor.eng.MuJoCoFileToStruct(file, struct_path, nargout=0)
+            record_conversion(struct_manifest, file, struct_path, struct_outputs(file), {'stage': 'struct'})
+            results['struct'].append(os.path.join(struct_path, os.path.basename(file)))
+            return results['struct'][-1]
+
+        def analysis(file):
+            results['analysis'][file] = analyze(os.path.dirname(file) + '/', os.path.basename(file))
+
+        stages = [('spikes', to_spikes)] + ([] if flat else [('struct', to_struct)]) + [('analysis', analysis)]
+        queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [None]
+        threads = [threading.Thread(target=pipeline_stage, args=(name, work, queues[stage_no], queues[stage_no + 1],
+                                                                 results['failed']), daemon=True)
+                   for stage_no, (name, work) in enumerate(stages)]
+        for thread in threads:
+            thread.start()
+
+        print(f'Sensing {trial_count} trial(s), converting and analysing each one as it is saved.')
+        try:
+            for trial in range(1, int(trial_count) + 1):
+                try:
+                    #  MuJoCoSense.m returns the names it saved, which may overwrite files of an earlier run
+                    saved_files = self.eng.MuJoCoSense(depths_path, target_sampling_frequency, step_count, 1, trial,
+                                                       nargout=1)
+                except Exception as err:
+                    print(f'Sensing trial {trial} failed ({err}).')
+                    results['failed'][f'trial {trial}'] = f'sense: {err}'
+                    continue
+                for file in saved_files:
+                    results['depths'].append(file)
+                    queues[0].put(file)
+        finally:
+            queues[0].put(PIPELINE_END)
+            for thread in threads:
+                thread.join()
+
+        print('Finished pipeline.')
+        return results
+
+
+def pipeline_stage(name, work, inbox, outbox, failed):
+    """
+    Runs one stage of MujoCoSense.HaptixPipeline(): work(file) for every file taken from inbox, until PIPELINE_END,
+    handing each result to outbox. A file whose work raises is recorded in failed and goes no further.
+    """
+    while True:
+        file = inbox.get()
+        if file is PIPELINE_END:
+            break
+        try:
+            result = work(file)
+        except Exception as err:
+            print(f'{name} stage failed on {file} ({err}).')
+            failed[file] = f'{name}: {err}'
+            continue
+        if outbox is not None:
+            outbox.put(result)
+    if outbox is not None:
+        outbox.put(PIPELINE_END)
+
+
+def start_engines(count, showpaths=False, showroot=False, connect=False):
+    """
+    Starts count MATLAB engines at once, in the background [see MujoCoSense(background=True)]
+    :return: list of MujoCoSense, one per engine
+    """
+    return [MujoCoSense(showpaths=showpaths, showroot=showroot, connect=connect, background=True)
+            for _ in range(count)]
+
+
+def MuJoCoToSpikesParallel(sensors, data_path, save_path, flat=False, retries=1, progress=None, poll_interval=0.1,
+                           force=False, checksum=False):
+    """
+    Converts the HAPTIX files of data_path to neural spikes [see MujoCoSense.MuJoCoToSpikes()] on several MATLAB
+    engines at once. Each engine converts one file at a time (matlab/MuJoCoFileToSpikes.m, run with
+    background=True). The afferent population of save_path is built (or loaded) on the first engine to start,
+    before any file is given out, and every engine loads that same population [see spikes_options()]. Engines
+    still starting are given files as soon as they are ready; an engine that fails to start is dropped
+    (RuntimeError only if none of them starts). A file whose conversion fails is queued again, up to retries more
+    times, for any engine. Up to date files are skipped and finished ones recorded, as in
+    MujoCoSense.MuJoCoToSpikes().
+
+    Parameters
+    ----------
+    sensors - list of MujoCoSense (e.g. from start_engines(), or wrapping stand-in engines)
+    data_path - directory to load data from
+    save_path - directory to save data to for neural spike train analysis
+    flat - save the flat export format [see MujoCoSense.MuJoCoToSpikes()]
+    retries - how many times a failed file is tried again
+    progress - called as progress(finished, total, file, error) after every file (error is None on success)
+    poll_interval - seconds to wait between checks of the running conversions
+    force - convert every file, even the up to date ones
+    checksum - also record SHA-1s [see MujoCoSense.MuJoCoToSpikes()]
+
+    Returns dictionary with the converted files and the failed ones (file -> last error message)
+    -------
+
+    """
+    if not os.path.exists(data_path):
+        raise FileNotFoundError(
+            errno.ENOENT, os.strerror(errno.ENOENT), data_path)
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+
+    if not any(is_trial_file(file) for file in os.listdir(data_path)):
+        print(f"Directory is empty: {data_path}.")
+        return {'converted': [], 'failed': {}}
+
+    dropped = set()  # indices of the sensors whose engine could not be started
+    options = None
+    for sensor_no, sensor in enumerate(sensors):
+        try:
+            sensor.eng  # waits for the engine to start
+        except Exception as err:
+            logger.error('MATLAB engine %d could not be started (%s); continuing without it.', sensor_no, err)
+            dropped.add(sensor_no)
+            continue
+        options = spikes_options(sensor, save_path, flat=flat)  # before any engine loads the population
+        break
+    if options is None:
+        raise RuntimeError(f'None of the {len(sensors)} MATLAB engine(s) could be started.')
+    manifest, inputs, pending = pending_conversions(data_path, save_path, options, spikes_outputs, force=force,
+                                                    checksum=checksum)
+
+    files = deque((file, 0) for file in pending)
+    total = len(files)
+    running = {}  # sensor index -> (future, file, attempt)
+    converted, failed = [], {}
+    print(f'Converting {total} of {len(inputs)} file(s) to neural spikes on {len(sensors)} engine(s).')
+    while files or running:
+        for sensor_no, sensor in enumerate(sensors):
+            if files and sensor_no not in running and sensor_no not in dropped and sensor.ready():
+                file, attempt = files.popleft()
+                try:
+                    future = sensor.eng.MuJoCoFileToSpikes(file, save_path, options['format'], nargout=0,
+                                                           background=True)
+                except Exception as err:
+                    logger.error('MATLAB engine %d could not be started (%s); continuing without it.', sensor_no, err)
+                    dropped.add(sensor_no)
+                    files.appendleft((file, attempt))
+                    continue
+                running[sensor_no] = (future, file, attempt)
+        if len(dropped) == len(sensors):  # nothing is running then
+            raise RuntimeError(f'None of the {len(sensors)} MATLAB engine(s) could be started.')
+
+        finished = [sensor_no for sensor_no, (future, _, _) in running.items() if future.done()]
+        if not finished:
+            time.sleep(poll_interval)
+            continue
+
+        for sensor_no in finished:
+            future, file, attempt = running.pop(sensor_no)
+            try:
+                future.result()
+                error = None
+            except Exception as err:
+                error = str(err)
+
+            if error is None:
+                converted.append(file)
+                record_conversion(manifest, file, save_path, spikes_outputs(file), options, checksum=checksum)
+            elif attempt < retries:
+                print(f'Conversion of {file} failed ({error}), retrying.')
+                files.append((file, attempt + 1))
+                continue
+            else:
+                failed[file] = error
+            print(f'[{len(converted) + len(failed)}/{total}] {"converted" if error is None else "failed"} {file}')
+            if progress is not None:
+                progress(len(converted) + len(failed), total, file, error)
+
+    print('Finished converting forces.')
+    print(f'Saved to {save_path}')
+    return {'converted': converted, 'failed': failed}
 
 
 # TODO: Document somewhere that one must install the matlab API for python
@@ -134,9 +588,3 @@ class MujoCoSense:
 # https://www.mathworks.com/matlabcentral/answers/166188-can-i-call-my-own-custom-matlab-functions-from-python-r2014b
 # https://www.mathworks.com/matlabcentral/answers/202901-problem-of-call-user-script-from-python
 # https://www.mathworks.com/matlabcentral/answers/93627-why-do-i-receive-license-manager-error-16
-
-
-
-
-
-
@@ -0,0 +1,160 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+from TouchSimMat2Python_Loader import AFFERENT_TYPES
+
+#  Fields of the legacy afferent_stats[afferent_type] dictionaries [see spiketrainanalysis.calculate_afferet_isi_stats()]
+AFFERENT_STATS_FIELDS = ('id_range', 'isi', 'fire_count', 'spike_deltas', 'neuron_count', 'locations')
+
+
+class NeuronTable(Mapping):
+    """
+    Struct-of-arrays ISI statistics of one sensor's afferent population, one entry per neuron ID:
+        afferent_class - int8 code, an index into AFFERENT_TYPES (-1 for none)
+        locations      - float32 n x 2 coordinates
+        depths         - float32 depth (nan if unknown)
+        fire_count     - number of spikes
+        isi            - mean ISI (0 for neurons that fired less than twice)
+        delta_offsets  - neuron i's ISIs are spike_deltas[delta_offsets[i]:delta_offsets[i+1]] (one shared buffer)
+    Lookups by neuron ID (afferent_type(), spike_deltas_of(), spiked()) are O(1) and masks() selects by type.
+    For existing callers the table also reads like the legacy afferent_stats nested dictionary, e.g.
+    table['sa']['spike_deltas'][i] or table['ra']['isi']; those views are only built when first accessed.
+    """
+
+    def __init__(self, afferent_class, locations, fire_count, isi, spike_deltas, delta_offsets, depths=None):
+        self.afferent_class = np.asarray(afferent_class, dtype=np.int8)
+        self.locations = np.asarray(locations, dtype=np.float32).reshape(-1, 2)
+        self.depths = np.full(self.afferent_class.shape[0], np.nan, dtype=np.float32) if depths is None else \
+            np.asarray(depths, dtype=np.float32)
+        self.fire_count = np.asarray(fire_count)
+        self.isi = np.asarray(isi)
+        self.spike_deltas = np.asarray(spike_deltas)
+        self.delta_offsets = np.asarray(delta_offsets)
+        self._views = {}
+
+    @classmethod
+    def from_batch(cls, batch, depths=None):
+        """
+        Table of an ISI batch [see spiketrainanalysis.calculate_isi_batch()]; the batch's arrays are shared, not copied
+        """
+        return cls(batch['afferent_class'], batch['locations'], batch['fire_count'], batch['isi'],
+                   batch['spike_deltas'], batch['delta_offsets'], depths=depths)
+
+    @property
+    def neuron_count(self):
+        return self.afferent_class.shape[0]
+
+    def afferent_type(self, neuron_id):
+        """
+        'sa', 'ra' or 'pc' for a neuron ID, None if the neuron is none of these
+        """
+        code = self.afferent_class[neuron_id]
+        return AFFERENT_TYPES[code] if code >= 0 else None
+
+    def mask(self, afferent_type):
+        """
+        Boolean mask over the neuron IDs of afferent_type
+        """
+        return self.afferent_class == AFFERENT_TYPES.index(afferent_type)
+
+    def ids(self, afferent_type):
+        return np.flatnonzero(self.mask(afferent_type))
+
+    def spike_deltas_of(self, neuron_id):
+        """
+        ISIs of one neuron (a view into the shared buffer)
+        """
+        return self.spike_deltas[self.delta_offsets[neuron_id]:self.delta_offsets[neuron_id + 1]]
+
+    def spiked(self, neuron_id=None):
+        """
+        Whether a neuron had at least one ISI, or a boolean array over all neurons if neuron_id is None
+        """
+        if neuron_id is None:
+            return np.diff(self.delta_offsets) > 0
+        return bool(self.delta_offsets[neuron_id + 1] > self.delta_offsets[neuron_id])
+
+    #  Legacy afferent_stats interface: table[afferent_type][field]
+    def __getitem__(self, afferent_type):
+        if afferent_type not in AFFERENT_TYPES:
+            raise KeyError(afferent_type)
+        if afferent_type not in self._views:
+            self._views[afferent_type] = AfferentStatsView(self, afferent_type)
+        return self._views[afferent_type]
+
+    def __iter__(self):
+        return iter(AFFERENT_TYPES)
+
+    def __len__(self):
+        return len(AFFERENT_TYPES)
+
+
+class AfferentStatsView(Mapping):
+    """
+    afferent_stats[afferent_type] dictionary of a NeuronTable, each field built on first access:
+        id_range     - list of the type's neuron IDs
+        isi          - {neuron_id: mean ISI}
+        fire_count   - {neuron_id: firing count}
+        spike_deltas - list over all neuron IDs of the type's ISI arrays (0 for neurons of other types)
+        neuron_count - number of neurons of the type
+        locations    - n x 2 array of the type's coordinates (0 for neurons of other types)
+    """
+
+    def __init__(self, table, afferent_type):
+        self._table = table
+        self._afferent_type = afferent_type
+        self._fields = {}
+
+    def __getitem__(self, field):
+        if field not in self._fields:
+            self._fields[field] = self._build(field)
+        return self._fields[field]
+
+    def __iter__(self):
+        return iter(AFFERENT_STATS_FIELDS)
+
+    def __len__(self):
+        return len(AFFERENT_STATS_FIELDS)
+
+    def _build(self, field):
+        table = self._table
+        mask = table.mask(self._afferent_type)
+        id_range = np.flatnonzero(mask).tolist()
+        if field == 'id_range':
+            return id_range
+        if field == 'isi':
+            isi = table.isi.tolist()
+            return {i: isi[i] for i in id_range}
+        if field == 'fire_count':
+            fire_count = table.fire_count.tolist()
+            return {i: fire_count[i] for i in id_range}
+        if field == 'spike_deltas':
+            spike_deltas = [0] * table.neuron_count
+            for i in id_range:
+                spike_deltas[i] = table.spike_deltas_of(i)
+            return spike_deltas
+        if field == 'neuron_count':
+            return len(id_range)
+        if field == 'locations':
+            locations = np.zeros((table.neuron_count, 2))
+            locations[mask] = table.locations[mask]
+            return locations
+        raise KeyError(field)
@@ -0,0 +1,137 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from trialcatalog import get_trial_catalog
+from histogramaccumulator import histogram_bin_indices
+from spiketrainanalysis import load_sensor_batches, batch_isi_data, kl_divergence_matrix
+from instrumentation import get_logger, stage
+
+logger = get_logger('noisesweep')
+
+SWEEP_FACTORS = ('noise', 'sensor', 'object', 'dim')  # columns of the catalog that define a sweep condition
+SWEEP_METRICS = ('kl', 'mean_isi_difference')
+
+
+def sweep_conditions(table, mask):
+    """
+    Function groups the masked rows of a trial table [see trialcatalog.TrialCatalog] by condition (noise, sensor,
+    object, dim), pooling trial numbers. Conditions are ordered by noise, then sensor, object and dim.
+    :return: dictionary of condition columns (one entry per condition), condition index of each masked row
+    """
+    rows = np.flatnonzero(mask)
+    order = rows[np.lexsort(tuple(table[factor][rows] for factor in reversed(SWEEP_FACTORS)))]
+    condition_ids, row_conditions = {}, np.empty(table['noise'].shape[0], dtype=np.int64)
+    for row in order:
+        key = tuple(None if factor == 'noise' and np.isnan(table[factor][row]) else table[factor][row]
+                    for factor in SWEEP_FACTORS)
+        row_conditions[row] = condition_ids.setdefault(key, len(condition_ids))
+
+    columns = list(zip(*condition_ids)) if condition_ids else [()] * len(SWEEP_FACTORS)
+    conditions = {factor: np.array([np.nan if value is None else value for value in column], dtype=table[factor].dtype)
+                  for factor, column in zip(SWEEP_FACTORS, columns)}
+    return conditions, row_conditions[rows]
+
+
+def sweep_histograms(batches, trial_conditions, condition_count, n_bins=30, neuron_id=None, afferent_type=None):
+    """
+    Function histograms the ISIs of every condition on one set of bin edges shared by all conditions
+    :param batches:          ISI batch of every trial [see spiketrainanalysis.calculate_isi_batch()]
+    :param trial_conditions: condition index of every trial
+    :param n_bins:           number of bins spanning all the selected ISIs, or an array of bin edges
+    :return: conditions x bins counts, ISI count, ISI sum of every condition, bin edges
+    """
+    trial_data = [batch_isi_data(batch, neuron_id=neuron_id, afferent_type=afferent_type) for batch in batches]
+    if np.ndim(n_bins) == 0:
+        spiked = [data for data in trial_data if data.shape[0] > 0]
+        data_range = (min(data.min() for data in spiked), max(data.max() for data in spiked)) if spiked else (0, 1)
+        bin_edges = np.histogram_bin_edges(np.array(data_range, dtype=float), bins=int(n_bins))
+    else:
+        bin_edges = np.asarray(n_bins, dtype=float)
+    bin_count = bin_edges.shape[0] - 1
+
+    counts = np.zeros(condition_count * bin_count, dtype=np.int64)
+    isi_counts, isi_sums = np.zeros(condition_count, dtype=np.int64), np.zeros(condition_count)
+    for condition, data in zip(trial_conditions, trial_data):
+        with stage('histogram', spikes=data.shape[0]):
+            bins = histogram_bin_indices(data, bin_edges)
+            counts += np.bincount(condition * bin_count + bins[bins >= 0], minlength=counts.shape[0])
+        isi_counts[condition] += data.shape[0]
+        isi_sums[condition] += data.sum()
+    return counts.reshape(condition_count, bin_count), isi_counts, isi_sums, bin_edges
+
+
+def pairwise_table(conditions, metrics):
+    """
+    Function lays out symmetric condition x condition metric matrices as a columnar table with one row per
+    (condition A, condition B, metric), A before B in condition order
+    :param metrics: dictionary of metric name -> conditions x conditions matrix
+    """
+    first, second = np.triu_indices(len(conditions[SWEEP_FACTORS[0]]), 1)
+    table = {}
+    for suffix, rows in (('_a', first), ('_b', second)):
+        for factor in SWEEP_FACTORS:
+            table[factor + suffix] = np.tile(conditions[factor][rows], len(metrics))
+    table['metric'] = np.repeat(np.array(list(metrics), dtype=str), first.shape[0])
+    table['value'] = np.concatenate([np.zeros(0)] + [matrix[first, second] for matrix in metrics.values()])
+    return table
+
+
+def noise_sweep_grid(data_dir, noise=None, sensor=None, obj=None, dim=None, n_bins=30, neuron_id=None,
+                     afferent_type=None, trq_sensor_no=0, workers=None, executor=None):
+    """
+    Function compares every pair of conditions of a sweep grid in one pass. The trials below data_dir matching the
+    grid [see trialcatalog.select_trials(); each of noise, sensor, obj, dim is a value, a list, or None for any]
+    are grouped into conditions, loaded once (in parallel with workers/executor), and the ISIs of each condition
+    are histogrammed on shared bin edges.
+    Metrics of each pair of conditions:
+        kl                  - symmetric KL divergence of the ISI distributions [see spiketrainanalysis.kl_divergence()]
+        mean_isi_difference - absolute difference of the mean ISIs (sec)
+    :return: pair table (dictionary of columns noise_a, sensor_a, object_a, dim_a, noise_b, ..., metric, value),
+             condition table (columns noise, sensor, object, dim, trial_count, isi_count, mean_isi and the
+             conditions x bins probability heights), bin edges;
+             None if no trials match
+    """
+    catalog = get_trial_catalog(data_dir)
+    mask = catalog.select(noise=noise, sensor=sensor, obj=obj, dim=dim)
+    if not mask.any():
+        logger.error('No trials match the sweep grid. Returning None.')
+        return None
+
+    conditions, trial_conditions = sweep_conditions(catalog.table, mask)
+    condition_count = len(conditions['noise'])
+    trial_files = catalog.trial_files()  # built on every call, so only once here
+    trial_paths = [trial_files[row] for row in np.flatnonzero(mask)]
+    sensor_batches, = load_sensor_batches([trial_paths], trq_sensor_no=trq_sensor_no, workers=workers,
+                                          executor=executor)
+
+    counts, isi_counts, isi_sums, bin_edges = sweep_histograms([batch for batch, _ in sensor_batches],
+                                                               trial_conditions, condition_count, n_bins=n_bins,
+                                                               neuron_id=neuron_id, afferent_type=afferent_type)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        heights = counts / counts.sum(axis=1, keepdims=True)
+        mean_isi = isi_sums / isi_counts
+    if np.any(isi_counts == 0):
+        logger.warning('Some conditions have no ISIs; their metrics are NaN.')
+
+    metrics = {'kl': kl_divergence_matrix(heights),
+               'mean_isi_difference': np.abs(mean_isi[:, None] - mean_isi[None, :])}
+    conditions.update(trial_count=np.bincount(trial_conditions, minlength=condition_count), isi_count=isi_counts,
+                      mean_isi=mean_isi, heights=heights)
+    return pairwise_table(conditions, metrics), conditions, bin_edges
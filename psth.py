@@ -0,0 +1,203 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from TouchSimMat2Python_Loader import AFFERENT_TYPES, TIMESTAMP_RATE
+from spiketrainanalysis import find_trial_files, map_trials
+from spikedistance import load_trial_spike_trains
+from instrumentation import stage
+
+MAX_CHUNK_VALUES = 1 << 22  # counts (trials x neurons x bins) held at once while aggregating
+
+
+class SpikeCounts:
+    """
+    Cumulative spike counts of every (trial, neuron) of an afferent population, built once from the sparse spike
+    times. Every spike is stored as a complex key row + 1j * spike_time in one sorted array (row = trial *
+    neuron_count + neuron; numpy orders complex numbers by real, then imaginary part), so the number of spikes of a
+    row before time t is a binary search, and the counts of any bin width or window (1 ms to 1 s) are O(bins)
+    lookups with no raster.
+    Bins are half-open, [edge_i, edge_i+1). Cumulative sums of the within-row ISIs give the ISI statistics of any
+    window from the same lookups.
+        trial_count, neuron_count - shape of the population
+        afferent_class            - int8 code of each neuron, an index into AFFERENT_TYPES (-1 for none)
+        duration                  - longest trial duration, n_timestamps / TIMESTAMP_RATE (sec); for trials without
+                                    n_timestamps, one timestamp past their last spike
+    """
+
+    def __init__(self, trials):
+        """
+        :param trials: list of spike train dictionaries of the same population [see spikedistance.load_trial_spike_trains()]
+        """
+        self.trial_count = len(trials)
+        self.afferent_class = np.asarray(trials[0]['afferent_class'], dtype=np.int8)
+        self.neuron_count = self.afferent_class.shape[0]
+        for trial in trials:
+            if len(trial['spike_offsets']) != self.neuron_count + 1:
+                raise ValueError('every trial must have the same afferent population')
+
+        times = [np.asarray(trial['spike_times'], dtype=float) for trial in trials]
+        #  Bins are half-open, so the default window must end after the last spike rather than on it
+        self.duration = max([trial['n_timestamps'] / TIMESTAMP_RATE for trial in trials if 'n_timestamps' in trial] +
+                            [float(trial_times.max()) + 1 / TIMESTAMP_RATE
+                             for trial, trial_times in zip(trials, times)
+                             if 'n_timestamps' not in trial and trial_times.shape[0]], default=0.0)
+        rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            trial_no * self.neuron_count + np.repeat(np.arange(self.neuron_count), np.diff(trial['spike_offsets']))
+            for trial_no, trial in enumerate(trials)])
+        self.keys = np.sort(rows + 1j * np.concatenate([np.zeros(0)] + times))
+
+        #  Cumulative sums of the ISIs (0 across row boundaries), so the ISIs between positions p and q of a row
+        #  sum to isi_sums[q - 1] - isi_sums[p] (one extra entry for positions past the last spike)
+        deltas = np.diff(self.keys.imag)
+        deltas[np.diff(self.keys.real) != 0] = 0
+        self.isi_sums = np.concatenate(([0.0], np.cumsum(deltas), [0.0]))
+        self.isi_square_sums = np.concatenate(([0.0], np.cumsum(deltas ** 2), [0.0]))
+        self.isi_sums[-1], self.isi_square_sums[-1] = self.isi_sums[-2], self.isi_square_sums[-2]
+
+    def neurons(self, neuron_id=None, afferent_type=None):
+        """
+        Neuron IDs selected by neuron_id (an ID or a list of IDs), afferent_type, or every afferent when both are None
+        """
+        if neuron_id is not None:
+            return np.atleast_1d(neuron_id)
+        if afferent_type is not None:
+            return np.flatnonzero(self.afferent_class == AFFERENT_TYPES.index(afferent_type))
+        return np.flatnonzero(self.afferent_class >= 0)
+
+    def bin_edges(self, bin_width, window=None):
+        """
+        Edges of bin_width (sec) bins covering window (start, stop), by default the whole trial duration
+        """
+        start, stop = window if window is not None else (0.0, self.duration)
+        bin_count = max(int(np.ceil((stop - start) / bin_width - 1e-9)), 1)
+        return start + np.arange(bin_count + 1) * bin_width
+
+    def positions(self, trials, neurons, edges):
+        """
+        Index into keys of the first spike at or after each edge, for every (trial, neuron) row
+        :return: trials x neurons x edges int array
+        """
+        rows = np.asarray(trials)[:, None] * self.neuron_count + np.asarray(neurons)[None, :]
+        queries = rows[:, :, None] + 1j * np.asarray(edges, dtype=float)[None, None, :]
+        with stage('histogram', spikes=queries.size):
+            return np.searchsorted(self.keys, queries, side='left')
+
+    def trial_chunks(self, trials, neurons, edges):
+        trials = np.arange(self.trial_count) if trials is None else np.atleast_1d(trials)
+        chunk = max(MAX_CHUNK_VALUES // max(len(neurons) * len(edges), 1), 1)
+        for chunk_start in range(0, trials.shape[0], chunk):
+            yield self.positions(trials[chunk_start:chunk_start + chunk], neurons, edges)
+
+    def selection(self, bin_width, window, edges, neuron_id, afferent_type):
+        if edges is None:
+            edges = self.bin_edges(bin_width, window)
+        return np.asarray(edges, dtype=float), self.neurons(neuron_id=neuron_id, afferent_type=afferent_type)
+
+    def counts(self, bin_width=None, window=None, edges=None, neuron_id=None, afferent_type=None, trials=None):
+        """
+        Spike counts of every selected trial and neuron in every bin
+        :param bin_width:  bin width (sec), used with window when edges is None
+        :param window:     (start, stop) in sec, by default the whole trial duration
+        :param edges:      explicit bin edges (sec), overriding bin_width/window
+        :param trials:     trial indices (default all)
+        :return: trials x neurons x bins count array, bin edges
+        """
+        edges, neurons = self.selection(bin_width, window, edges, neuron_id, afferent_type)
+        return np.concatenate([np.diff(positions, axis=2) for positions in self.trial_chunks(trials, neurons, edges)]
+                              ), edges
+
+    def count_moments(self, edges, neurons, trials):
+        """
+        Sum over trials of the counts and of the squared counts, neurons x bins each, and the number of trials
+        """
+        total, square_total, trial_count = 0, 0, 0
+        for positions in self.trial_chunks(trials, neurons, edges):
+            bin_counts = np.diff(positions, axis=2).astype(float)
+            total = total + bin_counts.sum(axis=0)
+            square_total = square_total + (bin_counts ** 2).sum(axis=0)
+            trial_count += bin_counts.shape[0]
+        return total, square_total, trial_count
+
+    def psth(self, bin_width=None, window=None, edges=None, neuron_id=None, afferent_type=None, trials=None):
+        """
+        Peri-stimulus time histogram: firing rate (spikes/sec) in every bin, averaged over the selected trials and
+        neurons [see counts() for the parameters]
+        :return: rate per bin, bin edges
+        """
+        edges, neurons = self.selection(bin_width, window, edges, neuron_id, afferent_type)
+        total, _, trial_count = self.count_moments(edges, neurons, trials)
+        if trial_count == 0 or len(neurons) == 0:
+            return np.zeros(len(edges) - 1), edges
+        return total.sum(axis=0) / (trial_count * len(neurons) * np.diff(edges)), edges
+
+    def fano_factor(self, bin_width=None, window=None, edges=None, neuron_id=None, afferent_type=None, trials=None):
+        """
+        Fano factor (variance / mean of the spike count across trials) of every selected neuron in every bin,
+        nan where the neuron never fired in the bin [see counts() for the parameters]
+        :return: neurons x bins Fano factors, bin edges
+        """
+        edges, neurons = self.selection(bin_width, window, edges, neuron_id, afferent_type)
+        total, square_total, trial_count = self.count_moments(edges, neurons, trials)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / trial_count
+            return (square_total / trial_count - mean ** 2) / mean, edges
+
+    def fano_sweep(self, bin_widths, window=None, neuron_id=None, afferent_type=None, trials=None):
+        """
+        Fano factor averaged over the selected neurons and bins (nan entries ignored) for each bin width
+        """
+        return np.array([np.nanmean(self.fano_factor(bin_width=bin_width, window=window, neuron_id=neuron_id,
+                                                     afferent_type=afferent_type, trials=trials)[0])
+                         if len(self.neurons(neuron_id, afferent_type)) else np.nan for bin_width in bin_widths])
+
+    def isi_cv(self, bin_width=None, window=None, edges=None, neuron_id=None, afferent_type=None, trials=None):
+        """
+        Coefficient of variation (std / mean) of the ISIs of every selected neuron in every bin, pooling the ISIs of
+        all selected trials whose two spikes fall in the bin; nan with fewer than two ISIs
+        [see counts() for the parameters]
+        :return: neurons x bins CVs, bin edges
+        """
+        edges, neurons = self.selection(bin_width, window, edges, neuron_id, afferent_type)
+        isi_count, isi_total, isi_square_total = 0, 0, 0
+        for positions in self.trial_chunks(trials, neurons, edges):
+            first, stop = positions[:, :, :-1], positions[:, :, 1:]
+            last = np.maximum(stop - 1, first)  # ISIs first..last-1 lie inside the bin
+            isi_count = isi_count + (last - first).sum(axis=0)
+            isi_total = isi_total + (self.isi_sums[last] - self.isi_sums[first]).sum(axis=0)
+            isi_square_total = isi_square_total + (self.isi_square_sums[last] - self.isi_square_sums[first]).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = isi_total / isi_count
+            variance = np.maximum(isi_square_total / isi_count - mean ** 2, 0)
+            return np.where(isi_count >= 2, np.sqrt(variance) / mean, np.nan), edges
+
+
+def load_spike_counts(data_dir, trial_filenames=(), trq_sensor_no=0, workers=None, executor=None):
+    """
+    Function loads the trials in trial_filenames [see find_trial_files()] into one SpikeCounts
+    :param workers:  - number of worker processes to load trials with (optional, see map_trials())
+    :param executor: - concurrent.futures executor to load trials with instead of workers (optional)
+    :return: SpikeCounts, (directory, file) of each of its trials
+    """
+    trial_paths = find_trial_files(data_dir, trial_filenames)
+    if len(trial_paths) == 0:
+        return None
+    trials = map_trials(load_trial_spike_trains, trial_paths, workers=workers, executor=executor,
+                        trq_sensor_no=trq_sensor_no)
+    return SpikeCounts(trials), trial_paths
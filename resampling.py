@@ -0,0 +1,170 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from histogramaccumulator import histogram_bin_indices
+from instrumentation import get_logger, stage
+
+logger = get_logger('resampling')
+
+RESAMPLING_METHODS = ('permutation', 'bootstrap')
+MAX_CHUNK_DRAWS = 1 << 22  # unit draws (resamples x units) held at once by one resampling chunk
+
+
+def row_kl_divergence(p, q):
+    """
+    Function returns the symmetric KL divergence of every pair of rows of p and q, with empty bins counted as 1e-10
+    as in spiketrainanalysis.kl_divergence()
+    """
+    p = np.where(p == 0, 1e-10, p)
+    q = np.where(q == 0, 1e-10, q)
+    return np.sum((p - q) * (np.log(p) - np.log(q)), axis=-1)
+
+
+def row_heights(counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts / counts.sum(axis=-1, keepdims=True)
+
+
+def gather_counts(selection, bin_count, unit_bins=None, unit_counts=None):
+    """
+    Function histograms many resamples at once. Each row of selection lists the units drawn into one resample;
+    units are single values (unit_bins: bin index of each value) or whole trials (unit_counts: units x bins counts).
+    Offsetting the bin (or unit) indices of resample r by r * bins (units) makes one bincount fill every row.
+    :return: resamples x bins counts
+    """
+    resample_count = selection.shape[0]
+    if unit_counts is None:
+        offsets = np.arange(resample_count)[:, None] * bin_count
+        return np.bincount((offsets + unit_bins[selection]).ravel(),
+                           minlength=resample_count * bin_count).reshape(resample_count, bin_count)
+
+    unit_count = unit_counts.shape[0]
+    offsets = np.arange(resample_count)[:, None] * unit_count
+    multiplicity = np.bincount((offsets + selection).ravel(),
+                               minlength=resample_count * unit_count).reshape(resample_count, unit_count)
+    return multiplicity @ unit_counts
+
+
+def resample_kl_chunk(seed, resample_count, method, size_a, bin_count, unit_bins=None, unit_counts=None):
+    """
+    Function draws resample_count resamples of the two groups (the first size_a units are group A, the rest group B)
+    and returns the KL divergence of each. Permutations shuffle the units between the groups; bootstraps draw each
+    group's units with replacement from that group.
+    """
+    rng = np.random.default_rng(seed)
+    unit_count = unit_bins.shape[0] if unit_counts is None else unit_counts.shape[0]
+    gather = functools.partial(gather_counts, bin_count=bin_count, unit_bins=unit_bins, unit_counts=unit_counts)
+    if method == 'permutation':
+        selection = rng.permuted(np.tile(np.arange(unit_count), (resample_count, 1)), axis=1)
+        counts_a = gather(selection[:, :size_a])
+        counts_b = gather(selection[:, size_a:])
+    else:
+        counts_a = gather(rng.integers(0, size_a, (resample_count, size_a)))
+        counts_b = gather(rng.integers(size_a, unit_count, (resample_count, unit_count - size_a)))
+    return row_kl_divergence(row_heights(counts_a), row_heights(counts_b))
+
+
+def resample_kl(method, n_resamples, size_a, bin_count, unit_bins=None, unit_counts=None, seed=0, workers=None,
+                executor=None):
+    """
+    Function computes the KL divergence of n_resamples resamples [see resample_kl_chunk()] in chunks of at most
+    MAX_CHUNK_DRAWS draws. Each chunk gets its own child of (seed, method), so results do not depend on workers.
+    :param workers:  - number of worker processes to spread the chunks over; None or 1 runs serially (optional)
+    :param executor: - an existing concurrent.futures executor to use instead of starting a process pool (optional)
+    """
+    unit_count = unit_bins.shape[0] if unit_counts is None else unit_counts.shape[0]
+    chunk = max(MAX_CHUNK_DRAWS // max(unit_count, 1), 1)
+    sizes = [min(chunk, n_resamples - start) for start in range(0, n_resamples, chunk)]
+    seeds = np.random.SeedSequence([seed, RESAMPLING_METHODS.index(method)]).spawn(len(sizes))
+    task = functools.partial(resample_kl_chunk, method=method, size_a=size_a, bin_count=bin_count,
+                             unit_bins=unit_bins, unit_counts=unit_counts)
+
+    with stage('kl', spikes=n_resamples * unit_count):
+        if executor is not None:
+            results = list(executor.map(task, seeds, sizes))
+        elif workers is None or workers <= 1:
+            results = [task(chunk_seed, size) for chunk_seed, size in zip(seeds, sizes)]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(task, seeds, sizes))
+    return np.concatenate([np.zeros(0)] + results)
+
+
+def kl_significance(group_a, group_b, n_bins=30, n_permutations=1000, n_bootstrap=1000, confidence=0.95,
+                    by_trial=True, seed=0, workers=None, executor=None):
+    """
+    Function tests whether the ISI distributions of two groups of trials differ. Both groups are histogrammed on
+    one set of bin edges (values outside them are dropped) and compared with the symmetric KL divergence.
+        p_value    - share of label permutations with a KL divergence at least the observed one, (1 + hits) / (1 + n)
+        ci         - bootstrap percentile confidence interval of the KL divergence
+    By default whole trials are the resampled units (permuting trial labels and bootstrapping trials), which keeps
+    the ISIs of a trial together; by_trial=False resamples individual ISIs, e.g. for groups of a single trial.
+    :param group_a:        list of 1D arrays of ISIs, one per trial (or a single array of pooled ISIs)
+    :param group_b:        same for the second group
+    :param n_bins:         number of bins spanning the ISIs of both groups, or an array of bin edges
+    :param confidence:     confidence level of the bootstrap interval
+    :param seed:           seed of every resample; equal seeds give equal results for any workers
+    :param workers:        number of worker processes (optional, see resample_kl())
+    :return: dictionary with kl, p_value, ci (low, high), permutation_kl, bootstrap_kl and bin_edges; None without ISIs
+    """
+    groups = [[np.asarray(trial, dtype=float) for trial in ([group] if np.ndim(group[0]) == 0 else group)]
+              if len(group) else [] for group in (group_a, group_b)]
+    values = np.concatenate([np.zeros(0)] + groups[0] + groups[1])
+    if values.shape[0] == 0 or not all(sum(trial.shape[0] for trial in group) for group in groups):
+        logger.error('Both groups need ISIs to be compared. Returning None.')
+        return None
+
+    if np.ndim(n_bins) == 0:
+        bin_edges = np.histogram_bin_edges(values, bins=int(n_bins))
+    else:
+        bin_edges = np.asarray(n_bins, dtype=float)
+    bin_count = bin_edges.shape[0] - 1
+
+    trial_bins = [[histogram_bin_indices(trial, bin_edges) for trial in group] for group in groups]
+    counts = np.array([np.bincount(np.concatenate([np.zeros(0, dtype=np.int64)] + [bins[bins >= 0] for bins in group]),
+                                   minlength=bin_count) for group in trial_bins])
+    observed = row_kl_divergence(row_heights(counts[:1]), row_heights(counts[1:]))[0]
+
+    if by_trial:
+        if min(len(group) for group in groups) < 2:
+            logger.warning('Trial resampling with a single trial in a group; consider by_trial=False.')
+        units = {'unit_counts': np.array([np.bincount(bins[bins >= 0], minlength=bin_count)
+                                          for group in trial_bins for bins in group])}
+        size_a = len(groups[0])
+    else:
+        group_bins = [np.concatenate([np.zeros(0, dtype=np.int64)] + group) for group in trial_bins]
+        group_bins = [bins[bins >= 0] for bins in group_bins]
+        units = {'unit_bins': np.concatenate(group_bins)}
+        size_a = group_bins[0].shape[0]
+
+    resample = functools.partial(resample_kl, size_a=size_a, bin_count=bin_count, seed=seed, workers=workers,
+                                 executor=executor, **units)
+    permutation_kl = resample('permutation', n_permutations)
+    bootstrap_kl = resample('bootstrap', n_bootstrap)
+
+    alpha = (1 - confidence) / 2
+    return {'kl': observed,
+            'p_value': (1 + np.sum(permutation_kl >= observed)) / (1 + permutation_kl.shape[0]),
+            'ci': tuple(np.nanquantile(bootstrap_kl, [alpha, 1 - alpha])) if n_bootstrap else (np.nan, np.nan),
+            'permutation_kl': permutation_kl,
+            'bootstrap_kl': bootstrap_kl,
+            'bin_edges': bin_edges}
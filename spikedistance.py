@@ -0,0 +1,224 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from TouchSimMat2Python_Loader import AFFERENT_TYPES
+from trialcache import load_trial
+from spiketrainanalysis import find_trial_files, map_trials
+from instrumentation import stage
+
+SPIKE_DISTANCE_METRICS = ('van_rossum', 'victor_purpura')
+MAX_EXPONENT = 300.0  # largest kernel exponent (in units of tau) allowed within one van Rossum segment
+
+
+def load_trial_spike_trains(directory, file, trq_sensor_no=0):
+    """
+    Function loads the spike trains of the sensor analyzed in a file (trq_sensor_no for trq files, else the only one)
+    :return: dictionary with spike_times, spike_offsets, afferent_class and n_timestamps [see TouchSimMat2Python()]
+    """
+    sensor = load_trial(directory, file)[trq_sensor_no if "trq" in file else 0]
+    return {field: sensor[field] for field in ('spike_times', 'spike_offsets', 'afferent_class', 'n_timestamps')}
+
+
+def van_rossum_squared(trains, tau=0.01, max_segment=4096):
+    """
+    Function computes the squared van Rossum distance D^2 = 1/tau * integral (f - g)^2 dt, where f and g are the
+    trains convolved with exp(-t/tau), between every pair of spike trains (a single spike against an empty train
+    gives 1/2). It uses the closed form D^2(a, b) = (S_aa + S_bb - 2 S_ab) / 2 with S_ab = sum exp(-|a_i - b_j| / tau).
+    All S_ab come from one pass over the merged, sorted spikes: the causal sums
+    L[u, v] = sum over spikes x of u, y of v at or before x of exp(-(x - y) / tau) are running (segmented) exponential
+    cumulative sums per train, and S = L + L^T - diag(spike counts).
+    :param trains: list of 1D arrays of spike times (sec)
+    :param tau:    kernel time constant (sec)
+    :return: trains x trains array of squared distances
+    """
+    train_count = len(trains)
+    counts = np.array([len(train) for train in trains], dtype=np.int64)
+    if counts.sum() == 0:
+        return np.zeros((train_count, train_count))
+
+    times = np.concatenate([np.asarray(train, dtype=float) for train in trains]) / tau
+    labels = np.repeat(np.arange(train_count), counts)
+    order = np.argsort(times, kind='stable')
+    times, labels = times[order], labels[order]
+
+    lower = np.zeros((train_count, train_count))
+    carry, carry_time = np.zeros(train_count), times[0]
+    start = 0
+    while start < times.shape[0]:
+        #  Each segment spans at most MAX_EXPONENT time constants so exp() stays finite within it
+        stop = min(np.searchsorted(times, times[start] + MAX_EXPONENT, side='left'), start + max_segment)
+        stop = max(stop, start + 1)
+        segment_times = times[start:stop] - times[start]
+        segment_labels = labels[start:stop]
+
+        running = np.zeros((stop - start, train_count))
+        running[np.arange(stop - start), segment_labels] = np.exp(segment_times)
+        np.cumsum(running, axis=0, out=running)
+        running *= np.exp(-segment_times)[:, None]
+        running += carry[None, :] * np.exp(-(times[start:stop] - carry_time))[:, None]
+
+        np.add.at(lower, segment_labels, running)
+        carry, carry_time = running[-1], times[stop - 1]
+        start = stop
+
+    cross = lower + lower.T - np.diag(counts)
+    self_terms = np.diag(cross)
+    return np.maximum((self_terms[:, None] + self_terms[None, :] - 2 * cross) / 2, 0)
+
+
+def van_rossum_distances(trains, tau=0.01):
+    """
+    van Rossum distance between every pair of spike trains [see van_rossum_squared()]
+    """
+    return np.sqrt(van_rossum_squared(trains, tau=tau))
+
+
+def victor_purpura_pairs(spike_times, starts, counts, first, second, cost=100.0, chunk_size=4096):
+    """
+    Function computes the Victor-Purpura distance (1 per inserted/deleted spike, cost per second of shifting a spike)
+    of many pairs of spike trains stored back to back in spike_times (train r is
+    spike_times[starts[r]:starts[r] + counts[r]]), for the train pairs (first[p], second[p]).
+    The DP G[i, j] = min(G[i-1, j] + 1, G[i, j-1] + 1, G[i-1, j-1] + cost * |a_i - b_j|) is run one row of spikes at
+    a time for chunk_size pairs at once; within a row the G[i, j-1] dependency is a running minimum
+    (G[i, j] = j + min over k <= j of (H[k] - k)). Shift costs are capped at 2, the price of a deletion plus an
+    insertion, so spikes further than 2 / cost apart never pair up.
+    :return: 1D array of distances, one per pair
+    """
+    first, second = np.asarray(first), np.asarray(second)
+    distances = np.empty(first.shape[0])
+    order = np.argsort(counts[first], kind='stable')  # similar row counts per chunk
+    for chunk_start in range(0, order.shape[0], chunk_size):
+        pairs = order[chunk_start:chunk_start + chunk_size]
+        rows_a, rows_b = counts[first[pairs]], counts[second[pairs]]
+        length_a, length_b = int(rows_a.max(initial=0)), int(rows_b.max(initial=0))
+
+        def padded(trains, lengths, width):
+            columns = np.arange(width)
+            index = starts[trains][:, None] + np.minimum(columns, np.maximum(lengths[:, None] - 1, 0))
+            values = spike_times[np.minimum(index, max(spike_times.shape[0] - 1, 0))] if spike_times.shape[0] else \
+                np.zeros(index.shape)
+            return np.where(columns < lengths[:, None], values, np.inf)
+
+        a = padded(first[pairs], rows_a, length_a)
+        b = padded(second[pairs], rows_b, length_b)
+        columns = np.arange(length_b + 1)
+        dp = np.broadcast_to(columns.astype(float), (pairs.shape[0], length_b + 1)).copy()
+        step = np.empty_like(dp)
+        with np.errstate(invalid='ignore'):
+            for row in range(length_a):
+                shift = np.minimum(cost * np.abs(a[:, row, None] - b), 2)
+                step[:, 0] = dp[:, 0] + 1
+                np.minimum(dp[:, 1:] + 1, dp[:, :-1] + shift, out=step[:, 1:])
+                updated = np.minimum.accumulate(step - columns, axis=1) + columns
+                active = row < rows_a
+                dp[active] = updated[active]
+        distances[pairs] = dp[np.arange(pairs.shape[0]), rows_b]
+    return distances
+
+
+def victor_purpura_distances(trains, cost=100.0):
+    """
+    Victor-Purpura distance between every pair of spike trains [see victor_purpura_pairs()]
+    :param trains: list of 1D arrays of spike times (sec)
+    :param cost:   cost per second of shifting a spike (1 / cost is the timescale of the comparison)
+    :return: trains x trains distance matrix
+    """
+    counts = np.array([len(train) for train in trains], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    spike_times = np.concatenate([np.zeros(0)] + [np.asarray(train, dtype=float) for train in trains])
+    first, second = np.triu_indices(len(trains), 1)
+
+    distances = np.zeros((len(trains), len(trains)))
+    distances[first, second] = victor_purpura_pairs(spike_times, starts, counts, first, second, cost=cost)
+    return distances + distances.T
+
+
+def selected_neurons(trials, neuron_id=None, afferent_type=None):
+    """
+    Neuron IDs compared by population_distance_matrix(): neuron_id, the neurons of afferent_type, or all afferents
+    """
+    if neuron_id is not None:
+        return np.atleast_1d(neuron_id)
+    afferent_class = np.asarray(trials[0]['afferent_class'])
+    if afferent_type is not None:
+        return np.flatnonzero(afferent_class == AFFERENT_TYPES.index(afferent_type))
+    return np.flatnonzero(afferent_class >= 0)
+
+
+def population_distance_matrix(trials, metric='van_rossum', neuron_id=None, afferent_type=None, tau=0.01,
+                               cost=100.0):
+    """
+    Function computes a spike-train distance between every pair of trials for one neuron or a population
+    (an afferent type, or every afferent when both are None). Neurons are compared as labelled lines: the
+    distance of two trials is the sum over neurons of the Victor-Purpura distances, or the square root of the sum of
+    the squared van Rossum distances.
+    :param trials:    list of spike train dictionaries of the same afferent population [see load_trial_spike_trains()]
+    :param metric:    'van_rossum' or 'victor_purpura'
+    :param tau:       van Rossum kernel time constant (sec)
+    :param cost:      Victor-Purpura cost per second of shifting a spike
+    :return: trials x trials distance matrix
+    """
+    if metric not in SPIKE_DISTANCE_METRICS:
+        raise ValueError(f'metric must be one of {SPIKE_DISTANCE_METRICS}, not {metric!r}')
+    neurons = selected_neurons(trials, neuron_id=neuron_id, afferent_type=afferent_type)
+    trial_count = len(trials)
+
+    #  Gather every (neuron, trial) train as a slice of one flat array, row = neuron * trial_count + trial
+    trial_starts = np.cumsum([0] + [trial['spike_times'].shape[0] for trial in trials])
+    spike_times = np.concatenate([np.zeros(0)] + [np.asarray(trial['spike_times'], dtype=float) for trial in trials])
+    offsets = np.array([np.asarray(trial['spike_offsets'])[neurons] for trial in trials]).T + trial_starts[:-1]
+    ends = np.array([np.asarray(trial['spike_offsets'])[neurons + 1] for trial in trials]).T + trial_starts[:-1]
+    starts, counts = offsets.ravel(), (ends - offsets).ravel()
+
+    with stage('spike_distance', spikes=int(counts.sum())):
+        if metric == 'van_rossum':
+            squared = np.zeros((trial_count, trial_count))
+            for neuron in range(neurons.shape[0]):
+                rows = range(neuron * trial_count, (neuron + 1) * trial_count)
+                squared += van_rossum_squared([spike_times[starts[row]:starts[row] + counts[row]] for row in rows],
+                                              tau=tau)
+            return np.sqrt(squared)
+
+        first, second = np.triu_indices(trial_count, 1)
+        neuron_rows = (np.arange(neurons.shape[0]) * trial_count)[:, None]
+        pair_distances = victor_purpura_pairs(spike_times, starts, counts, (neuron_rows + first).ravel(),
+                                              (neuron_rows + second).ravel(), cost=cost)
+        distances = np.zeros((trial_count, trial_count))
+        distances[first, second] = pair_distances.reshape(neurons.shape[0], -1).sum(axis=0)
+        return distances + distances.T
+
+
+def trial_spike_distance_matrix(data_dir, trial_filenames=(), metric='van_rossum', neuron_id=None, afferent_type=None,
+                                tau=0.01, cost=100.0, trq_sensor_no=0, workers=None, executor=None):
+    """
+    Function loads the spike trains of the trials in trial_filenames [see find_trial_files()] and returns the
+    distance between every pair of trials [see population_distance_matrix()]
+    :param workers:  - number of worker processes to load trials with (optional, see map_trials())
+    :param executor: - concurrent.futures executor to load trials with instead of workers (optional)
+    :return: trials x trials distance matrix, (directory, file) of each row/column
+    """
+    trial_paths = find_trial_files(data_dir, trial_filenames)
+    if len(trial_paths) == 0:
+        return None
+    trials = map_trials(load_trial_spike_trains, trial_paths, workers=workers, executor=executor,
+                        trq_sensor_no=trq_sensor_no)
+    distances = population_distance_matrix(trials, metric=metric, neuron_id=neuron_id, afferent_type=afferent_type,
+                                           tau=tau, cost=cost)
+    return distances, trial_paths
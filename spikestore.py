@@ -0,0 +1,197 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+from trialcache import load_trial
+from trialcatalog import parse_trial_path, select_trials
+from spiketrainanalysis import find_trial_files, calculate_isi_batch, afferent_stats_from_batch
+
+STORE_VERSION = 1
+
+#  Flat columns of a store, appended trial by trial as raw binary files and read back with np.memmap.
+#  The afferent columns have one row per (recording, neuron); spike_offsets has one more entry than there are rows.
+STORE_COLUMNS = {'spike_times': ('<f8', ()),
+                 'spike_offsets': ('<i8', ()),
+                 'afferent_class': ('i1', ()),
+                 'locations': ('<f8', (2,)),
+                 'depths': ('<f8', ()),
+                 'rates': ('<f8', ())}
+
+
+def build_spike_store(data_dir, store_dir, trial_filenames=()):
+    """
+    Converts the .mat trials below data_dir into a single columnar spike store [see SpikeStore].
+    Trials are appended one at a time (through the trialcache.py cache), so memory does not grow with the dataset.
+    The store is written to store_dir + '.partial' and only moved to store_dir once complete.
+    :param data_dir:        - directory with .mat trial files
+    :param store_dir:       - directory to create (an existing store there is replaced)
+    :param trial_filenames: - custom list of filenames to convert (optional, all .mat files below data_dir if empty)
+    :return: the opened SpikeStore
+    """
+    partial_dir = store_dir.rstrip('/') + '.partial'
+    if os.path.isdir(partial_dir):
+        shutil.rmtree(partial_dir)
+    os.makedirs(partial_dir)
+
+    columns = {column: open(os.path.join(partial_dir, column + '.bin'), 'wb') for column in STORE_COLUMNS}
+    lengths = dict.fromkeys(STORE_COLUMNS, 0)
+    trials = {column: [] for column in ('directory', 'file', 'sensor', 'object', 'dim', 'trial', 'noise',
+                                        'sensor_no', 'n_timestamps', 'neuron_start', 'neuron_count')}
+
+    def append(column, values):
+        dtype, shape = STORE_COLUMNS[column]
+        values = np.ascontiguousarray(values, dtype=dtype).reshape((-1,) + shape)
+        columns[column].write(values.tobytes())
+        lengths[column] += values.shape[0]
+
+    try:
+        append('spike_offsets', [0])
+        for directory, file in find_trial_files(data_dir, trial_filenames):
+            sensor_type, obj, dim, trial, noise = parse_trial_path(os.path.abspath(directory), file)
+            for sensor in load_trial(directory, file):
+                neuron_count = sensor['spike_offsets'].shape[0] - 1
+                trials['directory'].append(os.path.abspath(directory))
+                trials['file'].append(file)
+                trials['sensor'].append(sensor_type)
+                trials['object'].append(obj)
+                trials['dim'].append(dim)
+                trials['trial'].append(trial)
+                trials['noise'].append(noise)
+                trials['sensor_no'].append(sensor['sensor_no'])
+                trials['n_timestamps'].append(sensor['n_timestamps'])
+                trials['neuron_start'].append(lengths['afferent_class'])
+                trials['neuron_count'].append(neuron_count)
+
+                append('spike_offsets', sensor['spike_offsets'][1:] + lengths['spike_times'])
+                append('spike_times', sensor['spike_times'])
+                append('afferent_class', sensor['afferent_class'])
+                append('locations', sensor['locations'])
+                append('depths', sensor['depths'])
+                append('rates', sensor['rates'])
+    finally:
+        for column_file in columns.values():
+            column_file.close()
+
+    os.makedirs(os.path.join(partial_dir, 'trials'))
+    for column, values in trials.items():
+        dtype = str if column in ('directory', 'file', 'sensor', 'object') else float if column == 'noise' else np.int64
+        np.save(os.path.join(partial_dir, 'trials', column + '.npy'), np.array(values, dtype=dtype))
+    with open(os.path.join(partial_dir, 'store.json'), 'w') as store_file:
+        json.dump({'version': STORE_VERSION, 'data_dir': os.path.abspath(data_dir), 'lengths': lengths}, store_file)
+
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(partial_dir, store_dir)
+    return SpikeStore(store_dir)
+
+
+class SpikeStore:
+    """
+    Read side of a store written by build_spike_store(). A store holds every recording (one sensor of one trial)
+    of a dataset in flat columns:
+        spike_times    - every spike time (sec), recording by recording and neuron by neuron
+        spike_offsets  - row r (a neuron of a recording) owns spike_times[spike_offsets[r]:spike_offsets[r+1]]
+        afferent_class, locations, depths, rates - one row per (recording, neuron)
+    plus a small trial table (self.trials, one .npy per column, parallel columns directory, file, sensor, object, dim, trial, noise,
+    sensor_no, n_timestamps, neuron_start, neuron_count) with one row per recording.
+    The columns are opened with np.memmap, so everything recording() returns is a slice of the page cache and any
+    number of analysis processes can share one copy of the dataset.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'store.json')) as store_file:
+            header = json.load(store_file)
+        if header['version'] != STORE_VERSION:
+            raise ValueError(f'{store_dir} is a version {header["version"]} spike store, expected {STORE_VERSION}. '
+                             f'Rebuild it with build_spike_store().')
+        self.data_dir = header['data_dir']
+        for column, (dtype, shape) in STORE_COLUMNS.items():
+            length = header['lengths'][column]
+            if length == 0:  # np.memmap cannot map an empty file
+                values = np.zeros((0,) + shape, dtype=dtype)
+            else:
+                values = np.memmap(os.path.join(store_dir, column + '.bin'), dtype=dtype, mode='r',
+                                   shape=(length,) + shape)
+            setattr(self, column, values)
+        self.trials = {column[:-len('.npy')]: np.load(os.path.join(store_dir, 'trials', column), allow_pickle=False)
+                       for column in os.listdir(os.path.join(store_dir, 'trials')) if column.endswith('.npy')}
+
+    def __len__(self):
+        return self.trials['file'].shape[0]
+
+    def select(self, noise=None, sensor=None, obj=None, dim=None, trial=None, sensor_no=None):
+        """
+        Boolean mask over the recordings matching every condition given [see trialcatalog.select_trials()]
+        """
+        mask = select_trials(self.trials, noise=noise, sensor=sensor, obj=obj, dim=dim, trial=trial)
+        if sensor_no is not None:
+            mask &= np.isin(self.trials['sensor_no'], np.atleast_1d(sensor_no))
+        return mask
+
+    def recording(self, row):
+        """
+        Sensor dictionary of recording row, as trialcache.load_trial() returns it; the arrays are memmap slices
+        (only spike_offsets is rebased to the recording, which copies one int per neuron)
+        """
+        start = self.trials['neuron_start'][row]
+        stop = start + self.trials['neuron_count'][row]
+        spike_offsets = self.spike_offsets[start:stop + 1]
+        return {'spike_times': self.spike_times[spike_offsets[0]:spike_offsets[-1]],
+                'spike_offsets': spike_offsets - spike_offsets[0],
+                'n_timestamps': int(self.trials['n_timestamps'][row]),
+                'afferent_class': self.afferent_class[start:stop],
+                'locations': self.locations[start:stop],
+                'depths': self.depths[start:stop],
+                'rates': self.rates[start:stop],
+                'sensor_type': str(self.trials['sensor'][row]),
+                'sensor_no': int(self.trials['sensor_no'][row])}
+
+    def isi_batch(self, row):
+        """
+        ISI batch of recording row [see spiketrainanalysis.calculate_isi_batch()]
+        """
+        sensor = self.recording(row)
+        return calculate_isi_batch(sensor['spike_times'], sensor['spike_offsets'], sensor['afferent_class'],
+                                   sensor['locations'])
+
+    def isi_stats(self, row):
+        """
+        afferent_stats (NeuronTable) of recording row, as spiketrainanalysis.load_isi_stats() returns for one sensor
+        """
+        return afferent_stats_from_batch(self.isi_batch(row), depths=self.recording(row)['depths'])
+
+    def sensor_batches(self, mask=None, trq_sensor_no=0):
+        """
+        (batch, plot label suffix) of every selected trial, like spiketrainanalysis.load_sensor_batches() but read
+        from the store, so the batches_* distribution functions can run on it directly. As there, the trq sensor
+        analyzed is trq_sensor_no and the other sensors of trq trials are skipped.
+        """
+        rows = np.flatnonzero(mask) if mask is not None else np.arange(len(self))
+        batches = []
+        for row in rows:
+            if self.trials['sensor'][row] == 'trq':
+                if self.trials['sensor_no'][row] == trq_sensor_no:
+                    batches.append((self.isi_batch(row), f' | (sensor #{trq_sensor_no})'))
+            elif self.trials['sensor_no'][row] == 0:
+                batches.append((self.isi_batch(row), ''))
+        return batches
@@ -18,10 +18,17 @@ limitations under the License.
 """
 
 import os
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import scipy.stats as ss
-from matplotlib import pyplot as plt
 from TouchSimMat2Python_Loader import *
+from trialcache import load_trial
+from trialcatalog import get_trial_catalog
+from histogramaccumulator import HistogramAccumulator, ValueCounter, histogram_bin_indices
+from instrumentation import get_logger, stage
+from neurontable import NeuronTable
+
+logger = get_logger('spiketrainanalysis')
 
 
 def calculate_magnitude(neuron_x, neuron_y, center_x=0, center_y=0):
@@ -33,13 +40,8 @@ def flatten_arrays(arrays):
     Function flattens a list of numpy arrays
     Accepts a single tuple of numpy arrays
     """
-    data = np.array(())
-
-    for array in arrays:  # sa ra pc
-        for neuron in array:  # 0 1 2 3 in list
-            data = np.hstack((data, neuron))
-
-    return data
+    #  sa ra pc, then 0 1 2 3 in list; concatenated once instead of hstacking neuron by neuron
+    return np.concatenate([np.zeros(0)] + [np.atleast_1d(neuron) for array in arrays for neuron in array])
 
 
 def get_afferent_ranges(afferent_stats):
@@ -57,7 +59,14 @@ def get_afferent_ranges(afferent_stats):
 def get_afferent_type(neuron_id, afferent_stats):
     """
     Function retrieves the type of afferent for a given neuron within a set of afferent_stats
+    (an O(1) lookup when afferent_stats is a NeuronTable)
     """
+    if isinstance(afferent_stats, NeuronTable):
+        afferent_type = afferent_stats.afferent_type(neuron_id)
+        if afferent_type is None:
+            logger.error('neuron_id %s does not correspond to SA, RA, or PC neuron.', neuron_id)
+        return afferent_type
+
     sa_range, ra_range, pc_range = get_afferent_ranges(afferent_stats)
 
     if neuron_id in sa_range:
@@ -67,7 +76,7 @@ def get_afferent_type(neuron_id, afferent_stats):
     elif neuron_id in pc_range:
         afferent_type = 'pc'
     else:
-        print('Error - neuron_id does not correspond to SA, RA, or PC neuron.')
+        logger.error('neuron_id %s does not correspond to SA, RA, or PC neuron.', neuron_id)
 
     return afferent_type
 
@@ -116,6 +125,9 @@ def neuron_spiked(i, afferent_stats):
     :param afferent_stats:
     :return:
     """
+    if isinstance(afferent_stats, NeuronTable):
+        return afferent_stats.spiked(i)
+
     afferent_type = get_afferent_type(i, afferent_stats)
     spike_deltas = afferent_stats[afferent_type]['spike_deltas']
     spiked = len(spike_deltas[i]) > 0
@@ -124,106 +136,111 @@ def neuron_spiked(i, afferent_stats):
     return spiked
 
 
+def load_isi_batches(data_dir, file):
+    """
+    Function loads a trial and runs calculate_isi_batch() on every sensor in it
+    Trials are read through the trialcache.py cache, so repeat loads skip the MAT parser
+    :param data_dir: directory to search from (nesting is allowed by caller function,
+    see trial_isi_probability_distribution().)
+    :param file:
+    :return: list of ISI batches, one per sensor
+    """
+    file_data = load_trial(data_dir, file)
+
+    return [sensor_isi_batch(sensor) for sensor in file_data]
+
+
 def load_isi_stats(data_dir, file):
     """
     Function accepts a data_dir directory to search for a file to convert from matlab to python data types
     :param data_dir: directory to search from (nesting is allowed by caller function,
     see trial_isi_probability_distribution().)
     :param file:
-    :return:
+    :return: list of NeuronTable (read like the afferent_stats dictionary), one per sensor
     """
-    file_data = TouchSimMat2Python(data_dir, file)
+    return [afferent_stats_from_batch(sensor_isi_batch(sensor), depths=sensor['depths'])
+            for sensor in load_trial(data_dir, file)]
 
-    sensors = []
 
-    for sensor in file_data:  # parse all sensors in case of trq file
-        afferent_stats = calculate_afferet_isi_stats(sensor['spikes'],
-                                                     sensor['metadata'],
-                                                     sensor['sensor_no'])
-        sensors.append(afferent_stats)
+def calculate_isi_batch(spike_times, spike_offsets, afferent_class, locations):
+    """
+    Function computes ISI statistics for every neuron of a trial at once with segmented numpy operations
+    (one diff over the concatenated spike times, one reduceat per neuron), so the cost is linear in spike count.
+    :param spike_times:    all spike times of the trial, neuron by neuron [see TouchSimMat2Python()]
+    :param spike_offsets:  neuron i's spikes are spike_times[spike_offsets[i]:spike_offsets[i+1]]
+    :param afferent_class: int code per neuron, an index into AFFERENT_TYPES (-1 for none)
+    :param locations:      n neurons x 2 array of neuron coordinates
+    :return: dictionary with
+        spike_deltas:   every neuron's inter-spike times back to back
+        delta_offsets:  neuron i's ISIs are spike_deltas[delta_offsets[i]:delta_offsets[i+1]]
+        isi:            average ISI per neuron (0 for neurons that fired less than twice)
+        fire_count:     firing count per neuron
+        afferent_class: afferent_class, as passed in
+        masks:          {afferent type: boolean mask over neurons}
+        locations:      locations, as passed in
+    """
+    with stage('isi_extraction', spikes=spike_times.shape[0]):
+        spike_offsets = np.asarray(spike_offsets, dtype=np.int64)
+        fire_count = np.diff(spike_offsets)
+        delta_count = np.maximum(fire_count - 1, 0)
+        delta_offsets = np.zeros_like(spike_offsets)
+        np.cumsum(delta_count, out=delta_offsets[1:])
+
+        #  Differences across a neuron boundary (last spike of one neuron to first of the next) are not ISIs
+        spike_deltas = np.diff(spike_times)
+        neuron_starts = spike_offsets[1:-1]
+        neuron_starts = neuron_starts[(neuron_starts > 0) & (neuron_starts < spike_times.shape[0])]
+        keep = np.ones(spike_deltas.shape[0], dtype=bool)
+        keep[neuron_starts - 1] = False
+        spike_deltas = spike_deltas[keep]
+
+        isi = np.zeros(fire_count.shape[0])
+        fired = delta_count > 0
+        if np.any(fired):
+            isi[fired] = np.add.reduceat(spike_deltas, delta_offsets[:-1][fired]) / delta_count[fired]
+
+        afferent_class = np.asarray(afferent_class)
+        masks = {afferent_type: afferent_class == code for code, afferent_type in enumerate(AFFERENT_TYPES)}
+
+    return {'spike_deltas': spike_deltas, 'delta_offsets': delta_offsets, 'isi': isi, 'fire_count': fire_count,
+            'afferent_class': afferent_class, 'masks': masks, 'locations': locations}
+
+
+def batch_spike_deltas(batch, neuron_mask):
+    """
+    Function returns the ISIs of every neuron selected by neuron_mask as one flat array
+    """
+    return batch['spike_deltas'][np.repeat(neuron_mask, np.diff(batch['delta_offsets']))]
 
-    return sensors
+
+def afferent_stats_from_batch(batch, depths=None):
+    """
+    Function wraps an ISI batch [see calculate_isi_batch()] in a NeuronTable, which reads like the afferent_stats
+    nested dictionary described in calculate_afferet_isi_stats() without building it for every afferent type
+    """
+    return NeuronTable.from_batch(batch, depths=depths)
 
 
-def calculate_afferet_isi_stats(spikes, metadata, sensor_no):
+def calculate_afferet_isi_stats(spikes, metadata, sensor_no, spike_offsets=None):
     """
     Function accepts matlab data [i.e. TouchSimMat2Python()]
-    and produces a nested dictionary containing the following (each for SA, RA, and PC afferents):
+    'spikes' is either the flat spike_times array (when spike_offsets is given) or a dense 0/1 raster
+    and produces a NeuronTable [see neurontable.py] that reads like a nested dictionary containing the following
+    (each for SA, RA, and PC afferents), e.g. afferent_stats['sa']['spike_deltas']:
     :param id_range:     Range of neuron IDs corresponding to the afferent type; list
     :param isi:          Average ISI for each type of afferent neuron; {neuron_id, int}
     :param fire_count:   The firing count of each neuron (organized by afferent type); {neuron_id, int}
     :param spike_deltas: All inter-spike times for a neuron that fired; {neuron_id, list}
     :param neuron_count: Amount of neurons of this afferent type (i.e. the length of id_range); int
+    :param locations:    Coordinates of the neurons of this afferent type (0 for the others); n x 2 array
     """
 
-    neuron_count = spikes.shape[0]
-
-    # print(f'neuron count = {neuron_count}')
-
-    afferent_stats = {}
-    afferent_stats['sa'] = {}
-    afferent_stats['sa']['id_range'] = []  # Store what neuron ID range corresponds to an afferent
-    afferent_stats['sa']['isi'] = {}  # Average ISI for each neuron {id, avg_isi}
-    afferent_stats['sa']['fire_count'] = {}  # Total quanitiy of nerve firings per neuron {id, firings}
-    afferent_stats['sa']['spike_deltas'] = [0] * neuron_count  # Lists of the time deltas between neuron spikes
-    afferent_stats['sa']['neuron_count'] = 0  # Number of afferent neurons (length of id_range)
-    afferent_stats['sa']['locations'] = np.zeros((neuron_count, 2))  # Array of the neuron coordinates
-
-    afferent_stats['ra'] = {}
-    afferent_stats['ra']['id_range'] = []
-    afferent_stats['ra']['isi'] = {}
-    afferent_stats['ra']['fire_count'] = {}
-    afferent_stats['ra']['spike_deltas'] = [0] * neuron_count
-    afferent_stats['ra']['neuron_count'] = 0
-    afferent_stats['ra']['locations'] = np.zeros((neuron_count, 2))
-
-    afferent_stats['pc'] = {}
-    afferent_stats['pc']['id_range'] = []
-    afferent_stats['pc']['isi'] = {}
-    afferent_stats['pc']['fire_count'] = {}
-    afferent_stats['pc']['spike_deltas'] = [0] * neuron_count
-    afferent_stats['pc']['neuron_count'] = 0
-    afferent_stats['pc']['locations'] = np.zeros((neuron_count, 2))
-
-    for i in range(neuron_count):  # iterate over every neuron
-        nonzero_spikes = np.nonzero(spikes[i, :])[0]  # Remove indices where neuron didn't spike
-        spike_times = nonzero_spikes / 1e4  # Convert array to spike timestamps
-        neuron_fire_count = spike_times.shape[0]  # Get a quantity for how many times each nerve fired
-        average_ISI = np.zeros(spikes.shape[0], )
-
-        if (neuron_fire_count < 2):  # This must be a neuron that fired at least twice (so a delta exists)
-            spike_deltas = []
-            average_ISI[i] = 0
-        else:
-            spike_deltas = calculate_spike_deltas(neuron_fire_count, spike_times)
-            average_ISI[i] = sum(spike_deltas) / len(spike_deltas)
-
-        if metadata[i]['iSA1'] == 1:
-            afferent_stats['sa']['id_range'].append(i)
-            afferent_stats['sa']['isi'][i] = average_ISI[i]
-            afferent_stats['sa']['fire_count'][i] = neuron_fire_count
-            afferent_stats['sa']['spike_deltas'][i] = np.array(spike_deltas)
-            afferent_stats['sa']['locations'][i] = metadata[i]['location']
-
-        elif metadata[i]['iRA'] == 1:
-            afferent_stats['ra']['id_range'].append(i)
-            afferent_stats['ra']['isi'][i] = average_ISI[i]
-            afferent_stats['ra']['fire_count'][i] = neuron_fire_count
-            afferent_stats['ra']['spike_deltas'][i] = np.array(spike_deltas)
-            afferent_stats['ra']['locations'][i] = metadata[i]['location']
+    if spike_offsets is None:
+        spikes, spike_offsets = raster_to_spike_times(spikes)
 
-        elif metadata[i]['iPC'] == 1:
-            afferent_stats['pc']['id_range'].append(i)
-            afferent_stats['pc']['isi'][i] = average_ISI[i]
-            afferent_stats['pc']['fire_count'][i] = neuron_fire_count
-            afferent_stats['pc']['spike_deltas'][i] = np.array(spike_deltas)
-            afferent_stats['pc']['locations'][i] = metadata[i]['location']
+    batch = calculate_isi_batch(spikes, spike_offsets, afferent_class_codes(metadata), afferent_locations(metadata))
 
-    afferent_stats['sa']['neuron_count'] = len(afferent_stats['sa']['id_range'])
-    afferent_stats['ra']['neuron_count'] = len(afferent_stats['ra']['id_range'])
-    afferent_stats['pc']['neuron_count'] = len(afferent_stats['pc']['id_range'])
-
-    return afferent_stats
+    return afferent_stats_from_batch(batch, depths=afferent_depths(metadata))
 
 
 def plot_spikes(afferent_stats=None, metric='isi', ylabel='', title_addendum=''):
@@ -234,6 +251,8 @@ def plot_spikes(afferent_stats=None, metric='isi', ylabel='', title_addendum='')
     Additional Parameters are for labeling axis and title of plot
     """
 
+    from matplotlib import pyplot as plt
+
     width = 1
     y_axis_limit = 5
 
@@ -256,19 +275,14 @@ def plot_isi_count_histogram(neuron_id, afferent_stats, n_bins=20):
     (Checks the id for the type of afferent first)
     """
 
-    afferent_type = None
-    sa_range, ra_range, pc_range = get_afferent_ranges(afferent_stats)
+    from matplotlib import pyplot as plt
 
-    afferent_type = get_afferent_type(neuron_id, afferent_stats)
+    colors = {'sa': 'g', 'ra': 'b', 'pc': 'orange'}
 
-    if neuron_id in sa_range:
-        plt.hist(afferent_stats[afferent_type]['spike_deltas'][neuron_id], bins=n_bins, color='g')
-    elif neuron_id in ra_range:
-        plt.hist(afferent_stats[afferent_type]['spike_deltas'][neuron_id], bins=n_bins, color='b')
-    elif neuron_id in pc_range:
-        plt.hist(afferent_stats[afferent_type]['spike_deltas'][neuron_id], bins=n_bins, color='orange')
-    else:
-        print('Error - neuron_id does not correspond to SA, RA, or PC neuron.')
+    afferent_type = get_afferent_type(neuron_id, afferent_stats)  # logs an error for other neurons
+
+    if afferent_type in colors:
+        plt.hist(afferent_stats[afferent_type]['spike_deltas'][neuron_id], bins=n_bins, color=colors[afferent_type])
 
     plt.title(f"Neuron #{neuron_id} ({afferent_type}) ISI Histogram with {n_bins} bins")
     plt.xlabel('ISI Time (sec)')
@@ -311,33 +325,46 @@ def plot_noise_sweep(dir_to_sweep, trial_filenames, trq_sensor_no=0):
                 plot_spikes(afferent_stats, ylabel='Average ISI (sec)', title_addendum=noise_profile)
 
 
-def probability_distribution(data, n_bins=10, plotted_data='', show_bins=False, y_axis_limit=1, x_axis_limit=0,
-                             plot_title='ISI Probability Distribution', xlabel='Inter-Spike Time (sec)'):
+def probability_heights(data, n_bins=10):
     """
-    :param xlabel: desired x label for when not plotting ISI
-    :param plot_title: desired title for when not plotting ISI
+    Function computes the probability distribution of data without plotting it [see probability_distribution()]
     :param data: a 1D array of aggregated spike_deltas (across neurons, afferent type, noise profile, etc.)
     :param n_bins: preferred bin count, or ranges for bins. see https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
-    :param plotted_data: appends to the plot title to explicity show what was plotted
-    :param show_bins: prints out the bins calculated for plotting
-    :param y_axis_limit: sets the upper limit of the y-axis on plots, defaults to 1, set to 0 to scale with data (optional)
-    :param x_axis_limit: sets the upper limit of the x-axis on plots, defaults to 0 which scales the axis with the data
-    :return: heights of probability distribution
+    :return: heights of probability distribution, bin edges
     """
 
     #  If the values in data exceed the upper n_bins limit, an error will be thrown.
     if type(n_bins).__module__ == np.__name__:
         if (len(data[data < n_bins[-1]])) == 0:
-            print('WARNING: All values read from data exceed the upper n_bins limit. Switching to default (n_bins=10).')
+            logger.warning('All values read from data exceed the upper n_bins limit. Switching to default (n_bins=10).')
             n_bins = 10
 
-    heights, bins = np.histogram(data, bins=n_bins)
+    with stage('histogram', spikes=len(data)):
+        heights, bins = np.histogram(data, bins=n_bins)
 
-    heights = heights / sum(heights)
+    return normalized_heights(heights), bins
+
+
+def normalized_heights(counts):
+    """
+    Function turns histogram counts into probability heights [see probability_heights()]
+    """
+    heights = counts / sum(counts)
     if (np.isnan(np.sum(heights))):
-        print(f'NaN detected in calculation. This most likely means some neurons did not fire. Removing NaNs.')
+        logger.warning('NaN detected in calculation. This most likely means some neurons did not fire. Removing NaNs.')
         heights = heights[~np.isnan(heights)]
 
+    return heights
+
+
+def plot_probability_distribution(heights, bins, plotted_data='', y_axis_limit=1, x_axis_limit=0,
+                                  plot_title='ISI Probability Distribution', xlabel='Inter-Spike Time (sec)'):
+    """
+    Function plots a probability distribution computed by probability_heights()
+    Parameters are as in probability_distribution()
+    """
+    from matplotlib import pyplot as plt
+
     plt.bar(bins[:-1], heights, width=(max(bins) - min(bins)) / len(bins), alpha=0.5)
     plt.title(f'{plot_title} {plotted_data}')
     plt.xlabel(xlabel)
@@ -349,6 +376,28 @@ def probability_distribution(data, n_bins=10, plotted_data='', show_bins=False,
     else:
         plt.ylim(top=y_axis_limit)
     plt.show()
+
+
+def probability_distribution(data, n_bins=10, plotted_data='', show_bins=False, y_axis_limit=1, x_axis_limit=0,
+                             plot_title='ISI Probability Distribution', xlabel='Inter-Spike Time (sec)', plot=True):
+    """
+    :param xlabel: desired x label for when not plotting ISI
+    :param plot_title: desired title for when not plotting ISI
+    :param data: a 1D array of aggregated spike_deltas (across neurons, afferent type, noise profile, etc.)
+    :param n_bins: preferred bin count, or ranges for bins. see https://numpy.org/doc/stable/reference/generated/numpy.histogram.html
+    :param plotted_data: appends to the plot title to explicity show what was plotted
+    :param show_bins: prints out the bins calculated for plotting
+    :param y_axis_limit: sets the upper limit of the y-axis on plots, defaults to 1, set to 0 to scale with data (optional)
+    :param x_axis_limit: sets the upper limit of the x-axis on plots, defaults to 0 which scales the axis with the data
+    :param plot: set to False to only compute the distribution; matplotlib is then never imported
+    :return: heights of probability distribution
+    """
+
+    heights, bins = probability_heights(data, n_bins=n_bins)
+
+    if plot:
+        plot_probability_distribution(heights, bins, plotted_data=plotted_data, y_axis_limit=y_axis_limit,
+                                      x_axis_limit=x_axis_limit, plot_title=plot_title, xlabel=xlabel)
     if show_bins == True:
         print(bins)
 
@@ -384,10 +433,13 @@ def neuron_probability_distribution(afferent_stats, neuron_id=0, n_bins=20, show
     heights, bins = np.histogram(afferent_stats[afferent_type]['spike_deltas'][neuron_id], bins=n_bins)
     heights = heights / sum(heights)
     if (np.isnan(np.sum(heights))):
-        print(f'NaN detected in calculation for neuron {neuron_id}. This most likely means this neuron did not fire.')
+        logger.warning('NaN detected in calculation for neuron %s. This most likely means this neuron did not fire.',
+                       neuron_id)
         return
 
     if show_plot == True:
+        from matplotlib import pyplot as plt
+
         plt.bar(bins[:-1], heights, width=(max(bins) - min(bins)) / len(bins), color=color, alpha=0.5)
         plt.title(f'ISI Probability Distribution for neuron #{neuron_id} ({afferent_type})')
         plt.xlabel('Inter-Spike Time (sec)')
@@ -401,223 +453,758 @@ def neuron_probability_distribution(afferent_stats, neuron_id=0, n_bins=20, show
     return heights
 
 
-def trial_isi_probability_distribution(n_bins, data_dir, trial_filenames=[], trq_sensor_no=0, neuron_id=None,
-                                       afferent_type=None,
-                                       y_axis_limit=1, x_axis_limit=0):
+def find_trial_files(data_dir, trial_filenames=()):
     """
-    Function creates isi probability distribtions across several trials.
-    :param n_bins:          - number of histogram bins
-    :param data_dir:        - directory with .mat trial files
-    :param trial_filenames: - custom list of filenames the user would like to specifically pull from (optional)
-    :param trq_sensor_no:   - if using trq sensor data, select the sensor to use (0-2) (optional)
-    :param neuron_id:       - selects this neuron_id across all trials (optional)
-    :param afferent_type:   - selects this afferent type (sa, ra, pc) to compare across trials (optional)
-    :param y_axis_limit:    - sets the upper limit of the y-axis on plots, defaults to 1, set to 0 to scale with data (optional)
+    Function returns a (directory, file) pair for every trial named in trial_filenames, found anywhere below
+    data_dir (nested directories are allowed). An empty trial_filenames selects every .mat file within data_dir.
+    Entries of trial_filenames that are full paths (e.g. from trialcatalog.TrialCatalog.query()) are used as-is.
+    Directories are listed through the trialcatalog.py index rather than walked on every call.
     """
+    trial_paths = []
+    filenames = set()
+    for file in trial_filenames:
+        if os.path.dirname(file):
+            trial_paths.append((os.path.dirname(file) + '/', os.path.basename(file)))
+        else:
+            filenames.add(file)
 
-    plotted_data = ''
-    data = np.array(())
-    heights = None
+    if len(filenames) > 0 or len(trial_filenames) == 0:
+        for directory, file in get_trial_catalog(data_dir).trial_files():
+            if len(filenames) == 0 or file in filenames:
+                trial_paths.append((directory, file))
+    return trial_paths
 
-    #  If an empty list is passed for trial_filenames, then all .mat files within data_dir will be used
-    if len(trial_filenames) == 0:
-        for subdir, dirs, files in os.walk(data_dir):
-            for file in files:
-                if file.endswith(".mat"):
-                    trial_filenames.append(file)
 
-    #  Walk through all nested directories and and aggregate/process data from files found in trial_filenames
-    for subdir, dirs, files in os.walk(data_dir):
-        for file in files:
-            if file in trial_filenames:
-                if "trq" in file:
-                    sensor_stats = load_isi_stats(str(subdir + '/'), file)
-                    afferent_stats = sensor_stats[trq_sensor_no]
-                    plotted_data = f' | (sensor #{trq_sensor_no})'
-                elif "ftsn" in file:
-                    afferent_stats = load_isi_stats(str(subdir + '/'), file)[0]
-                    plotted_data = ''
-                else:
-                    # If neither ftsn nor trq is in the .mat file, default to ftsn behavior
-                    afferent_stats = load_isi_stats(str(subdir + '/'), file)[0]
-                    plotted_data = ''
+def map_trials(function, trial_paths, workers=None, executor=None, **kwargs):
+    """
+    Function calls function(directory, file, **kwargs) for every (directory, file) pair in trial_paths and returns
+    the results in trial_paths order, however they were computed.
+    :param workers:  - number of worker processes to fan the trials out to; None or 1 runs serially (optional)
+    :param executor: - an existing concurrent.futures executor to use instead of starting a process pool (optional)
+    """
+    if executor is None and (workers is None or workers <= 1):
+        return [function(directory, file, **kwargs) for directory, file in trial_paths]
+
+    directories = [directory for directory, _ in trial_paths]
+    files = [file for _, file in trial_paths]
+    task = functools.partial(function, **kwargs)
+    if executor is not None:
+        return list(executor.map(task, directories, files))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(task, directories, files))
+
+
+def load_sensor_batch(directory, file, trq_sensor_no=0):
+    """
+    Function loads the ISI batch for the sensor analyzed in a file (trq_sensor_no for trq files, else the only one)
+    :return: batch [see calculate_isi_batch()], plot label suffix
+    """
+    if "trq" in file:
+        return sensor_isi_batch(load_trial(directory, file)[trq_sensor_no]), f' | (sensor #{trq_sensor_no})'
+    # If neither ftsn nor trq is in the .mat file, default to ftsn behavior
+    return sensor_isi_batch(load_trial(directory, file)[0]), ''
+
+
+def load_all_sensor_batches(directory, file):
+    """
+    Function loads the ISI batch of every sensor in a file from a single load (sensor mode)
+    :return: list of (batch [see calculate_isi_batch()], plot label suffix), one per sensor
+    """
+    if "trq" in file:
+        return [(sensor_isi_batch(sensor), f' | (sensor #{sensor_no})')
+                for sensor_no, sensor in enumerate(load_trial(directory, file))]
+    return [(sensor_isi_batch(load_trial(directory, file)[0]), '')]
+
+
+def sensor_isi_batch(sensor):
+    """
+    Function computes the ISI batch of one sensor dictionary of a loaded trial [see calculate_isi_batch()]
+    """
+    return calculate_isi_batch(sensor['spike_times'], sensor['spike_offsets'], sensor['afferent_class'],
+                               sensor['locations'])
+
+
+def load_sensor_batches(trial_path_sets, trq_sensor_no=0, workers=None, executor=None):
+    """
+    Function loads the sensor batch [see load_sensor_batch()] of every trial in one or more lists of (directory, file)
+    pairs [see find_trial_files()]. A trial that appears in several lists is only loaded once, so comparisons
+    over overlapping trial sets share the work.
+    :param workers:  - number of worker processes to load trials with (optional, see map_trials())
+    :param executor: - concurrent.futures executor to load trials with instead of workers (optional)
+    :return: one list of (batch, plot label suffix) per list in trial_path_sets, in the same order
+    """
+    unique_paths = {}
+    for trial_paths in trial_path_sets:
+        for directory, file in trial_paths:
+            unique_paths.setdefault(os.path.abspath(directory + file), (directory, file))
+
+    sensor_batches = map_trials(load_sensor_batch, list(unique_paths.values()), workers=workers, executor=executor,
+                                trq_sensor_no=trq_sensor_no)
+    loaded = dict(zip(unique_paths.keys(), sensor_batches))
+
+    return [[loaded[os.path.abspath(directory + file)] for directory, file in trial_paths]
+            for trial_paths in trial_path_sets]
+
+
+def batch_isi_data(batch, neuron_id=None, afferent_type=None):
+    """
+    Function extracts the ISIs that trial_isi_probability_distribution() aggregates from a single trial's batch
+    """
+    #  Afferent Mode - Aggregates data from one afferent type across all data ('sa', 'ra', 'pc')
+    if afferent_type is not None:
+        return batch_spike_deltas(batch, batch['masks'][afferent_type])
+
+    # Neuron Mode - Aggregates data from a single neuron across several trials
+    if neuron_id is not None:
+        delta_offsets = batch['delta_offsets']
+        return batch['spike_deltas'][delta_offsets[neuron_id]:delta_offsets[neuron_id + 1]]
+
+    # General Mode - Takes all data from across all trials neuron_spike_deltas
+    return batch_spike_deltas(batch, batch['afferent_class'] >= 0)
+
+
+def batch_distance_data(batch, reference_point=(0, 0), neuron_id=None, afferent_type=None):
+    """
+    Function extracts the distances from reference_point of the neurons that spiked (had at least one ISI)
+    in a single trial's batch, as aggregated by trial_distance_probabilty_distribution()
+    :return: 1D array of distances, or None if neuron_id was requested but did not spike
+    """
+    locations = batch_spiking_locations(batch, neuron_id=neuron_id, afferent_type=afferent_type)
+    if locations is None:
+        return None
+    return calculate_magnitude(neuron_x=locations[:, 0], neuron_y=locations[:, 1],
+                               center_x=reference_point[0], center_y=reference_point[1])
+
+
+def batch_spiking_locations(batch, neuron_id=None, afferent_type=None):
+    """
+    Function returns the locations (n x 2) of the neurons of a trial's batch that spiked (had at least one ISI),
+    restricted to afferent_type or neuron_id [see batch_distance_data()]
+    :return: n x 2 array, or None if neuron_id was requested but did not spike
+    """
+    spiked = np.diff(batch['delta_offsets']) > 0
+
+    #  Afferent Mode - Aggregates data from one afferent type across all data ('sa', 'ra', 'pc')
+    if afferent_type is not None:
+        selected = spiked & batch['masks'][afferent_type]
+
+    # Neuron Mode - Aggregates data from a single neuron across several trials
+    elif neuron_id is not None:
+        if not spiked[neuron_id]:
+            return None
+        selected = np.zeros(spiked.shape[0], dtype=bool)
+        selected[neuron_id] = True
+
+    # General Mode - Takes all data from across all trials neuron_spike_deltas
+    else:
+        selected = spiked & (batch['afferent_class'] >= 0)
+
+    return batch['locations'][selected]
 
-                if (afferent_type is not None) and (neuron_id is not None):
-                    print(f'afferent_type = {afferent_type}')
-                    print(f'neuron_id = {neuron_id}')
-                    print(
-                        f'Error: Cannot aggregate data using both neuron_id and afferent_type. '
-                        f'Expecting at least one to be set to None.')
-                    return None
 
-                #  Afferent Mode - Aggregates data from one afferent type across all data ('sa', 'ra', 'pc')
-                elif (afferent_type is not None) and (neuron_id is None):
-                    afferent_spike_deltas = afferent_stats[afferent_type]['spike_deltas']
+def aggregation_label(spike_count, plotted_data, neuron_id=None, afferent_type=None):
+    """
+    Function builds the plot title addendum describing what the trial aggregators collected
+    """
+    if afferent_type is not None:
+        return f'[{afferent_type} neurons] | spikes = {spike_count}' + plotted_data
+    elif neuron_id is not None:
+        return f'[ID = {neuron_id}] | spikes = {spike_count}' + plotted_data
+    return f'[All afferent types | spikes = {spike_count}]' + plotted_data
 
-                    #  afferent_spike_deltas still has indices for ALL afferent types. Truncate it to the ones we want:
-                    #  properly-written indices in the list for this afferent will be numpy arrays, others will be int
-                    afferent_spike_deltas = [spike for spike in afferent_spike_deltas if not isinstance(spike, int)]
 
-                    flat_spike_deltas = flatten_arrays([afferent_spike_deltas])
-                    data = np.hstack((data, flat_spike_deltas))
+def valid_aggregation_mode(neuron_id, afferent_type):
+    if (afferent_type is not None) and (neuron_id is not None):
+        logger.error('Cannot aggregate data using both neuron_id (%s) and afferent_type (%s). '
+                     'Expecting at least one to be set to None.', neuron_id, afferent_type)
+        return False
+    return True
 
-                    plotted_data = f'[{afferent_type} neurons] | spikes = {data.shape[0]}' + plotted_data
 
-                # Neuron Mode - Aggregates data from a single neuron across several trials
-                elif (neuron_id is not None) and (afferent_type is None):
-                    afferent_type = get_afferent_type(neuron_id, afferent_stats)
-                    neuron_spike_deltas = afferent_stats[afferent_type]['spike_deltas'][neuron_id]
-                    data = np.hstack((data, neuron_spike_deltas))
-                    plotted_data = f'[ID = {neuron_id}] | spikes = {data.shape[0]}' + plotted_data
-                    afferent_type = None  # Set to None to avoid a warning later in execution
+TRIAL_CHUNK = 32  # trials reduced between merges by stream_probability_distributions()
 
-                # General Mode - Takes all data from across all trials neuron_spike_deltas
-                elif (afferent_type is None) and (neuron_id is None):
-                    sa_range, ra_range, pc_range = get_afferent_ranges(afferent_stats)
 
-                    sa_spike_deltas = afferent_stats['sa']['spike_deltas'][min(sa_range):max(sa_range) + 1]
-                    ra_spike_deltas = afferent_stats['ra']['spike_deltas'][min(ra_range):max(ra_range) + 1]
-                    pc_spike_deltas = afferent_stats['pc']['spike_deltas'][min(pc_range):max(pc_range) + 1]
+def aggregation_bin_edges(n_bins, counter):
+    """
+    Function returns the bin edges np.histogram(data, bins=n_bins) picks for the values counted by counter
+    (a ValueCounter or HistogramAccumulator; only their count and range are needed)
+    """
+    data_range = (counter.minimum, counter.maximum) if counter.count > 0 else ()
+    return np.histogram_bin_edges(np.array(data_range, dtype=float), bins=int(n_bins))
 
-                    flat_spike_deltas = flatten_arrays((sa_spike_deltas, ra_spike_deltas, pc_spike_deltas))
 
-                    data = np.hstack((data, flat_spike_deltas))
-                    plotted_data = f'[All afferent types | spikes = {data.shape[0]}]' + plotted_data
+def count_trial(batch, trial_data):
+    """
+    Function counts the values every function of trial_data extracts from one trial's batch into a ValueCounter
+    :return: list of ValueCounter, None where the function returned None
+    """
+    counters = []
+    for function in trial_data:
+        data = function(batch)
+        counters.append(None if data is None else ValueCounter().add(data))
+    return counters
 
-                # Sensor Mode - Aggregates data across different sensors (trq only)
-                # Not built at this time, but would repeat the above mode(s) for each sensor
 
-                #  Debug to make sure we our data contains information from ONLY neurons that did spike
-                # print(f'Data concatenated from {file}')
-                # print('Spike count: ', data.shape)
-                # print('Zero count: ', len(np.argwhere(data == 0)))
-                # print('Nonzero count: ', len(np.argwhere(data != 0)))
-                # data = data[np.where(data != 0)]
+def load_trial_counts(directory, file, trial_data, trq_sensor_no=0):
+    """
+    Function loads one trial [see load_sensor_batch()] and reduces it to value counts right away
+    [see count_trial()], so a worker process returns a few counters instead of the trial's batch
+    :return: list of ValueCounter, plot label suffix
+    """
+    batch, plotted_data = load_sensor_batch(directory, file, trq_sensor_no=trq_sensor_no)
+    return count_trial(batch, trial_data), plotted_data
 
-    heights = probability_distribution(data, n_bins=n_bins, plotted_data=plotted_data,
-                                       y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit)
 
+def merge_trial_counts(merged, counts):
+    """
+    Function merges one trial's counters [see count_trial()] into merged (one ValueCounter per distribution, None
+    once a trial returned None for it); returns merged
+    """
+    for index, counter in enumerate(counts):
+        if merged[index] is not None:
+            merged[index] = None if counter is None else merged[index].merge(counter)
+    return merged
+
+
+def accumulate_distributions(n_bins, counters):
+    """
+    Function counts the values of every distribution on the bin edges probability_heights() would pick for them:
+    the edges spanning their range for a bin count, the given edges otherwise, or 10 bins over their range when
+    they all exceed the given edges (the fallback of probability_heights()). The counters hold every distinct
+    value, so no further pass over the trials is needed.
+    :param counters: one ValueCounter per distribution, None where a trial returned None [see merge_trial_counts()]
+    :return: list of HistogramAccumulator, None where the counter is None
+    """
+    accumulators = []
+    for counter in counters:
+        if counter is None:
+            accumulators.append(None)
+            continue
+        bin_edges = aggregation_bin_edges(n_bins, counter) if np.ndim(n_bins) == 0 else n_bins
+        accumulator = counter.histogram(bin_edges)
+
+        #  If the values exceed the upper n_bins limit, probability_heights() switches to 10 bins over the data range
+        if type(n_bins).__module__ == np.__name__ and np.ndim(n_bins) > 0:
+            if not accumulator.minimum < accumulator.bin_edges[-1]:
+                logger.warning('All values read from data exceed the upper n_bins limit. '
+                               'Switching to default (n_bins=10).')
+                accumulator = counter.histogram(aggregation_bin_edges(10, counter))
+        accumulators.append(accumulator)
+    return accumulators
+
+
+def accumulated_probability_distribution(accumulator, plotted_data='', neuron_id=None, afferent_type=None,
+                                         y_axis_limit=1, x_axis_limit=0, plot=True,
+                                         plot_title='ISI Probability Distribution', xlabel='Inter-Spike Time (sec)'):
+    """
+    Function turns the counts of an aggregation [see accumulate_distributions()] into probability heights and plots
+    them as probability_distribution() would
+    :param accumulator: HistogramAccumulator, or None if neuron_id did not spike in some trial
+    :return: heights of probability distribution
+    """
+    if accumulator is None:
+        logger.warning('Neuron #%s did not have an ISI. Returning None.', neuron_id)
+        return None
+
+    plotted_data = aggregation_label(accumulator.count, plotted_data, neuron_id=neuron_id, afferent_type=afferent_type)
+    heights = normalized_heights(accumulator.counts)
+    if plot:
+        plot_probability_distribution(heights, accumulator.bin_edges, plotted_data=plotted_data,
+                                      y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, plot_title=plot_title,
+                                      xlabel=xlabel)
     return heights
 
 
-def trial_distance_probabilty_distribution(data_dir, trial_filenames, n_bins, reference_point=(0, 0), trq_sensor_no=0,
-                                           neuron_id=None,
-                                           afferent_type=None, y_axis_limit=1):
+def aggregate_probability_distribution(n_bins, sensor_batches, trial_data, neuron_id=None, afferent_type=None,
+                                       y_axis_limit=1, x_axis_limit=0, plot=True,
+                                       plot_title='ISI Probability Distribution', xlabel='Inter-Spike Time (sec)'):
     """
-        Function creates probability distributions for distance from stimulus across several trials.
-        :param n_bins:          - number of histogram bins to group data into
-        :param reference_point: - tuple; representing the coordinates of a stimulus on the hand coordinate system
-        :param data_dir:        - directory with .mat trial files
-        :param trial_filenames: - custom list of filenames the user would like to specifically pull from (optional)
-        :param trq_sensor_no:   - if using trq sensor data, select the sensor to use (0-2) (optional)
-        :param neuron_id:       - selects this neuron_id across all trials (optional)
-        :param afferent_type:   - selects this afferent type (sa, ra, pc) to compare across trials (optional)
-        :param y_axis_limit:    - sets the upper limit of the y-axis on plots, defaults to 1, set to 0 to scale with data (optional)
-        """
+    Function computes (and plots) the probability distribution of the values trial_data(batch) extracts from every
+    already loaded trial [see load_sensor_batches()]. The trials are counted into a ValueCounter rather than
+    concatenated [see accumulate_distributions()], but the batches themselves are in memory already;
+    stream_probability_distributions() aggregates trials on disk without holding them.
+    The distribution is identical to probability_distribution() of all the values hstacked together.
+    :param trial_data: function of a batch returning a 1D array, or None to abort (neuron mode, neuron did not spike)
+    :return: heights of probability distribution
+    """
+    plotted_data = sensor_batches[-1][1] if len(sensor_batches) > 0 else ''
 
-    plotted_data = ''
-    data = np.array(())
-    heights = None
+    counters = [ValueCounter()]
+    for batch, _ in sensor_batches:
+        merge_trial_counts(counters, count_trial(batch, [trial_data]))
 
-    #  If an empty list is passed for trial_filenames, then all .mat files within data_dir will be used
-    if len(trial_filenames) == 0:
-        for subdir, dirs, files in os.walk(data_dir):
-            for file in files:
-                if file.endswith(".mat"):
-                    trial_filenames.append(file)
+    accumulator, = accumulate_distributions(n_bins, counters)
+    return accumulated_probability_distribution(accumulator, plotted_data, neuron_id=neuron_id,
+                                                afferent_type=afferent_type, y_axis_limit=y_axis_limit,
+                                                x_axis_limit=x_axis_limit, plot=plot, plot_title=plot_title,
+                                                xlabel=xlabel)
 
-    #  Walk through all nested directories and and aggregate/process data from files found in trial_filenames
-    for subdir, dirs, files in os.walk(data_dir):
-        for file in files:
-            if file in trial_filenames:
-                if "trq" in file:
-                    sensor_stats = load_isi_stats(str(subdir + '/'), file)
-                    afferent_stats = sensor_stats[trq_sensor_no]
-                    plotted_data = f' | (sensor #{trq_sensor_no})'
-                elif "ftsn" in file:
-                    afferent_stats = load_isi_stats(str(subdir + '/'), file)[0]
-                    plotted_data = ''
 
-                if (afferent_type is not None) and (neuron_id is not None):
-                    print(f'afferent_type = {afferent_type}')
-                    print(f'neuron_id = {neuron_id}')
-                    print(
-                        f'Error: Cannot aggregate data using both neuron_id and afferent_type. '
-                        f'Expecting at least one to be set to None.')
-                    return None
+def isi_aggregation(trial_paths, neuron_id=None, afferent_type=None):
+    """
+    Function describes the ISI distribution of the trials in trial_paths [see find_trial_files()] for
+    stream_probability_distributions(), as trial_isi_probability_distribution() aggregates it
+    """
+    return {'trial_paths': trial_paths, 'neuron_id': neuron_id, 'afferent_type': afferent_type,
+            'trial_data': functools.partial(batch_isi_data, neuron_id=neuron_id, afferent_type=afferent_type),
+            'plot_title': 'ISI Probability Distribution', 'xlabel': 'Inter-Spike Time (sec)'}
+
+
+def distance_aggregation(trial_paths, reference_point=(0, 0), neuron_id=None, afferent_type=None):
+    """
+    Function describes the distance distribution of the trials in trial_paths [see find_trial_files()] for
+    stream_probability_distributions(), as trial_distance_probabilty_distribution() aggregates it
+    """
+    return {'trial_paths': trial_paths, 'neuron_id': neuron_id, 'afferent_type': afferent_type,
+            'trial_data': functools.partial(batch_distance_data, reference_point=reference_point, neuron_id=neuron_id,
+                                            afferent_type=afferent_type),  # Only neurons that spiked are included
+            'plot_title': 'Distance Metric', 'xlabel': f'Distance from point {str(reference_point)}'}
+
+
+def stream_probability_distributions(n_bins, aggregations, trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0,
+                                     workers=None, executor=None, plot=True):
+    """
+    Function computes (and plots) several probability distributions of trials on disk in one pass, in memory that
+    does not grow with the number of trials. Every trial is reduced to the counts of its distinct values where it is
+    loaded [see load_trial_counts()], so workers return ValueCounters rather than batches, and the bin edges are
+    applied to the merged counters [see accumulate_distributions()]. A trial shared by several aggregations is
+    loaded once. Each distribution is identical to batches_isi_probability_distribution() (or its distance
+    counterpart) of the loaded trials.
+    :param aggregations: list of aggregations [see isi_aggregation(), distance_aggregation()]
+    :param workers:      - number of worker processes to load trials with (optional, see map_trials())
+    :param executor:     - concurrent.futures executor to load trials with instead of workers (optional)
+    Other parameters are as in trial_isi_probability_distribution().
+    :return: list of heights of probability distribution (None for an invalid or aborted aggregation)
+    """
+    if executor is None and workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:  # one pool for every group of trials
+            return stream_probability_distributions(n_bins, aggregations, trq_sensor_no=trq_sensor_no,
+                                                    y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit,
+                                                    executor=pool, plot=plot)
+
+    #  Trials are grouped by the aggregations they belong to, so each is loaded once
+    valid = [valid_aggregation_mode(aggregation['neuron_id'], aggregation['afferent_type'])
+             for aggregation in aggregations]
+    memberships = {}
+    for index, aggregation in enumerate(aggregations):
+        if valid[index]:
+            for directory, file in aggregation['trial_paths']:
+                path = os.path.abspath(directory + file)
+                memberships.setdefault(path, ((directory, file), []))[1].append(index)
+    groups = {}
+    for trial_path, members in memberships.values():
+        groups.setdefault(tuple(members), []).append(trial_path)
+
+    labels = {}
+    counters = [ValueCounter() for _ in aggregations]
+    for members, group_paths in groups.items():
+        #  Merged a chunk at a time, so only TRIAL_CHUNK per-trial counters are held at once
+        for chunk_start in range(0, len(group_paths), TRIAL_CHUNK):
+            trial_paths = group_paths[chunk_start:chunk_start + TRIAL_CHUNK]
+            results = map_trials(load_trial_counts, trial_paths, workers=workers, executor=executor,
+                                 trial_data=[aggregations[index]['trial_data'] for index in members],
+                                 trq_sensor_no=trq_sensor_no)
+            for (directory, file), (counts, plotted_data) in zip(trial_paths, results):
+                labels[os.path.abspath(directory + file)] = plotted_data
+                member_counters = merge_trial_counts([counters[index] for index in members], counts)
+                for index, counter in zip(members, member_counters):
+                    counters[index] = counter
+
+    accumulators = accumulate_distributions(n_bins, counters)
+
+    distributions = []
+    for aggregation, accumulator, is_valid in zip(aggregations, accumulators, valid):
+        if not is_valid:
+            distributions.append(None)
+            continue
+        trial_paths = aggregation['trial_paths']
+        plotted_data = labels[os.path.abspath(trial_paths[-1][0] + trial_paths[-1][1])] if trial_paths else ''
+        distributions.append(accumulated_probability_distribution(
+            accumulator, plotted_data, neuron_id=aggregation['neuron_id'], afferent_type=aggregation['afferent_type'],
+            y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, plot=plot, plot_title=aggregation['plot_title'],
+            xlabel=aggregation['xlabel']))
+    return distributions
+
+
+def batches_isi_probability_distribution(n_bins, sensor_batches, neuron_id=None, afferent_type=None,
+                                         y_axis_limit=1, x_axis_limit=0, plot=True):
+    """
+    Function creates the isi probability distribution of already loaded trials [see load_sensor_batches()].
+    Parameters are as in trial_isi_probability_distribution().
+    """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
+
+    # Sensor Mode - Aggregates data across different sensors (trq only)
+    # see batches_sensor_isi_probability_distribution()
+
+    aggregation = isi_aggregation([], neuron_id=neuron_id, afferent_type=afferent_type)
+    return aggregate_probability_distribution(n_bins, sensor_batches, aggregation['trial_data'], neuron_id=neuron_id,
+                                              afferent_type=afferent_type, y_axis_limit=y_axis_limit,
+                                              x_axis_limit=x_axis_limit, plot=plot)
+
+
+def batches_distance_probability_distribution(n_bins, sensor_batches, reference_point=(0, 0), neuron_id=None,
+                                              afferent_type=None, y_axis_limit=1, x_axis_limit=0, plot=True):
+    """
+    Function creates the distance probability distribution of already loaded trials [see load_sensor_batches()].
+    Parameters are as in trial_distance_probabilty_distribution().
+    """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
+
+    aggregation = distance_aggregation([], reference_point=reference_point, neuron_id=neuron_id,
+                                       afferent_type=afferent_type)
+    return aggregate_probability_distribution(n_bins, sensor_batches, aggregation['trial_data'], neuron_id=neuron_id,
+                                              afferent_type=afferent_type, y_axis_limit=y_axis_limit,
+                                              x_axis_limit=x_axis_limit, plot=plot,
+                                              plot_title=aggregation['plot_title'], xlabel=aggregation['xlabel'])
 
-                #  Afferent Mode - Aggregates data from one afferent type across all data ('sa', 'ra', 'pc')
-                elif (afferent_type is not None) and (neuron_id is None):
-                    afferent_spike_locations = afferent_stats[afferent_type]['locations']
 
-                    sa_range, ra_range, pc_range = get_afferent_ranges(afferent_stats)
-                    afferent_range = sa_range if afferent_type == 'sa' else ra_range if afferent_type == 'ra' else pc_range
+def batches_sensor_isi_probability_distribution(n_bins, trial_sensor_batches, neuron_id=None, afferent_type=None,
+                                                y_axis_limit=1, x_axis_limit=0, plot=True):
+    """
+    Sensor Mode - computes the isi probability distribution of every sensor, and of all sensors pooled, on one set
+    of bin edges from already loaded trials [see load_all_sensor_batches()].
+    Unlike probability_heights(), a sensor without any ISI keeps a row of NaN (so rows stay aligned with sensor
+    numbers) and there is no fallback to 10 bins when every value lies above the given edges.
+    :param n_bins:               - number of bins spanning the ISIs of all sensors, or an array of bin edges
+    :param trial_sensor_batches: - one list of (batch, plot label suffix) per trial, one entry per sensor
+    Other parameters are as in trial_isi_probability_distribution().
+    :return: sensors x bins array of heights, heights of the pooled distribution, bin edges
+    """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
+
+    sensor_count = max((len(sensor_batches) for sensor_batches in trial_sensor_batches), default=1)
+    sensor_data = [[] for _ in range(sensor_count)]
+    for sensor_batches in trial_sensor_batches:
+        for sensor_no, (batch, _) in enumerate(sensor_batches):
+            sensor_data[sensor_no].append(batch_isi_data(batch, neuron_id=neuron_id, afferent_type=afferent_type))
+
+    if np.ndim(n_bins) == 0:
+        #  Same edges np.histogram would pick for the pooled ISIs
+        spiked = [data for trial_data in sensor_data for data in trial_data if data.shape[0] > 0]
+        data_range = (min(data.min() for data in spiked), max(data.max() for data in spiked)) if spiked else (0, 1)
+        bin_edges = np.histogram_bin_edges(np.array(data_range, dtype=float), bins=int(n_bins))
+    else:
+        bin_edges = np.asarray(n_bins, dtype=float)
+
+    accumulators = [HistogramAccumulator(bin_edges) for _ in range(sensor_count)]
+    pooled = HistogramAccumulator(bin_edges)
+    for accumulator, trial_data in zip(accumulators, sensor_data):
+        for data in trial_data:
+            accumulator.add(data)
+        pooled.merge(accumulator)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sensor_heights = np.array([accumulator.counts / accumulator.counts.sum() for accumulator in accumulators])
+        pooled_heights = pooled.counts / pooled.counts.sum()
+
+    if plot:
+        for sensor_no, (accumulator, heights) in enumerate(zip(accumulators, sensor_heights)):
+            plotted_data = aggregation_label(accumulator.count, f' | (sensor #{sensor_no})', neuron_id=neuron_id,
+                                             afferent_type=afferent_type)
+            plot_probability_distribution(heights, bin_edges, plotted_data=plotted_data, y_axis_limit=y_axis_limit,
+                                          x_axis_limit=x_axis_limit)
+        plotted_data = aggregation_label(pooled.count, ' | (all sensors)', neuron_id=neuron_id,
+                                         afferent_type=afferent_type)
+        plot_probability_distribution(pooled_heights, bin_edges, plotted_data=plotted_data,
+                                      y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit)
+
+    return sensor_heights, pooled_heights, bin_edges
+
+
+def trial_sensor_isi_probability_distribution(n_bins, data_dir, trial_filenames=[], neuron_id=None,
+                                              afferent_type=None, y_axis_limit=1, x_axis_limit=0, workers=None,
+                                              executor=None, plot=True):
+    """
+    Sensor Mode version of trial_isi_probability_distribution(): every file is loaded once and the distributions
+    of all its sensors are computed on shared bin edges [see batches_sensor_isi_probability_distribution()].
+    :return: sensors x bins array of heights, heights of the pooled distribution, bin edges
+    """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
 
-                    truncated_afferent_range = afferent_spike_locations[min(afferent_range):max(afferent_range) + 1]
+    trial_paths = find_trial_files(data_dir, trial_filenames)
+    trial_sensor_batches = map_trials(load_all_sensor_batches, trial_paths, workers=workers, executor=executor)
 
-                    data = np.zeros((truncated_afferent_range.shape[0],))
-                    spiking_neurons = []
-                    for i in range(data.shape[0]):
-                        spiking_neurons.append(neuron_spiked(afferent_range[i], afferent_stats))  # tracks spikings
-                        data[i] = calculate_magnitude(neuron_x=truncated_afferent_range[i][0],
-                                                      neuron_y=truncated_afferent_range[i][1],
-                                                      center_x=reference_point[0], center_y=reference_point[1])
+    return batches_sensor_isi_probability_distribution(n_bins, trial_sensor_batches, neuron_id=neuron_id,
+                                                       afferent_type=afferent_type, y_axis_limit=y_axis_limit,
+                                                       x_axis_limit=x_axis_limit, plot=plot)
 
-                    data = data[spiking_neurons]  # Drops the neurons that didn't spike
-                    plotted_data = f'[{afferent_type} neurons] | spikes = {data.shape[0]}' + plotted_data
 
-                # Neuron Mode - Aggregates data from a single neuron across several trials
-                elif (neuron_id is not None) and (afferent_type is None):
-                    if not neuron_spiked(neuron_id, afferent_stats):
-                        print(f'Neuron #{neuron_id} did not have an ISI. Returning None.')
-                        return None
+def batches_distance_probability_matrix(n_bins, sensor_batches, reference_points, neuron_id=None, afferent_type=None,
+                                        chunk_size=256):
+    """
+    Function computes the distance probability distribution of already loaded trials [see load_sensor_batches()]
+    for many reference points at once (e.g. a grid of stimulus positions). The locations of the neurons that spiked
+    are collected once per trial, then the distances to chunk_size reference points at a time are computed with
+    one broadcast and histogrammed row by row with a single bincount.
+    Row r equals batches_distance_probability_distribution(n_bins, sensor_batches, reference_points[r], ...) except
+    that a row without data is NaN (not emptied) and there is no fallback to 10 bins for bin edges below every value.
+    :param n_bins:           - number of bins (each row spans its own distance range, as np.histogram would),
+                               or an array of bin edges shared by all rows
+    :param reference_points: - R x 2 array of (x, y) points on the hand coordinate system
+    :return: R x bins array of heights, R x (bins + 1) array of bin edges
+    """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
+
+    trial_locations = []
+    for batch, _ in sensor_batches:
+        locations = batch_spiking_locations(batch, neuron_id=neuron_id, afferent_type=afferent_type)
+        if locations is None:
+            logger.warning('Neuron #%s did not have an ISI. Returning None.', neuron_id)
+            return None
+        trial_locations.append(locations)
+    locations = np.concatenate([np.zeros((0, 2))] + trial_locations)  # Only neurons that spiked are included
+    reference_points = np.asarray(reference_points, dtype=float).reshape(-1, 2)
+
+    shared_edges = np.ndim(n_bins) > 0
+    bin_count = len(n_bins) - 1 if shared_edges else int(n_bins)
+    heights = np.empty((reference_points.shape[0], bin_count))
+    bin_edges = np.empty((reference_points.shape[0], bin_count + 1))
+    for start in range(0, reference_points.shape[0], chunk_size):
+        points = reference_points[start:start + chunk_size]
+        with stage('histogram', spikes=points.shape[0] * locations.shape[0]):
+            distances = calculate_magnitude(neuron_x=locations[None, :, 0], neuron_y=locations[None, :, 1],
+                                            center_x=points[:, 0, None], center_y=points[:, 1, None])
+            if shared_edges:
+                edges = np.broadcast_to(np.asarray(n_bins, dtype=float), (points.shape[0], bin_count + 1))
+                bins = histogram_bin_indices(distances, edges[0])
+            else:
+                edges, bins = row_histogram_bins(distances, bin_count)
+
+            rows = np.broadcast_to(np.arange(points.shape[0])[:, None], bins.shape)
+            inside = bins >= 0
+            counts = np.bincount((rows[inside] * bin_count + bins[inside]),
+                                 minlength=points.shape[0] * bin_count).reshape(points.shape[0], bin_count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            heights[start:start + chunk_size] = counts / counts.sum(axis=1, keepdims=True)
+        bin_edges[start:start + chunk_size] = edges
+
+    return heights, bin_edges
+
+
+def row_histogram_bins(data, bin_count):
+    """
+    Function bins every row of a 2D array on its own bin_count equal-width bins spanning the row's range, exactly
+    as np.histogram(row, bins=bin_count) would, without a Python loop over rows
+    :return: rows x (bin_count + 1) bin edges, bin index of every value
+    """
+    if data.shape[1] == 0:
+        first, last = np.zeros(data.shape[0]), np.ones(data.shape[0])  # np.histogram's range for empty data
+    else:
+        first, last = data.min(axis=1), data.max(axis=1)
+    flat = first == last
+    first, last = np.where(flat, first - 0.5, first), np.where(flat, last + 0.5, last)
+    edges = np.linspace(first, last, bin_count + 1, axis=1)
 
-                    afferent_type = get_afferent_type(neuron_id, afferent_stats)
-                    neuron_location = afferent_stats[afferent_type]['locations'][neuron_id]
-                    neuron_location = calculate_magnitude(neuron_x=neuron_location[0], neuron_y=neuron_location[1],
-                                                          center_x=reference_point[0], center_y=reference_point[1])
+    #  Same computation and edge corrections as np.histogram's uniform-bin path
+    bins = ((data - first[:, None]) * (bin_count / (last - first))[:, None]).astype(np.intp)
+    bins[bins == bin_count] -= 1
+    bins[data < np.take_along_axis(edges, bins, axis=1)] -= 1
+    bins[(data >= np.take_along_axis(edges, bins + 1, axis=1)) & (bins != bin_count - 1)] += 1
+    return edges, bins
 
-                    data = np.hstack((data, neuron_location))
 
-                    plotted_data = f'[ID = {neuron_id}] | spikes = {data.shape[0]}' + plotted_data
-                    afferent_type = None  # Set to None to avoid a warning later in execution
+def trial_distance_probability_matrix(data_dir, trial_filenames, n_bins, reference_points, trq_sensor_no=0,
+                                      neuron_id=None, afferent_type=None, workers=None, executor=None, chunk_size=256):
+    """
+    Multi-reference-point version of trial_distance_probabilty_distribution(): loads the trials once and returns the
+    distance distribution to every point of reference_points [see batches_distance_probability_matrix()]
+    :return: R x bins array of heights, R x (bins + 1) array of bin edges
+    """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
 
-                # General Mode - Takes all data from across all trials neuron_spike_deltas
-                elif (afferent_type is None) and (neuron_id is None):
-                    sa_range, ra_range, pc_range = get_afferent_ranges(afferent_stats)
+    trial_paths = find_trial_files(data_dir, trial_filenames)
+    sensor_batches, = load_sensor_batches([trial_paths], trq_sensor_no=trq_sensor_no, workers=workers,
+                                          executor=executor)
 
-                    sa_distances = afferent_stats['sa']['locations'][min(sa_range):max(sa_range) + 1]
-                    ra_distances = afferent_stats['ra']['locations'][min(ra_range):max(ra_range) + 1]
-                    pc_distances = afferent_stats['pc']['locations'][min(pc_range):max(pc_range) + 1]
+    return batches_distance_probability_matrix(n_bins, sensor_batches, reference_points, neuron_id=neuron_id,
+                                               afferent_type=afferent_type, chunk_size=chunk_size)
 
-                    distances = flatten_arrays((sa_distances, ra_distances, pc_distances)).reshape(-1, 2)
 
-                    neuron_locations = np.zeros((distances.shape[0],))
-                    spiking_neurons = []
-                    for i in range(neuron_locations.shape[0]):
-                        spiking_neurons.append(neuron_spiked(i, afferent_stats))  # keeps a list of neurons that spiked
-                        x_coordinate = distances[i][0]
-                        y_coordinate = distances[i][1]
-                        neuron_locations[i] = calculate_magnitude(neuron_x=x_coordinate, neuron_y=y_coordinate,
-                                                                  center_x=reference_point[0],
-                                                                  center_y=reference_point[1])
+def trial_isi_probability_distribution(n_bins, data_dir, trial_filenames=[], trq_sensor_no=0, neuron_id=None,
+                                       afferent_type=None,
+                                       y_axis_limit=1, x_axis_limit=0, workers=None, executor=None, plot=True):
+    """
+    Function creates isi probability distribtions across several trials.
+    :param n_bins:          - number of histogram bins
+    :param data_dir:        - directory with .mat trial files
+    :param trial_filenames: - custom list of filenames the user would like to specifically pull from (optional)
+    :param trq_sensor_no:   - if using trq sensor data, select the sensor to use (0-2) (optional)
+    :param neuron_id:       - selects this neuron_id across all trials (optional)
+    :param afferent_type:   - selects this afferent type (sa, ra, pc) to compare across trials (optional)
+    :param y_axis_limit:    - sets the upper limit of the y-axis on plots, defaults to 1, set to 0 to scale with data (optional)
+    :param workers:         - load and process trials in this many worker processes; results are merged in file
+                              order, so the distribution is identical to the serial one (optional)
+    :param executor:        - concurrent.futures executor to load trials with instead of workers (optional)
+    :param plot:            - set to False to only compute the distribution (no matplotlib) (optional)
+    """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
 
-                    data = np.hstack((data, neuron_locations[spiking_neurons]))  # Drops the neurons that didn't spike
+    #  Walk through all nested directories and and aggregate/process data from files found in trial_filenames
+    #  (if an empty list is passed for trial_filenames, then all .mat files within data_dir will be used)
+    trial_paths = find_trial_files(data_dir, trial_filenames)
+    heights, = stream_probability_distributions(n_bins, [isi_aggregation(trial_paths, neuron_id=neuron_id,
+                                                                         afferent_type=afferent_type)],
+                                                trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit,
+                                                x_axis_limit=x_axis_limit, workers=workers, executor=executor,
+                                                plot=plot)
 
-                    plotted_data = f'[All afferent types | spikes = {data.shape[0]}]' + plotted_data
+    return heights
 
-    heights = probability_distribution(data, n_bins=n_bins, plotted_data=plotted_data,
-                                       y_axis_limit=y_axis_limit, plot_title='Distance Metric',
-                                       xlabel=f'Distance from point {str(reference_point)}')
+
+def trial_distance_probabilty_distribution(data_dir, trial_filenames, n_bins, reference_point=(0, 0), trq_sensor_no=0,
+                                           neuron_id=None,
+                                           afferent_type=None, y_axis_limit=1, x_axis_limit=0, workers=None,
+                                           executor=None, plot=True):
+    """
+        Function creates probability distributions for distance from stimulus across several trials.
+        :param n_bins:          - number of histogram bins to group data into
+        :param reference_point: - tuple; representing the coordinates of a stimulus on the hand coordinate system
+        :param data_dir:        - directory with .mat trial files
+        :param trial_filenames: - custom list of filenames the user would like to specifically pull from (optional)
+        :param trq_sensor_no:   - if using trq sensor data, select the sensor to use (0-2) (optional)
+        :param neuron_id:       - selects this neuron_id across all trials (optional)
+        :param afferent_type:   - selects this afferent type (sa, ra, pc) to compare across trials (optional)
+        :param y_axis_limit:    - sets the upper limit of the y-axis on plots, defaults to 1, set to 0 to scale with data (optional)
+        :param x_axis_limit:    - sets the upper limit of the x-axis on plots, defaults to 0 which scales the axis with the data
+        :param workers:         - load and process trials in this many worker processes; results are merged in file
+                                  order, so the distribution is identical to the serial one (optional)
+        :param executor:        - concurrent.futures executor to load trials with instead of workers (optional)
+        :param plot:            - set to False to only compute the distribution (no matplotlib) (optional)
+        """
+    if not valid_aggregation_mode(neuron_id, afferent_type):
+        return None
+
+    #  Walk through all nested directories and and aggregate/process data from files found in trial_filenames
+    #  (if an empty list is passed for trial_filenames, then all .mat files within data_dir will be used)
+    trial_paths = find_trial_files(data_dir, trial_filenames)
+    heights, = stream_probability_distributions(n_bins, [distance_aggregation(trial_paths,
+                                                                              reference_point=reference_point,
+                                                                              neuron_id=neuron_id,
+                                                                              afferent_type=afferent_type)],
+                                                trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit,
+                                                x_axis_limit=x_axis_limit, workers=workers, executor=executor,
+                                                plot=plot)
 
     return heights
 
 
 def kl_divergence(p, q):
-    p[p == 0] = 1e-10
-    q[q == 0] = 1e-10
+    """
+    Function returns the symmetric KL divergence of two probability distributions on the same bins. Empty bins are
+    counted as 1e-10 so the logs stay finite; p and q themselves are left untouched.
+    """
+    with stage('kl'):
+        p = np.where(np.asarray(p) == 0, 1e-10, p)
+        q = np.where(np.asarray(q) == 0, 1e-10, q)
 
-    kl_div_pq = np.sum(np.multiply(p, np.log(p) - np.log(q)))
-    kl_div_qp = np.sum(np.multiply(q, np.log(q) - np.log(p)))
+        kl_div_pq = np.sum(np.multiply(p, np.log(p) - np.log(q)))
+        kl_div_qp = np.sum(np.multiply(q, np.log(q) - np.log(p)))
 
     return kl_div_pq + kl_div_qp
+
+
+def neuron_isi_histograms(sensor_batches, n_bins=30, afferent_type=None):
+    """
+    Function histograms the ISIs of every neuron of already loaded trials [see load_sensor_batches()] in one pass,
+    on a single set of bin edges shared by all neurons so that the rows can be compared with each other.
+    :param sensor_batches: list of (batch, plot label suffix) as returned by load_sensor_batches()
+    :param n_bins:         number of bins spanning the ISIs of the selected neurons, or an array of bin edges
+    :param afferent_type:  only histogram the neurons of this afferent type (sa, ra, pc) (optional)
+    :return: neurons x bins count matrix, neuron ID of each row, bin edges
+    """
+    batches = [batch for batch, _ in sensor_batches]
+    if len({batch['fire_count'].shape[0] for batch in batches}) != 1:
+        logger.error('Trials must come from the same afferent population to compare their neurons. Returning None.')
+        return None
+
+    if afferent_type is not None:
+        selected = batches[0]['masks'][afferent_type]
+    else:
+        selected = batches[0]['afferent_class'] >= 0
+    neuron_ids = np.flatnonzero(selected)
+    rows = np.arange(neuron_ids.shape[0])
+
+    spike_deltas = [batch_spike_deltas(batch, selected) for batch in batches]
+    if np.ndim(n_bins) == 0:
+        #  Same edges np.histogram would pick for all the selected ISIs at once
+        spiked = [deltas for deltas in spike_deltas if deltas.shape[0] > 0]
+        data_range = (min(deltas.min() for deltas in spiked), max(deltas.max() for deltas in spiked)) if spiked else (0, 1)
+        bin_edges = np.histogram_bin_edges(np.array(data_range, dtype=float), bins=int(n_bins))
+    else:
+        bin_edges = np.asarray(n_bins, dtype=float)
+    bin_count = bin_edges.shape[0] - 1
+
+    counts = np.zeros(neuron_ids.shape[0] * bin_count, dtype=np.int64)
+    for batch, deltas in zip(batches, spike_deltas):
+        with stage('histogram', spikes=deltas.shape[0]):
+            delta_rows = np.repeat(rows, np.diff(batch['delta_offsets'])[selected])
+            bins = histogram_bin_indices(deltas, bin_edges)
+            inside = bins >= 0
+            counts += np.bincount(delta_rows[inside] * bin_count + bins[inside], minlength=counts.shape[0])
+
+    return counts.reshape(neuron_ids.shape[0], bin_count), neuron_ids, bin_edges
+
+
+def kl_divergence_matrix(distributions, chunk_size=1024):
+    """
+    Function computes kl_divergence() between every pair of rows of a distributions x bins matrix.
+    With a = sum(p * log p) per row, KL(i, j) = a_i + a_j - P_i.log(P_j) - log(P_i).P_j, so each chunk_size x chunk_size
+    block of the result is two matrix products; only the upper triangle of blocks is computed and then mirrored.
+    Memory beyond the n x n result stays at a few chunk_size x chunk_size blocks.
+    :param distributions: n x bins array, one probability distribution per row (rows of NaN give NaN divergences)
+    :return: symmetric n x n array of KL divergences
+    """
+    with stage('kl'):
+        p = np.asarray(distributions, dtype=float)
+        p = np.where(p == 0, 1e-10, p)
+        log_p = np.log(p)
+        self_terms = np.einsum('ij,ij->i', p, log_p)
+
+        n = p.shape[0]
+        kl = np.empty((n, n))
+        for row_start in range(0, n, chunk_size):
+            rows = slice(row_start, min(row_start + chunk_size, n))
+            for col_start in range(row_start, n, chunk_size):
+                cols = slice(col_start, min(col_start + chunk_size, n))
+                block = self_terms[rows, None] + self_terms[None, cols]
+                block -= p[rows] @ log_p[cols].T
+                block -= log_p[rows] @ p[cols].T
+                if col_start == row_start:
+                    block = (block + block.T) / 2  # the two products round differently
+                kl[rows, cols] = block
+                kl[cols, rows] = block.T
+
+        np.maximum(kl, 0, out=kl)  # clip round-off below zero
+        diagonal = np.arange(n)
+        kl[diagonal, diagonal] = np.where(np.isnan(kl[diagonal, diagonal]), np.nan, 0)
+    return kl
+
+
+def neuron_kl_matrix(sensor_batches, n_bins=30, afferent_type=None, chunk_size=1024):
+    """
+    Function computes the KL divergence between the ISI distributions of every pair of neurons of already loaded
+    trials [see load_sensor_batches()]. Each neuron is histogrammed once on shared bin edges
+    [see neuron_isi_histograms()]; neurons without an ISI get NaN rows and columns.
+    :param n_bins:        number of bins spanning the ISIs of the selected neurons, or an array of bin edges
+    :param afferent_type: only compare the neurons of this afferent type (sa, ra, pc) (optional)
+    :param chunk_size:    block size of the pairwise computation [see kl_divergence_matrix()]
+    :return: neurons x neurons KL matrix, neuron ID of each row/column, bin edges
+    """
+    histograms = neuron_isi_histograms(sensor_batches, n_bins=n_bins, afferent_type=afferent_type)
+    if histograms is None:
+        return None
+    counts, neuron_ids, bin_edges = histograms
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        distributions = counts / counts.sum(axis=1, keepdims=True)
+
+    return kl_divergence_matrix(distributions, chunk_size=chunk_size), neuron_ids, bin_edges
@@ -0,0 +1,233 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from TouchSimMat2Python_Loader import TouchSimMat2Python, LOADER_VERSION
+from instrumentation import get_logger
+
+logger = get_logger('trialcache')
+
+#  Fields of a TouchSimMat2Python() sensor dictionary that the analysis tools need. Only these are cached;
+#  the full metadata/stimulus trees are left out so a cached trial is a handful of flat arrays.
+TRIAL_FIELDS = ('spike_times', 'spike_offsets', 'n_timestamps', 'afferent_class', 'locations', 'depths', 'rates',
+                'sensor_type', 'sensor_no')
+
+DEFAULT_CACHE_DIR = os.environ.get('BLAST_TOOLS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'blast-tools'))
+DEFAULT_MEMORY_LIMIT = 512 * 2 ** 20  # bytes
+DEFAULT_DISK_LIMIT = 4 * 2 ** 30  # bytes
+
+
+class TrialCache:
+    """
+    Two-tier cache of parsed TouchSim trials so a repeat analysis never goes back through scipy's MAT parser.
+    Entries are keyed by the file's absolute path, size, mtime and the loader version, so editing or
+    replacing a .mat file (or changing the loader) simply misses the cache.
+    * memory tier - least recently used trials, bounded by memory_limit bytes
+    * disk tier   - one uncompressed .npz per trial in cache_dir, least recently used files are evicted once the
+                    directory grows past disk_limit bytes. Pass cache_dir=None for a memory-only cache.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, memory_limit=DEFAULT_MEMORY_LIMIT, disk_limit=DEFAULT_DISK_LIMIT):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()  # key -> (sensors, nbytes)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        #  Running size of the disk tier, so a write only scans the directory once it may be over disk_limit
+        self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    @staticmethod
+    def key(path):
+        """
+        Identity of a trial file: absolute path, size, mtime and loader version
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        identity = f'{path}|{stat.st_size}|{stat.st_mtime_ns}|{LOADER_VERSION}'
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def load(self, data_dir, file):
+        """
+        Drop-in for TouchSimMat2Python(data_dir, file) restricted to TRIAL_FIELDS
+        """
+        key = self.key(str(data_dir + file))
+        sensors = self.get(key)
+        if sensors is None:
+            self.misses += 1
+            sensors = [{field: sensor[field] for field in TRIAL_FIELDS}
+                       for sensor in TouchSimMat2Python(data_dir, file, full=False)]
+            self.put(key, sensors)
+        else:
+            self.hits += 1
+        return sensors
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0]
+
+        sensors = self._read_disk(key)
+        if sensors is not None:
+            self._put_memory(key, sensors)
+        return sensors
+
+    def put(self, key, sensors):
+        self._put_memory(key, sensors)
+        self._write_disk(key, sensors)
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if disk and self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for entry in os.listdir(self.cache_dir):
+                if entry.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, entry))
+            with self._lock:
+                self._disk_bytes = 0
+
+    def _put_memory(self, key, sensors):
+        nbytes = sum(np.asarray(sensor[field]).nbytes for sensor in sensors for field in TRIAL_FIELDS)
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= self._memory.pop(key)[1]
+            self._memory[key] = (sensors, nbytes)
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+                _, (_, evicted_bytes) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_bytes
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _read_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                sensors = []
+                for sensor_no in range(int(arrays['sensor_count'])):
+                    sensor = {field: arrays[f'{sensor_no}/{field}'] for field in TRIAL_FIELDS}
+                    sensor['n_timestamps'] = int(sensor['n_timestamps'])
+                    sensor['sensor_no'] = int(sensor['sensor_no'])
+                    sensor['sensor_type'] = str(sensor['sensor_type'])
+                    sensors.append(sensor)
+            os.utime(path)  # mtime doubles as the last-used time for eviction
+        except (OSError, KeyError, ValueError):
+            return None
+        return sensors
+
+    def _write_disk(self, key, sensors):
+        if self.cache_dir is None:
+            return
+        arrays = {'sensor_count': np.array(len(sensors))}
+        for sensor_no, sensor in enumerate(sensors):
+            for field in TRIAL_FIELDS:
+                arrays[f'{sensor_no}/{field}'] = np.asarray(sensor[field])
+        path = self._disk_path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.savez(tmp_file, **arrays)
+            size = os.path.getsize(tmp_path)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)  # atomic, so readers never see a partial entry
+        except OSError as err:
+            logger.warning('could not write trial cache entry to %s (%s).', self.cache_dir, err)
+            return
+        with self._lock:
+            self._disk_bytes += size - replaced
+            over_limit = self._disk_bytes > self.disk_limit
+        if not over_limit:
+            return
+        try:
+            self._evict_disk()
+        except OSError as err:  # cache maintenance must never fail a load
+            logger.warning('could not evict trial cache entries from %s (%s).', self.cache_dir, err)
+
+    def _disk_entries(self):
+        """
+        (mtime, size, path) of every entry of the disk tier; entries removed during the scan are skipped
+        """
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:  # removed by another process sharing the cache
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def _evict_disk(self):
+        #  The directory may be shared with other processes, so the running total is re-synced from the scan
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+
+_trial_cache = None
+
+
+def get_trial_cache():
+    """
+    Returns the process-wide TrialCache used by spiketrainanalysis.load_isi_stats()
+    """
+    global _trial_cache
+    if _trial_cache is None:
+        _trial_cache = TrialCache()
+    return _trial_cache
+
+
+def configure_trial_cache(cache_dir=DEFAULT_CACHE_DIR, memory_limit=DEFAULT_MEMORY_LIMIT, disk_limit=DEFAULT_DISK_LIMIT):
+    """
+    Replaces the process-wide TrialCache, e.g. configure_trial_cache(cache_dir=None) for a memory-only cache
+    """
+    global _trial_cache
+    _trial_cache = TrialCache(cache_dir=cache_dir, memory_limit=memory_limit, disk_limit=disk_limit)
+    return _trial_cache
+
+
+def load_trial(data_dir, file):
+    """
+    Cached equivalent of TouchSimMat2Python(data_dir, file) (only TRIAL_FIELDS are returned)
+    """
+    return get_trial_cache().load(data_dir, file)
@@ -0,0 +1,232 @@
+"""
+Christophe J. Brown
+August 2020
+
+Copyright 2020 The Johns Hopkins University Applied Physics Laboratory
+
+Licensed under the MIT License (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://opensource.org/licenses/MIT
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import re
+import hashlib
+import tempfile
+import numpy as np
+from trialcache import DEFAULT_CACHE_DIR
+from TouchSimMat2Python_Loader import is_trial_file
+from instrumentation import get_logger
+
+logger = get_logger('trialcatalog')
+
+OBJECT_PATTERN = re.compile(r'object_([^_.]+)')
+DIM_PATTERN = re.compile(r'dim_(\d+)')
+TRIAL_PATTERN = re.compile(r'trial_(\d+)')
+NEGATIVE_NOISE_PATTERN = re.compile(r'minus(\d+)')
+POSITIVE_NOISE_PATTERN = re.compile(r'noise_(\d+)')
+MISSING = -1  # dim/trial value for files that do not name one
+CATALOG_VERSION = 1
+
+
+def parse_trial_path(directory, file):
+    """
+    Parses the experimental conditions out of a trial's path
+    :return: sensor ('trq', 'ftsn' or ''), object (str, '' if missing), dim, trial (int, MISSING if missing),
+             noise level in dB (float, nan if the directory is not a noise_*/minus* directory)
+    """
+    sensor = 'trq' if 'trq' in file else 'ftsn' if 'ftsn' in file else ''  # same rule as TouchSimMat2Python()
+    obj = OBJECT_PATTERN.search(file)
+    dim = DIM_PATTERN.search(file)
+    trial = TRIAL_PATTERN.search(file)
+    negative_noise = NEGATIVE_NOISE_PATTERN.search(directory)
+    positive_noise = POSITIVE_NOISE_PATTERN.search(directory)
+    if negative_noise:
+        noise = -float(negative_noise.group(1))
+    elif positive_noise:
+        noise = float(positive_noise.group(1))
+    else:
+        noise = np.nan
+
+    return (sensor, obj.group(1) if obj else '', int(dim.group(1)) if dim else MISSING,
+            int(trial.group(1)) if trial else MISSING, noise)
+
+
+def select_trials(table, noise=None, sensor=None, obj=None, dim=None, trial=None):
+    """
+    Boolean mask over the rows of a trial table (parallel numpy columns noise, sensor, object, dim, trial) matching
+    every condition given. Each condition is a single value or a list of accepted values; None matches anything.
+    """
+    mask = np.ones(len(table['noise']), dtype=bool)
+    for column, value in (('noise', noise), ('sensor', sensor), ('object', obj), ('dim', dim), ('trial', trial)):
+        if value is None:
+            continue
+        values = np.atleast_1d(value)
+        if column == 'object':
+            values = values.astype(str)
+        mask &= np.isin(table[column], values)
+    return mask
+
+
+class TrialCatalog:
+    """
+    Index of every .mat trial below data_dir, built once and refreshed incrementally. Outputs still being written
+    (PARTIAL_SUFFIX files) are never listed.
+    The table is a set of parallel numpy columns (one row per trial):
+        directory - index into self.directories (absolute paths)
+        file      - filename
+        sensor    - 'trq' / 'ftsn'
+        object    - object name/number as a string
+        dim       - int (MISSING if not in the filename)
+        trial     - int (MISSING if not in the filename)
+        noise     - float dB, negative for minus* directories (nan if not in a noise directory)
+    The index is saved under index_path. refresh() only stats directories and re-lists the ones whose
+    mtime changed, so an unchanged archive is never walked file by file again.
+    """
+
+    def __init__(self, data_dir, index_path=None):
+        self.data_dir = os.path.abspath(data_dir)
+        if index_path is None:
+            digest = hashlib.sha1(self.data_dir.encode()).hexdigest()
+            index_path = os.path.join(DEFAULT_CACHE_DIR, 'catalogs', digest + '.npz')
+        self.index_path = index_path
+        self._listings = {}  # directory -> (mtime_ns, files, subdirectories)
+        self.directories = []
+        self.table = {}
+        self._load_index()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.table['file'])
+
+    def refresh(self):
+        """
+        Re-lists directories whose mtime changed since the last refresh and rebuilds the table if anything changed
+        """
+        listings = {}
+        changed = False
+        stack = [self.data_dir]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                changed = True
+                continue
+            listing = self._listings.get(directory)
+            if listing is None or listing[0] != mtime:
+                files, subdirectories = [], []
+                for entry in os.scandir(directory):
+                    if entry.is_dir():
+                        subdirectories.append(entry.name)
+                    elif is_trial_file(entry.name):
+                        files.append(entry.name)
+                listing = (mtime, sorted(files), sorted(subdirectories))
+                changed = True
+            listings[directory] = listing
+            stack.extend(os.path.join(directory, subdirectory) for subdirectory in reversed(listing[2]))
+
+        if changed or len(listings) != len(self._listings):
+            self._listings = listings
+            self._build_table()
+            self._save_index()
+        return self
+
+    def _build_table(self):
+        self.directories = sorted(self._listings)
+        rows = []
+        for directory_no, directory in enumerate(self.directories):
+            for file in self._listings[directory][1]:
+                rows.append((directory_no, file) + parse_trial_path(directory, file))
+        columns = list(zip(*rows)) if rows else [()] * 7
+        self.table = {'directory': np.array(columns[0], dtype=np.int32),
+                      'file': np.array(columns[1], dtype=str),
+                      'sensor': np.array(columns[2], dtype=str),
+                      'object': np.array(columns[3], dtype=str),
+                      'dim': np.array(columns[4], dtype=np.int32),
+                      'trial': np.array(columns[5], dtype=np.int32),
+                      'noise': np.array(columns[6], dtype=float)}
+
+    def select(self, noise=None, sensor=None, obj=None, dim=None, trial=None):
+        """
+        Boolean mask over the table rows matching every condition given [see select_trials()]
+        """
+        return select_trials(self.table, noise=noise, sensor=sensor, obj=obj, dim=dim, trial=trial)
+
+    def query(self, noise=None, sensor=None, obj=None, dim=None, trial=None):
+        """
+        Full paths of the trials matching the conditions [see select()], ready to pass as trial_filenames to the
+        spiketrainanalysis loaders, e.g. catalog.query(noise=-6, sensor='ftsn', obj=1, dim=2)
+        """
+        return self.paths(self.select(noise=noise, sensor=sensor, obj=obj, dim=dim, trial=trial))
+
+    def paths(self, mask=None):
+        rows = np.flatnonzero(mask) if mask is not None else range(len(self))
+        return [os.path.join(self.directories[self.table['directory'][row]], self.table['file'][row]) for row in rows]
+
+    def trial_files(self):
+        """
+        (directory, file) pairs of every trial, directories ending in '/' as the loaders expect
+        """
+        return [(self.directories[directory] + '/', file)
+                for directory, file in zip(self.table['directory'], self.table['file'])]
+
+    def _load_index(self):
+        try:
+            with np.load(self.index_path, allow_pickle=False) as index:
+                if int(index['version']) != CATALOG_VERSION or str(index['data_dir']) != self.data_dir:
+                    return
+                directories = index['directories'].tolist()
+                mtimes = index['mtimes'].tolist()
+                files = np.split(index['files'], index['file_offsets'][1:-1])
+                subdirectories = np.split(index['subdirectories'], index['subdirectory_offsets'][1:-1])
+        except (OSError, KeyError, ValueError):
+            return
+        self._listings = {directory: (mtime, file_list.tolist(), subdirectory_list.tolist())
+                          for directory, mtime, file_list, subdirectory_list
+                          in zip(directories, mtimes, files, subdirectories)}
+        self._build_table()
+
+    def _save_index(self):
+        directories = sorted(self._listings)
+        files = [self._listings[directory][1] for directory in directories]
+        subdirectories = [self._listings[directory][2] for directory in directories]
+        index = {'version': np.array(CATALOG_VERSION),
+                 'data_dir': np.array(self.data_dir),
+                 'directories': np.array(directories, dtype=str),
+                 'mtimes': np.array([self._listings[directory][0] for directory in directories], dtype=np.int64),
+                 'files': np.array([file for file_list in files for file in file_list], dtype=str),
+                 'file_offsets': np.cumsum([0] + [len(file_list) for file_list in files]),
+                 'subdirectories': np.array([name for names in subdirectories for name in names], dtype=str),
+                 'subdirectory_offsets': np.cumsum([0] + [len(names) for names in subdirectories])}
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.savez(tmp_file, **index)
+            os.replace(tmp_path, self.index_path)
+        except OSError as err:
+            logger.warning('could not save trial catalog to %s (%s).', self.index_path, err)
+
+
+_catalogs = {}
+
+
+def get_trial_catalog(data_dir):
+    """
+    Returns the (refreshed) TrialCatalog of data_dir, reusing the one already open in this process
+    """
+    key = os.path.abspath(data_dir)
+    if key not in _catalogs:
+        _catalogs[key] = TrialCatalog(data_dir)
+    else:
+        _catalogs[key].refresh()
+    return _catalogs[key]
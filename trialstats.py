@@ -20,154 +20,201 @@ limitations under the License.
 import os
 import re
 import spiketrainanalysis as sta
+import spikedistance as sd
+import noisesweep as ns
+import resampling as rs
 import numpy as np
+from trialcatalog import get_trial_catalog
 
 
-def compare_neuron(data_dir, trials, neuron1, neuron2, n_bins=30, trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0):
-    neuron1_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                          data_dir=data_dir,
-                                                          trial_filenames=trials,
-                                                          trq_sensor_no=trq_sensor_no,
-                                                          neuron_id=neuron1,
-                                                          afferent_type=None,
-                                                          y_axis_limit=y_axis_limit,
-                                                          x_axis_limit=x_axis_limit)
-
-    neuron2_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                          data_dir=data_dir,
-                                                          trial_filenames=trials,
-                                                          trq_sensor_no=trq_sensor_no,
-                                                          neuron_id=neuron2,
-                                                          afferent_type=None,
-                                                          y_axis_limit=y_axis_limit,
-                                                          x_axis_limit=x_axis_limit)
+def load_trial_sets(trial_sets, trq_sensor_no=0, workers=None):
+    """
+    Loads every (data_dir, trial_filenames) set of a comparison in a single pass. A file that belongs to several
+    sets is loaded and reduced once, and every distribution of the comparison is computed from the shared result.
+    Returns one list of sensor batches per set [see spiketrainanalysis.load_sensor_batches()].
+    """
+    trial_path_sets = [sta.find_trial_files(data_dir, trial_filenames) for data_dir, trial_filenames in trial_sets]
+    return sta.load_sensor_batches(trial_path_sets, trq_sensor_no=trq_sensor_no, workers=workers)
+
+
+def compare_neuron(data_dir, trials, neuron1, neuron2, n_bins=30, trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0,
+                   workers=None, plot=True):
+    trial_paths = sta.find_trial_files(data_dir, trials)
+
+    neuron1_dist, neuron2_dist = sta.stream_probability_distributions(
+        n_bins, [sta.isi_aggregation(trial_paths, neuron_id=neuron1),
+                 sta.isi_aggregation(trial_paths, neuron_id=neuron2)],
+        trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, workers=workers, plot=plot)
 
     kl_divergence = sta.kl_divergence(p=neuron1_dist, q=neuron2_dist)
     return kl_divergence
 
 
+def compare_all_neurons(data_dir, trials, n_bins=30, afferent_type=None, trq_sensor_no=0, workers=None,
+                        chunk_size=1024):
+    """
+    All-pairs version of compare_neuron(): loads the trials once and returns the KL divergence between the ISI
+    distributions of every pair of neurons (optionally only those of afferent_type), computed on bin edges shared
+    by all neurons [see spiketrainanalysis.neuron_kl_matrix()].
+    :return: neurons x neurons KL matrix, neuron ID of each row/column
+    """
+    sensor_batches, = load_trial_sets([(data_dir, trials)], trq_sensor_no=trq_sensor_no, workers=workers)
+
+    result = sta.neuron_kl_matrix(sensor_batches, n_bins=n_bins, afferent_type=afferent_type, chunk_size=chunk_size)
+    if result is None:
+        return None
+    kl_matrix, neuron_ids, _ = result
+    return kl_matrix, neuron_ids
+
+
 def compare_afferent(data_dir, trials, afferent1, afferent2, n_bins=30, trq_sensor_no=0, y_axis_limit=1,
-                     x_axis_limit=0):
-    afferent1_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                            data_dir=data_dir,
-                                                            trial_filenames=trials,
-                                                            trq_sensor_no=trq_sensor_no,
-                                                            neuron_id=None,
-                                                            afferent_type=afferent1,
-                                                            y_axis_limit=y_axis_limit,
-                                                            x_axis_limit=x_axis_limit)
-
-    afferent2_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                            data_dir=data_dir,
-                                                            trial_filenames=trials,
-                                                            trq_sensor_no=trq_sensor_no,
-                                                            neuron_id=None,
-                                                            afferent_type=afferent2,
-                                                            y_axis_limit=y_axis_limit,
-                                                            x_axis_limit=x_axis_limit)
+                     x_axis_limit=0, workers=None, plot=True):
+    trial_paths = sta.find_trial_files(data_dir, trials)
+
+    afferent1_dist, afferent2_dist = sta.stream_probability_distributions(
+        n_bins, [sta.isi_aggregation(trial_paths, afferent_type=afferent1),
+                 sta.isi_aggregation(trial_paths, afferent_type=afferent2)],
+        trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, workers=workers, plot=plot)
 
     kl_divergence = sta.kl_divergence(p=afferent1_dist, q=afferent2_dist)
     return kl_divergence
 
 
 def compare_response(data_dir, response_set1=[], response_set2=[], n_bins=30, neuron=None, afferent_type=None,
-                     trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0):
-    response1_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                            data_dir=data_dir,
-                                                            trial_filenames=response_set1,
-                                                            trq_sensor_no=trq_sensor_no,
-                                                            neuron_id=neuron,
-                                                            afferent_type=afferent_type,
-                                                            y_axis_limit=y_axis_limit,
-                                                            x_axis_limit=x_axis_limit)
-
-    response2_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                            data_dir=data_dir,
-                                                            trial_filenames=response_set2,
-                                                            trq_sensor_no=trq_sensor_no,
-                                                            neuron_id=neuron,
-                                                            afferent_type=afferent_type,
-                                                            y_axis_limit=y_axis_limit,
-                                                            x_axis_limit=x_axis_limit)
+                     trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0, workers=None, plot=True):
+    response1_paths = sta.find_trial_files(data_dir, response_set1)
+    response2_paths = sta.find_trial_files(data_dir, response_set2)
+
+    response1_dist, response2_dist = sta.stream_probability_distributions(
+        n_bins, [sta.isi_aggregation(response1_paths, neuron_id=neuron, afferent_type=afferent_type),
+                 sta.isi_aggregation(response2_paths, neuron_id=neuron, afferent_type=afferent_type)],
+        trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, workers=workers, plot=plot)
 
     kl_divergence = sta.kl_divergence(p=response1_dist, q=response2_dist)
     return kl_divergence
 
 
 def compare_trial(data_dir, trial_set1=[], trial_set2=[], n_bins=30, neuron=None, afferent_type=None, trq_sensor_no=0,
-                  y_axis_limit=1, x_axis_limit=0):
-    trial1_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                         data_dir=data_dir,
-                                                         trial_filenames=trial_set1,
-                                                         trq_sensor_no=trq_sensor_no,
-                                                         neuron_id=neuron,
-                                                         afferent_type=afferent_type,
-                                                         y_axis_limit=y_axis_limit,
-                                                         x_axis_limit=x_axis_limit)
-
-    trial2_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                         data_dir=data_dir,
-                                                         trial_filenames=trial_set2,
-                                                         trq_sensor_no=trq_sensor_no,
-                                                         neuron_id=neuron,
-                                                         afferent_type=afferent_type,
-                                                         y_axis_limit=y_axis_limit,
-                                                         x_axis_limit=x_axis_limit)
+                  y_axis_limit=1, x_axis_limit=0, workers=None, plot=True):
+    trial1_paths = sta.find_trial_files(data_dir, trial_set1)
+    trial2_paths = sta.find_trial_files(data_dir, trial_set2)
+
+    trial1_dist, trial2_dist = sta.stream_probability_distributions(
+        n_bins, [sta.isi_aggregation(trial1_paths, neuron_id=neuron, afferent_type=afferent_type),
+                 sta.isi_aggregation(trial2_paths, neuron_id=neuron, afferent_type=afferent_type)],
+        trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, workers=workers, plot=plot)
 
     kl_divergence = sta.kl_divergence(p=trial1_dist, q=trial2_dist)
     return kl_divergence
 
 
+def compare_sensors(data_dir, trials, n_bins=30, neuron=None, afferent_type=None, y_axis_limit=1, x_axis_limit=0,
+                    workers=None, plot=True):
+    """
+    Loads each (trq) trial once and compares the ISI distributions of all its sensors with each other
+    [see spiketrainanalysis.trial_sensor_isi_probability_distribution()]
+    :return: sensors x sensors KL divergence matrix, sensors x bins heights, pooled heights, bin edges
+    """
+    result = sta.trial_sensor_isi_probability_distribution(n_bins, data_dir, trials, neuron_id=neuron,
+                                                           afferent_type=afferent_type, y_axis_limit=y_axis_limit,
+                                                           x_axis_limit=x_axis_limit, workers=workers, plot=plot)
+    if result is None:
+        return None
+    sensor_heights, pooled_heights, bin_edges = result
+
+    return sta.kl_divergence_matrix(sensor_heights), sensor_heights, pooled_heights, bin_edges
+
+
 def compare_noise(noise_dir1, noise_dir2, noise_set1=[], noise_set2=[], n_bins=30, neuron=None, afferent_type=None,
-                  trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0):
-    noise1_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                         data_dir=noise_dir1,
-                                                         trial_filenames=noise_set1,
-                                                         trq_sensor_no=trq_sensor_no,
-                                                         neuron_id=neuron,
-                                                         afferent_type=afferent_type,
-                                                         y_axis_limit=y_axis_limit,
-                                                         x_axis_limit=x_axis_limit)
-
-    noise2_dist = sta.trial_isi_probability_distribution(n_bins=n_bins,
-                                                         data_dir=noise_dir2,
-                                                         trial_filenames=noise_set2,
-                                                         trq_sensor_no=trq_sensor_no,
-                                                         neuron_id=neuron,
-                                                         afferent_type=afferent_type,
-                                                         y_axis_limit=y_axis_limit,
-                                                         x_axis_limit=x_axis_limit)
+                  trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0, workers=None, plot=True):
+    noise1_paths = sta.find_trial_files(noise_dir1, noise_set1)
+    noise2_paths = sta.find_trial_files(noise_dir2, noise_set2)
+
+    noise1_dist, noise2_dist = sta.stream_probability_distributions(
+        n_bins, [sta.isi_aggregation(noise1_paths, neuron_id=neuron, afferent_type=afferent_type),
+                 sta.isi_aggregation(noise2_paths, neuron_id=neuron, afferent_type=afferent_type)],
+        trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, workers=workers, plot=plot)
 
     kl_divergence = sta.kl_divergence(p=noise1_dist, q=noise2_dist)
     return kl_divergence
 
 
 def compare_location(data_dir, location_set=[], ref1=(0, 0), ref2=(0, 0), n_bins=30, neuron=None,
-                     afferent_type=None, trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0):
-    distance_dist1 = sta.trial_distance_probabilty_distribution(data_dir=data_dir,
-                                                                trial_filenames=location_set,
-                                                                n_bins=n_bins,
-                                                                reference_point=ref1,
-                                                                trq_sensor_no=trq_sensor_no,
-                                                                neuron_id=neuron,
-                                                                afferent_type=afferent_type,
-                                                                y_axis_limit=y_axis_limit,
-                                                                x_axis_limit=x_axis_limit)
-
-    distance_dist2 = sta.trial_distance_probabilty_distribution(data_dir=data_dir,
-                                                                trial_filenames=location_set,
-                                                                n_bins=n_bins,
-                                                                reference_point=ref2,
-                                                                trq_sensor_no=trq_sensor_no,
-                                                                neuron_id=neuron,
-                                                                afferent_type=afferent_type,
-                                                                y_axis_limit=y_axis_limit,
-                                                                x_axis_limit=x_axis_limit)
+                     afferent_type=None, trq_sensor_no=0, y_axis_limit=1, x_axis_limit=0, workers=None, plot=True):
+    trial_paths = sta.find_trial_files(data_dir, location_set)
+
+    distance_dist1, distance_dist2 = sta.stream_probability_distributions(
+        n_bins, [sta.distance_aggregation(trial_paths, reference_point=ref1, neuron_id=neuron,
+                                          afferent_type=afferent_type),
+                 sta.distance_aggregation(trial_paths, reference_point=ref2, neuron_id=neuron,
+                                          afferent_type=afferent_type)],
+        trq_sensor_no=trq_sensor_no, y_axis_limit=y_axis_limit, x_axis_limit=x_axis_limit, workers=workers, plot=plot)
 
     kl_divergence = sta.kl_divergence(p=distance_dist1, q=distance_dist2)
     return kl_divergence
 
 
+def compare_locations(data_dir, location_set=[], reference_points=((0, 0),), n_bins=30, neuron=None,
+                      afferent_type=None, trq_sensor_no=0, workers=None):
+    """
+    Many-point version of compare_location(): loads the trials once, computes the distance distribution to every
+    point of reference_points in one pass [see spiketrainanalysis.batches_distance_probability_matrix()] and
+    returns the KL divergence between every pair of points
+    :return: R x R KL divergence matrix, R x bins heights, R x (bins + 1) bin edges
+    """
+    sensor_batches, = load_trial_sets([(data_dir, location_set)], trq_sensor_no=trq_sensor_no, workers=workers)
+
+    result = sta.batches_distance_probability_matrix(n_bins, sensor_batches, reference_points, neuron_id=neuron,
+                                                     afferent_type=afferent_type)
+    if result is None:
+        return None
+    heights, bin_edges = result
+
+    return sta.kl_divergence_matrix(heights), heights, bin_edges
+
+
+def compare_significance(data_dir, trial_set1=[], trial_set2=[], n_bins=30, neuron=None, afferent_type=None,
+                         trq_sensor_no=0, n_permutations=1000, n_bootstrap=1000, confidence=0.95, by_trial=True, seed=0,
+                         workers=None):
+    """
+    Loads two trial sets once and tests whether their ISI distributions differ: trial-label permutation p-value and
+    bootstrap confidence interval of the KL divergence [see resampling.kl_significance()]
+    :return: dictionary with kl, p_value, ci, permutation_kl, bootstrap_kl and bin_edges
+    """
+    batches1, batches2 = load_trial_sets([(data_dir, trial_set1), (data_dir, trial_set2)],
+                                         trq_sensor_no=trq_sensor_no, workers=workers)
+    group1, group2 = ([sta.batch_isi_data(batch, neuron_id=neuron, afferent_type=afferent_type) for batch, _ in batches]
+                      for batches in (batches1, batches2))
+    return rs.kl_significance(group1, group2, n_bins=n_bins, n_permutations=n_permutations, n_bootstrap=n_bootstrap,
+                              confidence=confidence, by_trial=by_trial, seed=seed, workers=workers)
+
+
+def compare_sweep(data_dir, noise=None, sensor=None, obj=None, dim=None, n_bins=30, neuron=None, afferent_type=None,
+                  trq_sensor_no=0, workers=None):
+    """
+    Compares every pair of conditions (noise, sensor, object, dim) of a sweep grid below data_dir, loading each
+    trial once, e.g. compare_sweep(sweep_dir, noise=[-6, 0, 9], sensor='ftsn', obj=[1, 2])
+    [see noisesweep.noise_sweep_grid()]
+    :return: pair table (columns noise_a ... dim_b, metric, value), condition table, bin edges
+    """
+    return ns.noise_sweep_grid(data_dir, noise=noise, sensor=sensor, obj=obj, dim=dim, n_bins=n_bins,
+                               neuron_id=neuron, afferent_type=afferent_type, trq_sensor_no=trq_sensor_no,
+                               workers=workers)
+
+
+def compare_spike_trains(data_dir, trials, metric='van_rossum', neuron=None, afferent_type=None, tau=0.01, cost=100.0,
+                         trq_sensor_no=0, workers=None):
+    """
+    Compares the spike timing of every pair of trials with the van Rossum (time constant tau, sec) or Victor-Purpura
+    (cost per second of shifting a spike) distance, for one neuron, one afferent type or every afferent
+    [see spikedistance.population_distance_matrix()]
+    :return: trials x trials distance matrix, (directory, file) of each row/column
+    """
+    return sd.trial_spike_distance_matrix(data_dir, trials, metric=metric, neuron_id=neuron,
+                                          afferent_type=afferent_type, tau=tau, cost=cost,
+                                          trq_sensor_no=trq_sensor_no, workers=workers)
+
+
 def trial_select(data_dir, noise=None, sensor=r'\w+', obj=r'\d+', dim=r'\d+', trial=r'\d+'):
     patterns = []
     if sensor is not None:
@@ -178,31 +225,49 @@ def trial_select(data_dir, noise=None, sensor=r'\w+', obj=r'\d+', dim=r'\d+', tr
         [patterns.append(f'dim_{dim}')]
     if trial is not None:
         [patterns.append(f'trial_{trial}')]
+    patterns = [re.compile(regex) for regex in patterns]
 
     trial_list = []
     noise_dir = ''
 
+    #  Directory listings come from the trial catalog instead of walking data_dir on every query
+    catalog = get_trial_catalog(data_dir)
+    directories = [data_dir if directory == catalog.data_dir else
+                   os.path.join(data_dir, os.path.relpath(directory, catalog.data_dir))
+                   for directory in catalog.directories]
+    files = catalog.table['file'].tolist()
+    file_directories = catalog.table['directory'].tolist()
+
     if isinstance(noise, int) or isinstance(noise, np.integer):
         if noise < 0:
             noise = 'minus' + str(abs(noise))
         else:
             noise = 'noise_' + str(noise)
 
-        for subdir, dirs, files in os.walk(data_dir):
-            if re.search(noise, subdir):
+        noise_dirs = [re.search(noise, subdir) is not None for subdir in directories]
+        for directory_no, subdir in enumerate(directories):
+            if noise_dirs[directory_no]:
                 noise_dir = subdir
-                for file in files:
-                    if all(re.search(regex, file) for regex in patterns):
-                        trial_list.append(file)
+        for file, directory_no in zip(files, file_directories):
+            if noise_dirs[directory_no] and all(regex.search(file) for regex in patterns):
+                trial_list.append(file)
     else:
-        for subdir, dirs, files in os.walk(data_dir):
-            for file in files:
-                if all(re.search(regex, file) for regex in patterns):
-                    trial_list.append(file)
+        for file in files:
+            if all(regex.search(file) for regex in patterns):
+                trial_list.append(file)
 
     return trial_list, noise_dir
 
 
+def trial_query(data_dir, noise=None, sensor=None, obj=None, dim=None, trial=None):
+    """
+    Indexed alternative to trial_select(): exact matches on the conditions parsed into the trial catalog
+    (noise in dB, sensor 'trq'/'ftsn', object, dim, trial; each a value or a list of values, None for any).
+    Returns full paths, which the compare_* functions and spiketrainanalysis loaders accept as trial lists.
+    """
+    return get_trial_catalog(data_dir).query(noise=noise, sensor=sensor, obj=obj, dim=dim, trial=trial)
+
+
 """
 1) different neurons or different neuron types in a given file 
 2) responses to different objects or dimension for a given neuron 